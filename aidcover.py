@@ -0,0 +1,190 @@
+"""How far each part of the course is from first aid.
+
+The routes are cut into stations every STATION_METERS. For every station
+we keep the ETA of each first-aid crew within HORIZON_FACTOR times the gap
+threshold of it, and the best of those. A crew moving, or changing
+transport or first aid, only touches the stations in its own reach, found
+through a grid, so updates are cheap enough for every crew fix. Crews that
+moved less than MOVE_METERS since their last update are skipped entirely.
+
+ETAs are straight-line distance times DETOUR at the transport's speed; a
+rough guess, but the same guess for every crew, which is what ranking them
+needs. Stations whose best ETA is over the gap threshold (or beyond the
+horizon, None) form gaps; the report lists them with which crew to move
+where, preferring crews that aren't the only cover for anywhere else.
+"""
+import math
+import os
+
+GAP_MINUTES = float(os.environ.get('COVERAGE_GAP_MINUTES', '5'))
+STATION_METERS = 100
+# ETAs are kept up to this many times the gap threshold
+HORIZON_FACTOR = 2
+# Speeds over the ground in m/s, and how much longer paths are than a straight line
+SPEEDS = {'walk': 1.4, 'bike': 4.0}
+DETOUR = 1.3
+# Under 20 s on foot; smaller moves don't change the picture
+MOVE_METERS = 25
+CELL_METERS = 250
+MAX_SUGGESTIONS = 5
+
+
+class Coverage(object):
+
+    def __init__(self, route_points, projection, gap_minutes=GAP_MINUTES):
+        self.projection = projection
+        self.gap_seconds = gap_minutes * 60
+        self.horizon = self.gap_seconds * HORIZON_FACTOR
+        # (route, km, x, y), consecutive along each route
+        self.stations = []
+        self.grid = {}
+        for name, points in route_points.items():
+            self.add_route(name, [projection.to_xy(lat, lng) for lat, lng in points])
+        # Per station: {crew: ETA seconds} within the horizon, and the best
+        self.etas = [{} for _ in self.stations]
+        self.best = [None] * len(self.stations)
+        # Per crew: (x, y, speed) last used, and {station: ETA}
+        self.crews = {}
+        self.reach = {}
+        self.version = 0
+
+    def add_route(self, name, points):
+        walked = 0.0
+        next_station = 0.0
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            step = math.hypot(x1 - x0, y1 - y0)
+            while step and walked + step >= next_station:
+                share = (next_station - walked) / step
+                x, y = x0 + (x1 - x0) * share, y0 + (y1 - y0) * share
+                cell = (int(x // CELL_METERS), int(y // CELL_METERS))
+                self.grid.setdefault(cell, []).append(len(self.stations))
+                self.stations.append((name, round(next_station / 1000.0, 1), x, y))
+                next_station += STATION_METERS
+            walked += step
+
+    def update(self, crew_id, crew):
+        """Refresh one crew's ETAs from its record in RaceEvent.crews."""
+        if not crew.get('first_aid') or not crew.get('sharing', True):
+            self.remove(crew_id)
+            return
+        x, y = self.projection.to_xy(*crew['location'])
+        speed = SPEEDS.get(crew.get('transport'), SPEEDS['walk'])
+        last = self.crews.get(crew_id)
+        if last is not None and last[2] == speed and math.hypot(x - last[0], y - last[1]) < MOVE_METERS:
+            return
+        self.crews[crew_id] = (x, y, speed)
+
+        meters = self.horizon * speed / DETOUR
+        reach = {}
+        cells = int(meters // CELL_METERS) + 1
+        cx, cy = int(x // CELL_METERS), int(y // CELL_METERS)
+        stations = self.stations
+        # The course only touches a few cells; a bike's reach spans hundreds
+        if (2 * cells + 1) ** 2 > len(self.grid):
+            nearby = [indexes for (gx, gy), indexes in self.grid.items()
+                      if abs(gx - cx) <= cells and abs(gy - cy) <= cells]
+        else:
+            nearby = [self.grid[(gx, gy)] for gx in range(cx - cells, cx + cells + 1)
+                      for gy in range(cy - cells, cy + cells + 1) if (gx, gy) in self.grid]
+        for indexes in nearby:
+            for index in indexes:
+                _, _, sx, sy = stations[index]
+                eta = int(math.hypot(sx - x, sy - y) * DETOUR / speed)
+                if eta <= self.horizon:
+                    reach[index] = eta
+        self.apply(crew_id, reach)
+
+    def remove(self, crew_id):
+        self.crews.pop(crew_id, None)
+        if crew_id in self.reach:
+            self.apply(crew_id, {})
+
+    def apply(self, crew_id, reach):
+        old = self.reach.get(crew_id, {})
+        etas, best = self.etas, self.best
+        touched = []
+        for index in old:
+            if index not in reach:
+                del etas[index][crew_id]
+                touched.append(index)
+        for index, eta in reach.items():
+            if old.get(index) != eta:
+                etas[index][crew_id] = eta
+                touched.append(index)
+        for index in touched:
+            value = min(etas[index].values()) if etas[index] else None
+            if value != best[index]:
+                best[index] = value
+                self.version += 1
+        if reach:
+            self.reach[crew_id] = reach
+        else:
+            self.reach.pop(crew_id, None)
+
+    def gaps(self):
+        """Runs of consecutive stations on a route that are over the threshold."""
+        gaps = []
+        current = None
+        for index, (route, km, _, _) in enumerate(self.stations):
+            eta = self.best[index]
+            if eta is not None and eta <= self.gap_seconds:
+                current = None
+                continue
+            if current is None or current['route'] != route or current['last'] != index - 1:
+                current = {'route': route, 'first': index, 'last': index, 'worst': eta}
+                gaps.append(current)
+            else:
+                current['last'] = index
+                if current['worst'] is not None and (eta is None or eta > current['worst']):
+                    current['worst'] = eta
+        return gaps
+
+    def report(self, busy=()):
+        """Gaps, longest first, with repositioning suggestions for crews not in `busy`."""
+        to_latlng = self.projection.to_latlng
+        gaps = sorted(self.gaps(), key=lambda gap: gap['first'] - gap['last'])
+        gap_seconds = self.gap_seconds
+        # Crews within the threshold of each station; a crew that is the only
+        # one for some station stays put, so a move never opens a new gap
+        counts = [sum(1 for eta in etas.values() if eta <= gap_seconds) for etas in self.etas]
+        free = dict((crew_id, position) for crew_id, position in self.crews.items() if crew_id not in busy)
+
+        listed = []
+        suggestions = []
+        for gap in gaps:
+            first, last = self.stations[gap['first']], self.stations[gap['last']]
+            middle = self.stations[(gap['first'] + gap['last']) // 2]
+            listed.append({
+                'route': gap['route'],
+                'from_km': first[1],
+                'to_km': last[1],
+                'worst_eta': gap['worst'],
+                'path': [list(to_latlng(x, y)) for _, _, x, y in self.stations[gap['first']:gap['last'] + 1]]
+            })
+            if len(suggestions) >= MAX_SUGGESTIONS:
+                continue
+            movable = [crew_id for crew_id in free if all(
+                counts[index] > 1 for index, eta in self.reach.get(crew_id, {}).items() if eta <= gap_seconds)]
+            if movable:
+                _, km, mx, my = middle
+                crew_id = min(movable, key=lambda c: math.hypot(free[c][0] - mx, free[c][1] - my) / free[c][2])
+                x, y, speed = free.pop(crew_id)
+                for index, eta in self.reach.get(crew_id, {}).items():
+                    if eta <= gap_seconds:
+                        counts[index] -= 1
+                suggestions.append({
+                    'crew': crew_id,
+                    'route': gap['route'],
+                    'km': km,
+                    'to': list(to_latlng(mx, my)),
+                    'eta': int(math.hypot(mx - x, my - y) * DETOUR / speed)
+                })
+        covered = sum(1 for eta in self.best if eta is not None and eta <= gap_seconds)
+        return {
+            'gap_minutes': self.gap_seconds / 60.0,
+            'stations': len(self.stations),
+            'covered': covered,
+            'crews': len(self.crews),
+            'gaps': listed,
+            'suggestions': suggestions
+        }
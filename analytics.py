@@ -0,0 +1,309 @@
+"""Off-course corridor lookups in worker processes.
+
+The hub copies a tick's positions into a shared-memory block and posts slice
+offsets to persistent worker processes. Workers read the block, run the
+lookup and write the results back into the same block, so nothing bigger
+than a few tuples is ever pickled, and nothing comes back over a pipe.
+Course corridor rasters are shared the same way, once per event.
+
+Only the corridor lookup runs here, and it is the cheapest per-tick step:
+the hub still packs the batch and applies the results, so at 10k runners
+this saves about a quarter of the off-course check's hub time (15.8 ms
+inline, 11.8 ms with the pool). The Kalman flush, clustering, stationary
+detection, density tiles, coverage and the spectator feed all stay on the
+hub, and they are what tick time grows with; RaceEvent.tick yields to the
+handlers between them instead.
+
+Results are collected on a later tick. If a job's previous batch is still
+running when the next tick comes round, that tick is skipped rather than
+queued, so a pool that falls behind gives coarser analytics instead of a
+growing backlog. A worker that hasn't finished its slice WORKER_DEADLINE
+seconds after it was posted is taken to be hung: it is killed and replaced,
+and its batch dropped, so one stuck process can't stop the checks for good.
+"""
+from array import array
+from multiprocessing import resource_tracker, shared_memory
+import atexit
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+
+from corridor import CourseCorridor
+
+WORKERS = int(os.environ.get('ANALYTICS_WORKERS', '2'))
+# Rows in a fresh batch block; blocks double when a tick outgrows them
+MIN_ROWS = 1024
+# Done slots at the head of each batch block, so at most this many workers
+SLOTS = 16
+DOUBLE = array('d').itemsize
+# A batch takes milliseconds; a slice still out after this is hung
+WORKER_DEADLINE = 10.0
+
+
+def start_pool(workers=WORKERS):
+    """An AnalyticsPool, or None to keep analytics inline on the hub."""
+    if workers <= 0:
+        return None
+    pool = AnalyticsPool(workers)
+    atexit.register(pool.close)
+    return pool
+
+
+def attach(name):
+    block = shared_memory.SharedMemory(name=name)
+    # The hub owns every block; stop this process's resource tracker from
+    # unlinking them when the worker exits
+    resource_tracker.unregister(block._name, 'shared_memory')
+    return block
+
+
+def distances(blocks, corridors, batch, block_name, slot, rows, segments):
+    # A function of its own so every view of a block is gone on return and
+    # the block can be closed when the hub says to forget it
+    if block_name not in blocks:
+        blocks[block_name] = attach(block_name)
+    view = blocks[block_name].buf.cast('d')
+    for grid_name, layout, start, stop in segments:
+        corridor = corridors.get(grid_name)
+        if corridor is None:
+            blocks[grid_name] = attach(grid_name)
+            size = layout[6] * layout[7]
+            corridor = corridors[grid_name] = CourseCorridor.from_grid(layout, blocks[grid_name].buf[:size])
+        lats = view[SLOTS + start:SLOTS + stop]
+        lngs = view[SLOTS + rows + start:SLOTS + rows + stop]
+        view[SLOTS + 2 * rows + start:SLOTS + 2 * rows + stop] = array('d', corridor.distances(lats, lngs))
+        lats.release()
+        lngs.release()
+    # Results are in place: stamp this slice's slot with the batch number
+    view[slot] = batch
+    view.release()
+
+
+def worker_main(stream):
+    # Shared blocks and corridors stay attached between ticks
+    blocks = {}
+    corridors = {}
+    for line in stream:
+        message = json.loads(line)
+        if message[0] == 'forget':
+            for name in message[1]:
+                corridors.pop(name, None)
+                block = blocks.pop(name, None)
+                if block is not None:
+                    block.close()
+        else:
+            distances(blocks, corridors, *message[1:])
+    # The hub has gone away
+    corridors.clear()
+    for block in blocks.values():
+        block.close()
+
+
+class AnalyticsPool(object):
+
+    def __init__(self, workers=WORKERS):
+        self.workers = [self._start() for _ in range(min(workers, SLOTS))]
+        self.jobs = {}
+        self.job_ids = itertools.count(1)
+
+    def _start(self):
+        # A fresh interpreter rather than a fork, so workers inherit neither
+        # the hub's sockets nor eventlet's patched modules
+        process = subprocess.Popen([sys.executable, '-m', 'analytics'], stdin=subprocess.PIPE,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        # Last batch sent per job, to know what is lost if the worker dies
+        return {'process': process, 'jobs': {}}
+
+    def corridor_job(self, corridors):
+        job = CorridorJob(self, next(self.job_ids), corridors)
+        self.jobs[job.id] = job
+        return job
+
+    def send(self, worker, message):
+        try:
+            worker['process'].stdin.write(json.dumps(message).encode() + b'\n')
+            worker['process'].stdin.flush()
+        except (OSError, ValueError):
+            # Dead; check() replaces it
+            pass
+
+    def post(self, worker, job, message):
+        self.send(worker, message)
+        worker['jobs'][job.id] = job.batch
+
+    def check(self, hung=()):
+        """Replace dead workers, and kill and replace the workers at the
+        indexes in `hung`; give up on the batches they held."""
+        for i, worker in enumerate(self.workers):
+            if i in hung and worker['process'].poll() is None:
+                worker['process'].kill()
+                worker['process'].wait()
+            if worker['process'].poll() is None:
+                continue
+            self.workers[i] = self._start()
+            for job_id, batch in worker['jobs'].items():
+                job = self.jobs.get(job_id)
+                if job is not None and job.batch == batch:
+                    job.lost()
+
+    def forget(self, names):
+        for worker in self.workers:
+            self.send(worker, ('forget', names))
+
+    def close(self):
+        for job in list(self.jobs.values()):
+            job.close()
+        for worker in self.workers:
+            process = worker['process']
+            try:
+                process.stdin.close()
+                process.wait(1)
+            except (OSError, subprocess.TimeoutExpired):
+                process.kill()
+
+
+class CorridorJob(object):
+    """Off-course distances for one event's runners, one batch in flight.
+
+    Rows are grouped by route so each worker slice is a few contiguous
+    (corridor, start, stop) segments. Block layout, in doubles: one done
+    slot per worker, then lats[rows], lngs[rows], distances[rows]. Polling
+    the slots is a memory read, so collecting never blocks or yields.
+    """
+
+    def __init__(self, pool, job_id, corridors):
+        self.pool = pool
+        self.id = job_id
+        self.grids = {}
+        for route, corridor in corridors.items():
+            grid = shared_memory.SharedMemory(create=True, size=max(len(corridor.grid), 1))
+            grid.buf[:len(corridor.grid)] = corridor.grid.tobytes()
+            self.grids[route] = (grid, corridor.layout())
+        self.block = None
+        self.rows = 0
+        self.batch = 0
+        self.slices = 0
+        self.pending = None
+        self.submitted = None
+        self.skipped = 0
+        self.hung = 0
+
+    def busy(self):
+        return self.pending is not None
+
+    def submit(self, batches):
+        """Queue {route: (sids, lats, lngs)}. Returns False, and counts a
+        skipped tick, if the previous batch hasn't been collected yet."""
+        if self.busy():
+            self.skipped += 1
+            return False
+        batches = [(route, batch) for route, batch in batches.items() if route in self.grids]
+        count = sum(len(sids) for _, (sids, _, _) in batches)
+        if not count:
+            return True
+        if count > self.rows:
+            self._grow(count)
+        rows = self.rows
+        view = self.block.buf.cast('d')
+        start = 0
+        segments = []
+        for route, (sids, lats, lngs) in batches:
+            stop = start + len(sids)
+            view[SLOTS + start:SLOTS + stop] = array('d', lats)
+            view[SLOTS + rows + start:SLOTS + rows + stop] = array('d', lngs)
+            segments.append((route, start, stop))
+            start = stop
+        view.release()
+
+        # Split the rows evenly across workers, cutting segments as needed
+        self.batch += 1
+        workers = self.pool.workers
+        share = -(-count // len(workers))
+        self.slices = 0
+        for worker in workers:
+            lo, hi = self.slices * share, min((self.slices + 1) * share, count)
+            if lo >= hi:
+                break
+            work = []
+            for route, start, stop in segments:
+                if start < hi and stop > lo:
+                    grid, layout = self.grids[route]
+                    work.append((grid.name, layout, max(start, lo), min(stop, hi)))
+            self.pool.post(worker, self, ('distances', self.batch, self.block.name, self.slices, rows, work))
+            self.slices += 1
+        self.pending = [(route, sids) for route, (sids, _, _) in batches]
+        self.submitted = time.monotonic()
+        return True
+
+    def collect(self):
+        """[(route, sids, distances)] for the batch in flight once every
+        slice is back, otherwise None."""
+        if self.pending is None:
+            return None
+        self.pool.check()
+        if self.pending is None:
+            return None
+        view = self.block.buf.cast('d')
+        try:
+            # Slice i went to worker i
+            late = [slot for slot in range(self.slices) if view[slot] != self.batch]
+            out = []
+            if not late:
+                start = SLOTS + 2 * self.rows
+                for route, sids in self.pending:
+                    out.append((route, sids, view[start:start + len(sids)].tolist()))
+                    start += len(sids)
+        finally:
+            view.release()
+        if late:
+            if time.monotonic() - self.submitted > WORKER_DEADLINE:
+                # Replacing the hung workers drops this batch (see lost)
+                self.hung += 1
+                self.pool.check(late)
+            return None
+        self.pending = None
+        return out
+
+    def lost(self):
+        # A worker died mid-batch: drop the batch and its block, since the
+        # surviving workers may still be writing into it. The next tick
+        # resubmits into a fresh one.
+        self.pending = None
+        self.pool.forget([self.block.name])
+        self._free(self.block)
+        self.block = None
+        self.rows = 0
+
+    def _grow(self, count):
+        rows = MIN_ROWS
+        while rows < count:
+            rows *= 2
+        if self.block is not None:
+            self.pool.forget([self.block.name])
+            self._free(self.block)
+        self.block = shared_memory.SharedMemory(create=True, size=(SLOTS + 3 * rows) * DOUBLE)
+        self.rows = rows
+
+    def _free(self, block):
+        block.close()
+        block.unlink()
+
+    def close(self):
+        names = [grid.name for grid, _ in self.grids.values()]
+        if self.block is not None:
+            names.append(self.block.name)
+        self.pool.forget(names)
+        for grid, _ in self.grids.values():
+            self._free(grid)
+        if self.block is not None:
+            self._free(self.block)
+        self.grids = {}
+        self.block = None
+        self.pool.jobs.pop(self.id, None)
+
+
+if __name__ == '__main__':
+    worker_main(sys.stdin.buffer)
@@ -0,0 +1,305 @@
+"""HTTP API, independent of the web framework.
+
+Each function takes the request's RaceEvent (None when the ?event= doesn't
+exist) and returns (payload, status) for the server mode to serialise.
+"""
+from datetime import datetime
+import hmac
+import json
+import math
+import os
+import time
+import zlib
+
+from courses import DEFAULT_EVENT, EVENT_ID
+import export
+import history
+import overlays
+import profiler
+import spectators
+import tiles
+
+# Admin endpoints are disabled unless a token is configured
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+NOT_FOUND = ({'error': 'Event not found'}, 404)
+
+# History queries: the largest area and time span one request may cover
+MAX_HISTORY_RADIUS = 5000
+MAX_HISTORY_SECONDS = 24 * 3600
+
+# Offline fix batches, before and after gzip
+MAX_BATCH_BYTES = 2 * 1024 * 1024
+MAX_BATCH_FIXES = 5000
+# Fix times a batch may carry, relative to now: a day back (a page offline
+# for longer has nothing useful left), and phone clocks a little ahead
+MAX_BATCH_AGE = 24 * 3600
+MAX_BATCH_AHEAD = 600
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def route(event, route_name):
+    if event is not None and route_name in event.route_points:
+        return {'route': event.route_points[route_name]}, 200
+    return {'error': 'Route not found'}, 404
+
+
+def all_routes(event):
+    if event is None:
+        return NOT_FOUND
+    return event.route_points, 200
+
+
+def incidents(event, status=None):
+    if event is None:
+        return NOT_FOUND
+    board = event.incident_board
+    if status:
+        if status not in board.by_status:
+            return {'error': 'Unknown status'}, 400
+        return {status: board.with_status(status)}, 200
+    return {status: board.with_status(status) for status in board.by_status}, 200
+
+
+def alert_latency(event):
+    if event is None:
+        return NOT_FOUND
+    return event.alert_dispatcher.stats(), 200
+
+
+def freshness(event):
+    """GPS-to-screen delay histograms per hop and role."""
+    if event is None:
+        return NOT_FOUND
+    return event.freshness.stats(), 200
+
+
+def coverage(event):
+    """First-aid coverage gaps along the course and who to move where."""
+    if event is None:
+        return NOT_FOUND
+    return event.coverage_report or event.coverage.report(), 200
+
+
+def client_lag(event, now):
+    if event is None:
+        return NOT_FOUND
+    return event.outbox.stats(now), 200
+
+
+def hub_lag(watchdog):
+    return watchdog.stats(), 200
+
+
+def track(event, participant, since=None):
+    # participant is a bib number or a participant ID
+    key = event.track_store.lookup(participant) if event is not None else None
+    if key is None:
+        return {'error': 'Track not found'}, 404
+    return event.track_store.encoded(key, since=to_float(since)), 200
+
+
+def fix_batch(event, body, encoding=None, now=None):
+    """Merge a page's offline buffer. The body is JSON, optionally with
+    'Content-Encoding: gzip': {"token": <session token>, "route", "bib",
+    "fixes": [[t_ms, lat, lng, accuracy], ...]}."""
+    if event is None:
+        return NOT_FOUND
+    if len(body) > MAX_BATCH_BYTES:
+        return {'error': 'Batch too large'}, 413
+    if encoding == 'gzip':
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            body = inflater.decompress(body, MAX_BATCH_BYTES)
+        except zlib.error:
+            return {'error': 'Bad gzip body'}, 400
+        if inflater.unconsumed_tail:
+            return {'error': 'Batch too large'}, 413
+    try:
+        batch = json.loads(body)
+    except ValueError:
+        return {'error': 'Bad JSON body'}, 400
+    if not isinstance(batch, dict) or not isinstance(batch.get('fixes'), list):
+        return {'error': 'Expected an object with a fixes list'}, 400
+    if len(batch['fixes']) > MAX_BATCH_FIXES:
+        return {'error': 'At most %d fixes per batch' % MAX_BATCH_FIXES}, 413
+    pid = event.presence.holder(batch.get('token'))
+    if pid is None:
+        return {'error': 'Unknown session'}, 403
+
+    if now is None:
+        now = time.time()
+    fixes = []
+    rejected = 0
+    for fix in batch['fixes']:
+        try:
+            t, lat, lng = float(fix[0]) / 1000.0, float(fix[1]), float(fix[2])
+            accuracy = to_float(fix[3]) if len(fix) > 3 else None
+        except (TypeError, ValueError, IndexError, KeyError):
+            rejected += 1
+            continue
+        # Comparisons with NaN are false, so it fails every range check
+        if (now - MAX_BATCH_AGE <= t <= now + MAX_BATCH_AHEAD
+                and -90 <= lat <= 90 and -180 <= lng <= 180):
+            if accuracy is not None and not math.isfinite(accuracy):
+                accuracy = None
+            fixes.append((t, lat, lng, accuracy))
+        else:
+            rejected += 1
+    result = event.ingest_fixes(pid, fixes, batch, now)
+    result['rejected'] = rejected
+    return result, 200
+
+
+def to_time(value):
+    """Epoch seconds, or an ISO 8601 date and time (local time without an offset)."""
+    seconds = to_float(value)
+    if seconds is not None or not value:
+        return seconds
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+
+def history_query(event, query, args, now):
+    """/admin/history/within: who was within ?radius= metres of ?lat=&lng=
+    between ?from= and ?to=. /admin/history/nearest: the ?count= closest
+    to ?lat=&lng= in the ?window= seconds up to ?at=. Both take ?type=.
+    /admin/history/stats: what is held in memory and on disk."""
+    if event is None:
+        return NOT_FOUND
+    if query == 'stats':
+        return event.history.stats(), 200
+    lat, lng = to_float(args.get('lat')), to_float(args.get('lng'))
+    if lat is None or lng is None:
+        return {'error': 'lat and lng are required'}, 400
+    x, y = event.projection.to_xy(lat, lng)
+    kind = args.get('type')
+    if query == 'within':
+        radius = to_float(args.get('radius')) or 200.0
+        start, end = to_time(args.get('from')), to_time(args.get('to')) or now
+        if start is None or end is None:
+            return {'error': 'from and to must be epoch seconds or ISO 8601'}, 400
+        if not 0 < radius <= MAX_HISTORY_RADIUS or not 0 <= end - start <= MAX_HISTORY_SECONDS:
+            return {'error': 'radius is at most %d m and the range at most %d s'
+                             % (MAX_HISTORY_RADIUS, MAX_HISTORY_SECONDS)}, 400
+        return {'participants': event.history.within(x, y, radius, start, end, kind)}, 200
+    if query == 'nearest':
+        at = to_time(args.get('at')) or now
+        window = to_float(args.get('window')) or 120.0
+        count = int(to_float(args.get('count')) or 5)
+        if not 0 < window <= MAX_HISTORY_SECONDS or not 0 < count <= 100:
+            return {'error': 'window is at most %d s and count at most 100' % MAX_HISTORY_SECONDS}, 400
+        return {'participants': event.history.nearest(x, y, at, count, window, kind)}, 200
+    return {'error': 'Not found'}, 404
+
+
+def export_command(args):
+    """(argv, headers) for an export process streaming to stdout, or
+    (None, error). Works for finished races as well as live ones: it reads
+    the event's history directory, not the RaceEvent. ?run= picks an
+    earlier run than the latest."""
+    event_id = args.get('event', DEFAULT_EVENT)
+    output = args.get('format', 'geojsonseq')
+    if not EVENT_ID.match(event_id):
+        return None, NOT_FOUND
+    runs = history.runs(os.path.join(history.HISTORY_DIR, event_id))
+    run = args.get('run') or (runs[-1] if runs else None)
+    if run not in runs:
+        return None, NOT_FOUND
+    if output not in export.FORMATS:
+        return None, ({'error': 'format is one of %s' % ', '.join(sorted(export.FORMATS))}, 400)
+    if not export.available(output):
+        return None, ({'error': '%s export is not installed' % output}, 501)
+    start, end = to_time(args.get('from')), to_time(args.get('to'))
+    if (args.get('from') and start is None) or (args.get('to') and end is None):
+        return None, ({'error': 'from and to must be epoch seconds or ISO 8601'}, 400)
+    participant = args.get('participant')
+    content_type, extension = export.FORMATS[output]
+    name = '%s-%s' % (event_id, run)
+    name = '%s-%s.%s' % (name, participant, extension) if participant else '%s.%s' % (name, extension)
+    headers = {
+        'Content-Type': content_type,
+        'Content-Disposition': 'attachment; filename="%s"' % name.replace('"', '')
+    }
+    return (export.command(event_id, output, participant, start, end, run), headers), None
+
+
+def tile(cache, z, x, y):
+    """A map tile's PNG bytes, from the cache or fetched on a miss."""
+    if not tiles.valid(z, x, y):
+        return {'error': 'Not found'}, 404
+    try:
+        data = cache.get(z, x, y)
+    except OSError:
+        return {'error': 'Tile server unavailable'}, 502
+    if data is None:
+        return {'error': 'Not found'}, 404
+    return data, 200
+
+
+def vector_tile(event, layer, z, x, y):
+    """((tile bytes, ETag), 200) for a course or density vector tile. Empty
+    tiles are still 200 so the map doesn't treat them as errors."""
+    if event is None:
+        return NOT_FOUND
+    if layer not in overlays.LAYERS or not tiles.valid(z, x, y):
+        return {'error': 'Not found'}, 404
+    source = event.course_overlay() if layer == 'course' else event.density_tiles
+    return source.tile(z, x, y), 200
+
+
+def spectate(event, gate, bib=None, last_event_id=None):
+    """((SSE chunk generator, headers), 200) for a spectator stream of every
+    runner or of the bibs in ?bib=, or an error. An admitted stream holds a
+    place in `gate` until the server releases it."""
+    if event is None:
+        return NOT_FOUND
+    try:
+        bibs = spectators.parse_bibs(bib)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    if not gate.admit():
+        return {'error': 'Too many spectators, try again shortly'}, 503
+    stream = event.spectator_feed.stream(bibs, spectators.parse_seq(last_event_id))
+    return (stream, spectators.HEADERS), 200
+
+
+def spectator_stats(gate):
+    return gate.stats(), 200
+
+
+def admin_error(authorization=None, token=None):
+    """None if the request carries the admin token, else an error response.
+    The token goes in 'Authorization: Bearer <token>' or ?token=."""
+    if not ADMIN_TOKEN:
+        return {'error': 'Not found'}, 404
+    if authorization and authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):]
+    if not token or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return {'error': 'Forbidden'}, 403
+    return None
+
+
+def profile_seconds(sampler, seconds):
+    """(seconds, None) with the profiler claimed, or (None, error)."""
+    seconds = to_float(seconds) or 10.0
+    if not 0 < seconds <= profiler.MAX_SECONDS:
+        return None, ({'error': 'seconds must be between 0 and %d' % profiler.MAX_SECONDS}, 400)
+    if not sampler.claim():
+        return None, ({'error': 'A profile is already running'}, 409)
+    return seconds, None
+
+
+def profile_result(counts, output=None):
+    """Collapsed stacks as text by default, or ?format=json for a summary."""
+    if output == 'json':
+        return profiler.summary(counts), 200
+    return profiler.collapsed(counts), 200
@@ -0,0 +1,420 @@
+"""Native asyncio server mode: python-socketio's AsyncServer under ASGI.
+
+An alternative to app.py that needs no eventlet monkey-patching, for
+deployments that want a standard ASGI server:
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+The race logic, handlers, HTTP API and courses are the same modules the
+eventlet server uses; only the transport and the tick loop differ.
+"""
+import asyncio
+import json
+import threading
+import time
+from urllib.parse import parse_qs
+
+import socketio
+
+from race import EventRegistry, HANDLERS
+from courses import DEFAULT_EVENT, event_ids, load_routes
+import api
+import export
+import outbox
+import overlays
+import spectators
+import tiles
+from analytics import start_pool
+import logs
+from logs import logger
+from hubwatch import HubWatchdog
+from profiler import SamplingProfiler
+
+TICK_SECONDS = 1.0
+EVENT_IDLE_SECONDS = 1800
+watchdog = HubWatchdog(threading.get_ident())
+profiler = SamplingProfiler(threading.get_ident())
+
+PAGES = {'/': 'index.html', '/index.html': 'index.html', '/crew': 'crew.html', '/crew.html': 'crew.html'}
+
+sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*', ping_timeout=60, ping_interval=25)
+
+
+class AsyncTransport(object):
+    # RaceEvent calls the transport synchronously; the AsyncServer's methods
+    # are coroutines, so they are scheduled in call order on the running loop.
+    # Tasks are kept referenced until done so they can't be garbage collected.
+
+    def __init__(self, server):
+        self.server = server
+        self.pending = set()
+
+    def schedule(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    def emit(self, event, payload, to=None, skip_sid=None, callback=None):
+        self.schedule(self.server.emit(event, payload, to=to, skip_sid=skip_sid, callback=callback))
+
+    def enter_room(self, sid, room):
+        self.schedule(self.server.enter_room(sid, room, namespace='/'))
+
+    def leave_room(self, sid, room):
+        self.schedule(self.server.leave_room(sid, room, namespace='/'))
+
+    def backlog(self, sid):
+        # Packets waiting in the client's Engine.IO send queue
+        socket = self.server.eio.sockets.get(self.server.manager.eio_sid_from_sid(sid, '/'))
+        return socket.queue.qsize() if socket is not None else None
+
+    def drop_queued(self, sid, events):
+        # Position packets waiting in that queue, ahead of an alert. Emits
+        # before this one are still scheduled, so the drop is too
+        self.schedule(self._drop_queued(sid, events))
+
+    async def _drop_queued(self, sid, events):
+        socket = self.server.eio.sockets.get(self.server.manager.eio_sid_from_sid(sid, '/'))
+        if socket is not None:
+            outbox.drop_positions(socket.queue, socket.queue._queue, events)
+
+
+def offload(fn, arg, done):
+    # Corridor builds and history writes run in a thread; done() comes back
+    # on the loop
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # At import, before there is anything to stall
+        done(fn(arg))
+        return
+    loop.run_in_executor(None, fn, arg).add_done_callback(lambda future: done(future.result()))
+
+
+registry = EventRegistry(AsyncTransport(sio), load_routes, idle_seconds=EVENT_IDLE_SECONDS, pinned=[DEFAULT_EVENT],
+                         hub_lag=watchdog.recent_lag, offload=offload)
+registry.prepare(event_ids())
+registry.get(DEFAULT_EVENT)
+tile_cache = tiles.TileCache()
+spectator_gate = spectators.Gate()
+tick_started = False
+
+
+def start_tick():
+    global tick_started
+    if not tick_started:
+        tick_started = True
+        # Started with the first client, so importing the app doesn't start workers
+        registry.use_analytics(start_pool())
+        sio.start_background_task(tick_loop)
+        sio.start_background_task(log_loop)
+        sio.start_background_task(heartbeat_loop)
+        threading.Thread(target=watchdog.watch, args=(time.sleep,), daemon=True).start()
+
+
+async def tick_loop():
+    while True:
+        await sio.sleep(TICK_SECONDS)
+        for _ in registry.tick(time.time()):
+            await sio.sleep(0)
+
+
+async def log_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        await sio.sleep(logs.FLUSH_SECONDS)
+        chunk = logger.drain()
+        if chunk:
+            await loop.run_in_executor(None, logs.write, chunk)
+
+
+async def heartbeat_loop():
+    while True:
+        watchdog.beat()
+        await sio.sleep(watchdog.interval)
+
+
+def query_arg(query_string, name, default=None):
+    if isinstance(query_string, bytes):
+        query_string = query_string.decode('latin-1')
+    values = parse_qs(query_string).get(name)
+    return values[0] if values else default
+
+
+@sio.event
+async def connect(sid, environ):
+    start_tick()
+    query_string = environ.get('QUERY_STRING', '')
+    event = registry.join(sid, query_arg(query_string, 'event', DEFAULT_EVENT), query_arg(query_string, 'resume'))
+    if event is None:
+        return False
+    logger.log('client_connected', sid=sid, race=event.id)
+
+
+@sio.event
+async def disconnect(sid):
+    registry.leave(sid)
+    logger.log('client_disconnected', sid=sid)
+
+
+def event_handler(name):
+    # Dispatch a Socket.IO event to the sender's RaceEvent
+    async def handler(sid, data=None):
+        return registry.handle(sid, name, data)
+    sio.on(name, handler)
+
+for name in HANDLERS:
+    event_handler(name)
+
+
+def http_api(path, query_string):
+    event = registry.get(query_arg(query_string, 'event', DEFAULT_EVENT))
+    parts = path.strip('/').split('/')
+    if parts[:2] == ['api', 'routes'] and len(parts) == 3:
+        return api.route(event, parts[2])
+    if parts == ['api', 'all-routes']:
+        return api.all_routes(event)
+    if parts == ['api', 'incidents']:
+        return api.incidents(event, query_arg(query_string, 'status'))
+    if parts == ['api', 'coverage']:
+        return api.coverage(event)
+    if parts == ['api', 'alert-latency']:
+        return api.alert_latency(event)
+    if parts == ['api', 'freshness']:
+        return api.freshness(event)
+    if parts == ['api', 'client-lag']:
+        return api.client_lag(event, time.time())
+    if parts == ['api', 'spectators']:
+        return api.spectator_stats(spectator_gate)
+    if parts == ['api', 'hub-lag']:
+        return api.hub_lag(watchdog)
+    if parts[:2] == ['api', 'tracks'] and len(parts) == 3:
+        return api.track(event, parts[2], query_arg(query_string, 'since'))
+    return {'error': 'Not found'}, 404
+
+
+async def admin_profile(scope):
+    query_string = scope.get('query_string', b'')
+    headers = dict(scope.get('headers', ()))
+    authorization = headers.get(b'authorization', b'').decode('latin-1')
+    error = api.admin_error(authorization, query_arg(query_string, 'token'))
+    if error:
+        return error
+    seconds, error = api.profile_seconds(profiler, query_arg(query_string, 'seconds'))
+    if error:
+        return error
+    # Sampling runs on a real thread; the loop keeps serving meanwhile
+    counts = await asyncio.get_running_loop().run_in_executor(None, profiler.profile, seconds, time.sleep)
+    return api.profile_result(counts, query_arg(query_string, 'format'))
+
+
+async def read_body(receive, limit):
+    # Stops reading past `limit`; the API rejects what came back as too large
+    body = b''
+    more = True
+    while more and len(body) <= limit:
+        message = await receive()
+        body += message.get('body', b'')
+        more = message.get('more_body', False)
+    return body
+
+
+async def post_fixes(scope, receive):
+    headers = dict(scope.get('headers', ()))
+    encoding = headers.get(b'content-encoding', b'').decode('latin-1') or None
+    body = await read_body(receive, api.MAX_BATCH_BYTES)
+    event = registry.get(query_arg(scope.get('query_string', b''), 'event', DEFAULT_EVENT))
+    return api.fix_batch(event, body, encoding, time.time())
+
+
+def admin_args(scope):
+    """(query arguments, None) for an admin request, or (None, error)."""
+    query_string = scope.get('query_string', b'')
+    headers = dict(scope.get('headers', ()))
+    error = api.admin_error(headers.get(b'authorization', b'').decode('latin-1'), query_arg(query_string, 'token'))
+    if error:
+        return None, error
+    if isinstance(query_string, bytes):
+        query_string = query_string.decode('latin-1')
+    return dict((name, values[0]) for name, values in parse_qs(query_string).items()), None
+
+
+def admin_history(scope):
+    args, error = admin_args(scope)
+    if error:
+        return error
+    event = registry.get(args.get('event', DEFAULT_EVENT))
+    return api.history_query(event, scope['path'].rsplit('/', 1)[-1], args, time.time())
+
+
+async def admin_export(scope, receive, send):
+    args, error = admin_args(scope)
+    if error:
+        return error
+    command, error = api.export_command(args)
+    if error:
+        return error
+    argv, headers = command
+    # A separate process does the work; the loop only relays its output,
+    # and kills it if the download is abandoned
+    process = await asyncio.create_subprocess_exec(*argv, stdout=asyncio.subprocess.PIPE)
+
+    async def watch():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        if process.returncode is None:
+            process.kill()
+
+    watcher = asyncio.ensure_future(watch())
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (name.lower().encode(), value.encode()) for name, value in headers.items()
+        ] + [(b'access-control-allow-origin', b'*')]})
+        while True:
+            chunk = await process.stdout.read(export.CHUNK_BYTES)
+            if not chunk:
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await process.wait()
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+        await process.wait()
+    return None
+
+
+async def get_tile(tile, send):
+    # Hits are a small file read; misses wait on upstream in a thread
+    payload = tile_cache.cached(*tile)
+    status = 200
+    if payload is None:
+        payload, status = await asyncio.get_running_loop().run_in_executor(None, api.tile, tile_cache, *tile)
+    if status != 200:
+        return payload, status
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'image/png'),
+        (b'content-length', str(len(payload)).encode()),
+        (b'cache-control', tiles.CACHE_CONTROL.encode()),
+        (b'access-control-allow-origin', b'*')
+    ]})
+    await send({'type': 'http.response.body', 'body': payload})
+    return None
+
+
+async def get_vector_tile(scope, vector_tile, send):
+    event = registry.get(query_arg(scope.get('query_string', b''), 'event', DEFAULT_EVENT))
+    payload, status = api.vector_tile(event, *vector_tile)
+    if status != 200:
+        return payload, status
+    data, etag = payload
+    # Pages revalidate every time; unchanged tiles cost a 304
+    headers = dict(scope.get('headers', ()))
+    if headers.get(b'if-none-match', b'').decode('latin-1') == etag:
+        status, data = 304, b''
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', overlays.CONTENT_TYPE.encode()),
+        (b'content-length', str(len(data)).encode()),
+        (b'cache-control', b'no-cache'),
+        (b'etag', etag.encode()),
+        (b'access-control-allow-origin', b'*')
+    ]})
+    await send({'type': 'http.response.body', 'body': data})
+    return None
+
+
+async def spectate(scope, receive, send):
+    query_string = scope.get('query_string', b'')
+    headers = dict(scope.get('headers', ()))
+    event = registry.get(query_arg(query_string, 'event', DEFAULT_EVENT))
+    result = api.spectate(event, spectator_gate, query_arg(query_string, 'bib'),
+                          headers.get(b'last-event-id', b'').decode('latin-1') or None)
+    if result[1] != 200:
+        return result
+    stream, headers = result[0]
+    disconnected = asyncio.Event()
+
+    async def watch():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.ensure_future(watch())
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (name.lower().encode(), value.encode()) for name, value in headers.items()
+        ] + [(b'access-control-allow-origin', b'*')]})
+        # Shared bytes from the feed, until the spectator goes away
+        for chunk in stream:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            try:
+                await asyncio.wait_for(disconnected.wait(), spectators.SPECTATOR_SECONDS)
+                break
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        watcher.cancel()
+        spectator_gate.release()
+    return None
+
+
+async def http_app(scope, receive, send):
+    # Everything that isn't Socket.IO or a page is the JSON API
+    tile = tiles.parse(scope['path'])
+    vector_tile = overlays.parse(scope['path'])
+    if tile is not None:
+        result = await get_tile(tile, send)
+        if result is None:
+            return
+        payload, status = result
+    elif vector_tile is not None:
+        result = await get_vector_tile(scope, vector_tile, send)
+        if result is None:
+            return
+        payload, status = result
+    elif scope['path'] == '/spectate':
+        result = await spectate(scope, receive, send)
+        if result is None:
+            return
+        payload, status = result
+    elif scope['path'] == '/admin/export':
+        result = await admin_export(scope, receive, send)
+        if result is None:
+            return
+        payload, status = result
+    elif scope['path'] == '/admin/profile':
+        payload, status = await admin_profile(scope)
+    elif scope['path'].startswith('/admin/history/'):
+        payload, status = admin_history(scope)
+    elif scope['path'] == '/api/fixes' and scope['method'] == 'POST':
+        payload, status = await post_fixes(scope, receive)
+    else:
+        payload, status = http_api(scope['path'], scope.get('query_string', b''))
+    if isinstance(payload, str):
+        body, content_type = payload.encode(), b'text/plain; charset=utf-8'
+    else:
+        body, content_type = json.dumps(payload).encode(), b'application/json'
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', content_type),
+        (b'content-length', str(len(body)).encode()),
+        (b'access-control-allow-origin', b'*')
+    ]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def shutdown():
+    # uvicorn re-raises SIGTERM after a graceful shutdown, so atexit never runs
+    registry.close()
+    if registry.analytics is not None:
+        registry.analytics.close()
+    chunk = logger.drain()
+    if chunk:
+        logs.write(chunk)
+
+
+app = socketio.ASGIApp(sio, other_asgi_app=http_app, static_files=PAGES, on_shutdown=shutdown)
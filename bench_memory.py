@@ -0,0 +1,248 @@
+"""Memory cost per connected runner, crew and active emergency.
+
+Starts the eventlet server in a subprocess with tracemalloc on, connects
+real Socket.IO clients in phases (runners, then crews, then emergencies
+raised by some of the runners), and diffs tracemalloc snapshots taken in the
+server after each phase. The figures therefore include the Engine.IO
+session, the socket's buffers and everything the race keeps per
+participant. Emergencies are alerted to every crew, so their cost grows
+with the crew count.
+
+    python bench_memory.py --scales 100,250,500
+    python bench_memory.py --save bench_memory_baseline.json
+    python bench_memory.py --baseline bench_memory_baseline.json
+    python bench_memory.py --limit-mb 512
+
+With --baseline, exits 1 if any per-participant figure grew by more than
+--tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import sysconfig
+
+START = (22.37538, 114.18007)
+KINDS = ('runner', 'crew', 'emergency')
+REPLY = 'bench_memory: '
+
+
+def serve(port):
+    # Server side: take snapshots when the benchmark asks for them on stdin.
+    # Tracing starts after the import: only growth is measured, and
+    # rasterising the corridors under tracemalloc takes minutes.
+    import app
+    from eventlet import tpool
+    import gc
+    import linecache
+    import tracemalloc
+    tracemalloc.start(8)
+    # Source lines cached for stall and profiler stacks aren't per participant
+    ignore = [tracemalloc.Filter(False, linecache.__file__), tracemalloc.Filter(False, tracemalloc.__file__)]
+
+    snapshots = {}
+
+    def control():
+        while True:
+            line = tpool.execute(sys.stdin.readline)
+            if not line:
+                os._exit(0)
+            command = line.split()
+            if command[0] == 'snapshot':
+                # Let a tick or two apply the phase's fixes first
+                app.socketio.sleep(2.5)
+                gc.collect()
+                snapshots[command[1]] = tracemalloc.take_snapshot().filter_traces(ignore)
+                event = app.registry.get(app.DEFAULT_EVENT)
+                reply = {'users': len(event.users), 'crews': len(event.crews),
+                         'emergencies': len(event.emergencies), 'rss_mb': rss_mb(os.getpid())}
+            elif command[0] == 'diff':
+                stats = snapshots[command[2]].compare_to(snapshots[command[1]], 'lineno')
+                reply = {
+                    'bytes': sum(stat.size_diff for stat in stats),
+                    'top': [{'where': short(str(stat.traceback[0])), 'bytes': stat.size_diff, 'blocks': stat.count_diff}
+                            for stat in stats[:8] if stat.size_diff]
+                }
+            # stdout carries the server's own logs
+            sys.stderr.write(REPLY + json.dumps(reply) + '\n')
+            sys.stderr.flush()
+
+    app.start_tick()
+    app.socketio.start_background_task(control)
+    app.socketio.run(app.app, host='127.0.0.1', port=port, log_output=False)
+
+
+def short(where):
+    # Allocation sites relative to site-packages, the stdlib or the repo
+    paths = sysconfig.get_paths()
+    for prefix in (paths['purelib'], paths['stdlib'], os.path.dirname(os.path.abspath(__file__))):
+        if where.startswith(prefix + os.sep):
+            return where[len(prefix) + 1:]
+    return where
+
+
+def rss_mb(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        return None
+
+
+class Server(object):
+
+    def __init__(self, port):
+        env = dict(os.environ, ANALYTICS_WORKERS='0')
+        self.process = subprocess.Popen([sys.executable, __file__, '--serve', '--port', str(port)],
+                                        stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE, env=env,
+                                        cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def ask(self, *command):
+        self.process.stdin.write((' '.join(command) + '\n').encode())
+        self.process.stdin.flush()
+        while True:
+            line = self.process.stderr.readline().decode()
+            if not line:
+                raise RuntimeError('server exited')
+            if line.startswith(REPLY):
+                return json.loads(line[len(REPLY):])
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+async def connect(url, count):
+    import socketio
+    clients = []
+    for _ in range(count):
+        client = socketio.AsyncClient(reconnection=False)
+        await client.connect(url, transports=['websocket'], wait_timeout=30)
+        clients.append(client)
+    return clients
+
+
+def jitter():
+    return [START[0] + random.uniform(-0.005, 0.005), START[1] + random.uniform(-0.005, 0.005)]
+
+
+async def measure(port, runners, crews, emergencies):
+    import bench_servers
+    server = Server(port)
+    loop = asyncio.get_running_loop()
+    url = 'http://127.0.0.1:%d' % port
+    try:
+        if not await loop.run_in_executor(None, bench_servers.wait_ready, port):
+            raise RuntimeError('server did not start')
+        ask = lambda *command: loop.run_in_executor(None, server.ask, *command)
+        # A throwaway client first, so one-off costs of the first connection
+        # don't land on the runners
+        warm = await connect(url, 1)
+        await warm[0].disconnect()
+        counts = {'base': await ask('snapshot', 'base')}
+
+        runner_clients = await connect(url, runners)
+        for i, client in enumerate(runner_clients):
+            lat, lng = jitter()
+            await client.emit('runner_location', {'lat': lat, 'lng': lng, 'route': '10k', 'bib': str(i), 'accuracy': 10})
+        counts['runner'] = await ask('snapshot', 'runner')
+
+        crew_clients = await connect(url, crews)
+        for client in crew_clients:
+            lat, lng = jitter()
+            await client.emit('map_view', {'zoom': 14, 'bounds': None})
+            await client.emit('crew_location', {'lat': lat, 'lng': lng, 'transport': 'bike', 'first_aid': True})
+        counts['crew'] = await ask('snapshot', 'crew')
+
+        for client in runner_clients[:emergencies]:
+            await client.emit('emergency_request', {'location': jitter(), 'sent_at': 0})
+        counts['emergency'] = await ask('snapshot', 'emergency')
+
+        result = {'counts': counts}
+        previous = 'base'
+        for kind, count in (('runner', runners), ('crew', crews), ('emergency', emergencies)):
+            diff = await ask('diff', previous, kind)
+            result[kind] = {'bytes_each': diff['bytes'] // max(count, 1), 'top': diff['top']}
+            previous = kind
+        for client in runner_clients + crew_clients:
+            await client.disconnect()
+        return result
+    finally:
+        server.close()
+
+
+def report(scale, result, limit_mb=None):
+    counts = result['counts']
+    print('== %d runners, %d crews, %d emergencies (server RSS %.1f MB -> %.1f MB)' % (
+        counts['runner']['users'], counts['crew']['crews'], counts['emergency']['emergencies'],
+        counts['base']['rss_mb'] or 0, counts['emergency']['rss_mb'] or 0))
+    for kind in KINDS:
+        print('  %-9s %8d bytes each' % (kind, result[kind]['bytes_each']))
+        for top in result[kind]['top'][:5]:
+            print('      %+10d B %6d blocks  %s' % (top['bytes'], top['blocks'], top['where']))
+    if limit_mb and counts['base']['rss_mb']:
+        # tracemalloc undercounts RSS (allocator overhead, C buffers), so
+        # project from RSS growth where it is larger
+        rss_each = (counts['runner']['rss_mb'] - counts['base']['rss_mb']) * 1024 * 1024 / max(scale, 1)
+        each = max(result['runner']['bytes_each'], rss_each)
+        print('  ceiling at %d MB: ~%d runners' % (limit_mb, (limit_mb - counts['base']['rss_mb']) * 1024 * 1024 / each))
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for scale, result in results.items():
+        saved = baseline.get(scale)
+        if saved is None:
+            continue
+        for kind in KINDS:
+            old, new = saved[kind], result[kind]['bytes_each']
+            if old > 0 and new > old * (1 + tolerance):
+                found.append('%s at %s: %d -> %d bytes each' % (kind, scale, old, new))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scales', default='100,250,500', help='runner counts to measure')
+    parser.add_argument('--crews', type=int, default=50)
+    parser.add_argument('--emergencies', type=int, default=50)
+    parser.add_argument('--port', type=int, default=5065)
+    parser.add_argument('--save', help='write per-participant bytes to this baseline file')
+    parser.add_argument('--baseline', help='compare against this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    parser.add_argument('--limit-mb', type=int, help='container memory limit, to project a runner ceiling')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port)
+        return
+
+    results = {}
+    for scale in [int(s) for s in args.scales.split(',')]:
+        result = asyncio.run(measure(args.port, scale, args.crews, min(args.emergencies, scale)))
+        results[str(scale)] = result
+        report(scale, result, args.limit_mb)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({scale: {kind: result[kind]['bytes_each'] for kind in KINDS}
+                       for scale, result in results.items()}, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print('REGRESSION', line)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
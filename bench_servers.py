@@ -0,0 +1,129 @@
+"""Compare the eventlet and asyncio server modes under simulated load.
+
+Starts each mode in a subprocess, connects simulated runners and crews with
+python-socketio's AsyncClient (needs aiohttp), has every runner report a fix
+per second, and reports connect time, messages delivered to crews per
+second and the server's resident memory.
+
+    python bench_servers.py --runners 500 --crews 20 --seconds 30
+"""
+import argparse
+import asyncio
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+
+import socketio
+
+MODES = {
+    'eventlet': [sys.executable, '-c',
+                 'import app; app.socketio.run(app.app, host="127.0.0.1", port=%d, log_output=False)'],
+    'asyncio': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', '%d',
+                '--log-level', 'warning']
+}
+
+START = (22.37538, 114.18007)
+
+
+def rss_mb(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        return None
+
+
+def wait_ready(port, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen('http://127.0.0.1:%d/api/alert-latency' % port, timeout=1)
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+async def connect(url, count, received):
+    clients = []
+    for i in range(count):
+        client = socketio.AsyncClient(reconnection=False)
+        client.on('*', lambda event, data=None: received.__setitem__(0, received[0] + 1))
+        await client.connect(url, transports=['websocket'])
+        clients.append(client)
+    return clients
+
+
+async def run_load(port, runners, crews, seconds):
+    url = 'http://127.0.0.1:%d' % port
+    received = [0]
+    started = time.time()
+    crew_clients = await connect(url, crews, received)
+    runner_clients = await connect(url, runners, [0])
+    connect_seconds = time.time() - started
+
+    positions = [[START[0] + random.uniform(-0.01, 0.01), START[1] + random.uniform(-0.01, 0.01)]
+                 for _ in runner_clients]
+    for i, client in enumerate(crew_clients):
+        await client.emit('crew_location', {'lat': START[0], 'lng': START[1], 'name': 'Crew %d' % i})
+    # Crews zoomed in past the cluster zoom get every runner_update
+    for client in crew_clients:
+        await client.emit('map_view', {'zoom': 18, 'bounds': [22.0, 114.0, 23.0, 115.0]})
+
+    received[0] = 0
+    sent = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        tick = time.time()
+        for i, client in enumerate(runner_clients):
+            position = positions[i]
+            position[0] += random.uniform(-0.00002, 0.00002)
+            position[1] += random.uniform(-0.00002, 0.00002)
+            await client.emit('runner_location', {'lat': position[0], 'lng': position[1], 'name': 'Runner %d' % i,
+                                                  'route': '10k', 'accuracy': 10})
+            sent += 1
+        await asyncio.sleep(max(0, 1 - (time.time() - tick)))
+
+    for client in crew_clients + runner_clients:
+        await client.disconnect()
+    return {'connect_seconds': connect_seconds, 'sent_per_second': sent / float(seconds),
+            'crew_messages_per_second': received[0] / float(seconds)}
+
+
+def bench(mode, port, runners, crews, seconds):
+    command = [part % port if '%d' in part else part for part in MODES[mode]]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        if not wait_ready(port):
+            return {'error': 'server did not start'}
+        idle = rss_mb(server.pid)
+        result = asyncio.run(run_load(port, runners, crews, seconds))
+        result['rss_idle_mb'] = idle
+        result['rss_loaded_mb'] = rss_mb(server.pid)
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runners', type=int, default=200)
+    parser.add_argument('--crews', type=int, default=10)
+    parser.add_argument('--seconds', type=int, default=20)
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--mode', choices=sorted(MODES), action='append')
+    args = parser.parse_args()
+
+    for mode in args.mode or sorted(MODES):
+        result = bench(mode, args.port, args.runners, args.crews, args.seconds)
+        print(mode, ' '.join('%s=%s' % (key, round(value, 2) if isinstance(value, float) else value)
+                             for key, value in sorted(result.items())))
+
+
+if __name__ == '__main__':
+    main()
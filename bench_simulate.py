@@ -0,0 +1,513 @@
+"""Deterministic race simulation against the core, with no network.
+
+Drives EventRegistry the way the Socket.IO handlers do (join, handle, leave,
+tick) on a virtual clock, so a whole race runs in seconds to minutes rather
+than an hour. Runners move along the event's real route_points at paces
+drawn from the seed and report at the cadence the server hints; some raise
+emergencies that a crew claims, reaches and resolves. Crews stand along the
+course, watch it zoomed in or out, and send back freshness receipts.
+
+The transport plans deliveries instead of sending them: it tracks room
+membership, so every emit is counted per recipient, and answers acks in
+virtual time. Its own bookkeeping is kept out of the CPU figures.
+
+Reports CPU per tick, per step of a tick (what the hub runs between two
+yields to the handlers) and for the handlers (process time), messages
+planned per recipient by role, and memory. A seed gives the same run every time:
+the digest hashes every planned emit, so it only changes when behaviour
+does, and --save/--baseline compare two commits.
+
+    python bench_simulate.py --runners 2000 --crews 50
+    python bench_simulate.py --runners 10000 --seed 7 --save sim_baseline.json
+    python bench_simulate.py --runners 10000 --seed 7 --baseline sim_baseline.json
+
+With --baseline, exits 1 if tick CPU grew by more than --tolerance.
+"""
+import argparse
+from bisect import bisect_right
+from collections import Counter
+import hashlib
+import heapq
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from courses import DEFAULT_EVENT, load_routes
+from geo import haversine
+from logs import logger
+import history
+import race
+
+# As app.py
+TICK_SECONDS = 1.0
+# Virtual time starts here, so runs don't depend on the date
+EPOCH = 1767254400.0
+
+CONNECT_SECONDS = 60
+START_SPREAD = 300
+PACE = (2.8, 0.5)
+PACE_LIMITS = (1.5, 5.0)
+GPS_NOISE_METERS = 5
+# Pages start at this cadence until the server hints one
+DEFAULT_REPORT_SECONDS = 10
+# Page clocks are off by up to this much, and receipts go back this often
+CLOCK_SKEW = 30.0
+RECEIPT_SECONDS = 10
+# Emergency timings: crew claims, arrives, resolves
+CLAIM_SECONDS = (20, 60)
+ARRIVE_SECONDS = (120, 300)
+RESOLVE_SECONDS = (300, 600)
+FINISHED_SECONDS = 60
+CREW_ZOOMS = (14, 15, 17, 18)
+VIEW_DEGREES = 0.005
+# Events the simulated pages act on; everything else is only counted
+REACTIONS = ('report_interval', 'clock', 'emergency_alert')
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        return None
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+class Course(object):
+    """Positions by distance along a route."""
+
+    def __init__(self, points):
+        self.points = points
+        self.distances = [0.0]
+        for a, b in zip(points, points[1:]):
+            self.distances.append(self.distances[-1] + haversine(a, b))
+        self.length = self.distances[-1]
+
+    def at(self, distance):
+        distance = min(max(distance, 0.0), self.length)
+        i = min(bisect_right(self.distances, distance), len(self.points) - 1)
+        start, end = self.distances[i - 1], self.distances[i]
+        share = (distance - start) / (end - start) if end > start else 0.0
+        a, b = self.points[i - 1], self.points[i]
+        return a[0] + (b[0] - a[0]) * share, a[1] + (b[1] - a[1]) * share
+
+
+class Page(object):
+    """What the simulation knows about one simulated browser."""
+
+    def __init__(self, sid, role, skew):
+        self.sid = sid
+        self.role = role
+        self.skew = skew
+        self.report_seconds = DEFAULT_REPORT_SECONDS
+        self.connected = False
+        self.receipts = []
+
+    def now_ms(self, now):
+        return (now + self.skew) * 1000
+
+
+class PlanningTransport(object):
+    """Counts what would be sent to whom instead of sending it."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.rooms = {}
+        self.pages = {}
+        self.received = Counter()
+        self.events = {}
+        self.messages = 0
+        self.bytes = 0
+        self.cpu = 0.0
+        # Time spent in server callbacks, which isn't the transport's
+        self.served = 0.0
+        self.digest = hashlib.sha1()
+        self.tick = 0
+
+    def enter_room(self, sid, room):
+        self.rooms.setdefault(room, set()).add(sid)
+
+    def leave_room(self, sid, room):
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(sid)
+
+    def drop(self, sid):
+        for members in self.rooms.values():
+            members.discard(sid)
+
+    def backlog(self, sid):
+        return 0 if sid in self.pages and self.pages[sid].connected else None
+
+    def drop_queued(self, sid, events):
+        # Nothing is ever queued here
+        pass
+
+    def emit(self, event, payload, to=None, skip_sid=None, callback=None):
+        started = time.process_time()
+        members = self.rooms.get(to)
+        if members is None:
+            page = self.pages.get(to)
+            recipients = [to] if page is not None and page.connected else []
+        else:
+            recipients = [sid for sid in members if sid != skip_sid]
+        size = len(json.dumps(payload, default=str))
+        self.messages += len(recipients)
+        self.bytes += size * len(recipients)
+        counts = self.events.setdefault(event, [0, 0])
+        counts[0] += len(recipients)
+        counts[1] += size * len(recipients)
+        self.digest.update(('%d %s %d %d\n' % (self.tick, event, len(recipients), size)).encode())
+        self.received.update(recipients)
+        # The pages' reactions are part of what is being simulated, but only
+        # the acks they call back into the server count as server time
+        served = self.served
+        if event in REACTIONS or (isinstance(payload, dict) and 'stamps' in payload):
+            pages = self.pages
+            for sid in recipients:
+                self.deliver(pages[sid], event, payload, callback)
+        self.cpu += time.process_time() - started - (self.served - served)
+
+    def deliver(self, page, event, payload, callback):
+        now = self.clock()
+        if event == 'report_interval':
+            page.report_seconds = payload['seconds']
+        elif event == 'clock' and callback is not None:
+            self.call(callback, page.now_ms(now))
+        elif event == 'emergency_alert' and callback is not None:
+            self.call(callback, {'received_at': page.now_ms(now)})
+        elif page.role == 'crew' and isinstance(payload, dict) and 'stamps' in payload:
+            page.receipts.append([payload['stamps'], page.now_ms(now)])
+
+    def call(self, callback, data):
+        started = time.process_time()
+        callback(data)
+        self.served += time.process_time() - started
+
+
+class Simulation(object):
+
+    def __init__(self, runners, crews, emergencies, seed, route, event_id=DEFAULT_EVENT):
+        self.rng = random.Random(seed)
+        self.now = EPOCH
+        self.transport = PlanningTransport(lambda: self.now)
+        self.registry = race.EventRegistry(self.transport, load_routes, pinned=[event_id], clock=lambda: self.now)
+        self.event_id = event_id
+        routes = load_routes(event_id)
+        self.route = route if route in routes else next(iter(routes))
+        self.course = Course(routes[self.route])
+        self.queue = []
+        self.seq = 0
+        self.runners = {}
+        self.handler_cpu = 0.0
+        self.handled = 0
+        self.errors = 0
+        self.ticks = []
+        self.steps = []
+        self.active = 0
+
+        rng = self.rng
+        for i in range(crews):
+            sid = 'c%04d' % i
+            # Spread evenly along the course, each with its own view of it
+            location = self.course.at(self.course.length * (i + 0.5) / max(crews, 1))
+            page = self.add_page(sid, 'crew')
+            page.location = location
+            page.zoom = rng.choice(CREW_ZOOMS)
+            self.schedule(rng.uniform(0, CONNECT_SECONDS), 'connect', page)
+        emergency_runners = set(rng.sample(range(runners), min(emergencies, runners)))
+        for i in range(runners):
+            page = self.add_page('r%05d' % i, 'runner')
+            page.bib = str(1000 + i)
+            page.start = CONNECT_SECONDS + rng.uniform(0, START_SPREAD)
+            page.pace = min(max(rng.gauss(*PACE), PACE_LIMITS[0]), PACE_LIMITS[1])
+            page.stopped = None
+            page.finished = False
+            page.emergency_at = None
+            if i in emergency_runners:
+                page.emergency_at = page.start + rng.uniform(0.1, 0.9) * self.course.length / page.pace
+            self.runners[page.sid] = page
+            self.schedule(rng.uniform(0, CONNECT_SECONDS), 'connect', page)
+        self.crews = [page for page in self.transport.pages.values() if page.role == 'crew']
+
+    def add_page(self, sid, role):
+        page = self.transport.pages[sid] = Page(sid, role, self.rng.uniform(-CLOCK_SKEW, CLOCK_SKEW))
+        return page
+
+    def schedule(self, offset, action, page, data=None):
+        self.seq += 1
+        heapq.heappush(self.queue, (EPOCH + offset, self.seq, action, page, data))
+
+    def handle(self, sid, name, data=None):
+        started = time.process_time()
+        self.registry.handle(sid, name, data)
+        self.handled += 1
+        self.handler_cpu += time.process_time() - started
+
+    def jitter(self, location):
+        rng = self.rng
+        # Metres to degrees, near enough at race scale
+        return [location[0] + rng.gauss(0, GPS_NOISE_METERS) / 111320.0,
+                location[1] + rng.gauss(0, GPS_NOISE_METERS) / 111320.0]
+
+    def runner_location(self, page, elapsed):
+        if page.stopped is not None:
+            return page.stopped
+        return self.course.at((elapsed - page.start) * page.pace) if elapsed > page.start else self.course.at(0)
+
+    def act(self, action, page, data):
+        rng = self.rng
+        elapsed = self.now - EPOCH
+        if action == 'connect':
+            started = time.process_time()
+            self.registry.join(page.sid, self.event_id)
+            self.handler_cpu += time.process_time() - started
+            page.connected = True
+            self.active += 1
+            self.handle(page.sid, 'get_initial_data')
+            if page.role == 'crew':
+                lat, lng = page.location
+                bounds = [lat - VIEW_DEGREES, lng - VIEW_DEGREES, lat + VIEW_DEGREES, lng + VIEW_DEGREES]
+                self.handle(page.sid, 'map_view', {'zoom': page.zoom, 'bounds': bounds})
+                self.schedule(elapsed + RECEIPT_SECONDS, 'receipts', page)
+            self.schedule(elapsed + rng.uniform(0, 1), 'report', page)
+        elif action == 'disconnect':
+            started = time.process_time()
+            self.registry.leave(page.sid)
+            self.handler_cpu += time.process_time() - started
+            page.connected = False
+            self.transport.drop(page.sid)
+            self.active -= 1
+        elif action == 'report' and page.connected:
+            now_ms = page.now_ms(self.now)
+            if page.role == 'crew':
+                lat, lng = self.jitter(page.location)
+                self.handle(page.sid, 'crew_location', {
+                    'lat': lat, 'lng': lng, 'accuracy': 10, 'transport': 'bike', 'first_aid': True,
+                    'sharing': True, 'gps_at': now_ms - rng.uniform(0, 1000), 'sent_at': now_ms
+                })
+            else:
+                location = self.runner_location(page, elapsed)
+                lat, lng = self.jitter(location)
+                self.handle(page.sid, 'runner_location', {
+                    'lat': lat, 'lng': lng, 'accuracy': 10, 'route': self.route, 'bib': page.bib,
+                    'emergency': page.stopped is not None, 'gps_at': now_ms - rng.uniform(0, 1000), 'sent_at': now_ms
+                })
+                if page.emergency_at is not None and elapsed >= page.emergency_at and page.stopped is None:
+                    self.raise_emergency(page, location, elapsed)
+                if (not page.finished and page.stopped is None and elapsed > page.start
+                        and (elapsed - page.start) * page.pace >= self.course.length):
+                    page.finished = True
+                    self.schedule(elapsed + FINISHED_SECONDS, 'disconnect', page)
+            self.schedule(elapsed + page.report_seconds, 'report', page)
+        elif action == 'receipts' and page.connected:
+            if page.receipts:
+                self.handle(page.sid, 'freshness', {'receipts': page.receipts})
+                page.receipts = []
+            self.schedule(elapsed + RECEIPT_SECONDS, 'receipts', page)
+        elif action in ('emergency_claim', 'emergency_on_scene', 'emergency_resolved') and page.connected:
+            self.handle(page.sid, action, data)
+
+    def raise_emergency(self, page, location, elapsed):
+        rng = self.rng
+        page.stopped = location
+        self.handle(page.sid, 'emergency_request', {'location': list(location), 'sent_at': page.now_ms(self.now)})
+        crews = [crew for crew in self.crews if crew.connected]
+        if not crews:
+            return
+        crew = min(crews, key=lambda crew: haversine(crew.location, location))
+        claim = elapsed + rng.uniform(*CLAIM_SECONDS)
+        arrive = claim + rng.uniform(*ARRIVE_SECONDS)
+        resolve = arrive + rng.uniform(*RESOLVE_SECONDS)
+        self.schedule(claim, 'emergency_claim', crew, {'id': page.sid})
+        self.schedule(arrive, 'emergency_on_scene', crew, {'id': page.sid})
+        self.schedule(resolve, 'emergency_resolved', crew, {'id': page.sid})
+        # The runner is taken off the course once it's dealt with
+        self.schedule(resolve + 1, 'disconnect', page)
+
+    def run(self, limit=None):
+        end = EPOCH + (limit if limit is not None else CONNECT_SECONDS + START_SPREAD
+                       + self.course.length / PACE_LIMITS[0] + FINISHED_SECONDS + 120)
+        tick_at = EPOCH + TICK_SECONDS
+        queue = self.queue
+        while tick_at <= end:
+            while queue and queue[0][0] < tick_at:
+                when, _, action, page, data = heapq.heappop(queue)
+                self.now = when
+                self.act(action, page, data)
+            self.now = tick_at
+            self.transport.tick += 1
+            transport_cpu = self.transport.cpu
+            started = time.process_time()
+            # The longest the tick holds the hub between two yields
+            step, step_transport, longest = started, transport_cpu, 0.0
+            for _ in self.registry.tick(tick_at):
+                now = time.process_time()
+                longest = max(longest, now - step - (self.transport.cpu - step_transport))
+                step, step_transport = now, self.transport.cpu
+            cpu = time.process_time() - started - (self.transport.cpu - transport_cpu)
+            self.ticks.append((tick_at - EPOCH, cpu, self.active))
+            self.steps.append(longest)
+            self.errors += sum(1 for line in logger.drain().splitlines() if '"level": "error"' in line)
+            tick_at += TICK_SECONDS
+            if not queue and not self.active:
+                break
+
+    def close(self):
+        self.registry.close()
+
+
+def summary(sim, wall, rss_before, traced_peak):
+    transport = sim.transport
+    costs = [cpu for _, cpu, _ in sim.ticks]
+    busy = [cpu for _, cpu, active in sim.ticks if active]
+    received = {'runner': [], 'crew': []}
+    for sid, page in transport.pages.items():
+        received[page.role].append(transport.received.get(sid, 0))
+    race_seconds = sim.ticks[-1][0] if sim.ticks else 0
+    rss_after = rss_mb()
+    return {
+        'digest': transport.digest.hexdigest(),
+        'virtual_seconds': race_seconds,
+        'wall_seconds': round(wall, 2),
+        'ticks': len(costs),
+        'tick_cpu_ms': {
+            'p50': round(percentile(busy, 0.5) * 1000, 3) if busy else None,
+            'p99': round(percentile(busy, 0.99) * 1000, 3) if busy else None,
+            'max': round(max(costs) * 1000, 3) if costs else None,
+            'total': round(sum(costs) * 1000, 1)
+        },
+        'tick_step_ms': {
+            'p99': round(percentile(sim.steps, 0.99) * 1000, 3) if sim.steps else None,
+            'max': round(max(sim.steps) * 1000, 3) if sim.steps else None
+        },
+        'handlers': {
+            'calls': sim.handled,
+            'cpu_ms': round(sim.handler_cpu * 1000, 1),
+            'us_each': round(sim.handler_cpu / sim.handled * 1e6, 2) if sim.handled else None
+        },
+        'messages': {
+            'total': transport.messages,
+            'bytes': transport.bytes,
+            'by_event': dict((event, counts[0]) for event, counts in sorted(transport.events.items())),
+            'per_recipient': dict((role, {
+                'recipients': len(counts),
+                'mean': round(sum(counts) / float(len(counts)), 1) if counts else None,
+                'p50': percentile(counts, 0.5),
+                'p99': percentile(counts, 0.99),
+                'max': max(counts) if counts else None,
+                'per_second': round(sum(counts) / float(len(counts)) / race_seconds, 3) if counts and race_seconds else None
+            }) for role, counts in received.items())
+        },
+        'memory_mb': {
+            'rss_before': round(rss_before, 1) if rss_before else None,
+            'rss_after': round(rss_after, 1) if rss_after else None,
+            'rss_peak': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+            'traced_peak': round(traced_peak / 1048576.0, 1) if traced_peak is not None else None
+        },
+        'errors': sim.errors
+    }
+
+
+def report(args, result):
+    print('== %d runners, %d crews, %d emergencies, seed %d: %ds of race in %.1fs' % (
+        args.runners, args.crews, args.emergencies, args.seed, result['virtual_seconds'], result['wall_seconds']))
+    ticks = result['tick_cpu_ms']
+    print('  tick cpu      p50 %s ms  p99 %s ms  max %s ms  (%d ticks)' % (
+        ticks['p50'], ticks['p99'], ticks['max'], result['ticks']))
+    steps = result['tick_step_ms']
+    print('  longest step  p99 %s ms  max %s ms' % (steps['p99'], steps['max']))
+    handlers = result['handlers']
+    print('  handlers      %d calls, %s us each' % (handlers['calls'], handlers['us_each']))
+    messages = result['messages']
+    print('  messages      %d planned, %.1f MB' % (messages['total'], messages['bytes'] / 1048576.0))
+    for role, stats in sorted(messages['per_recipient'].items()):
+        print('    per %-6s  mean %s  p50 %s  p99 %s  max %s  (%s/s)' % (
+            role, stats['mean'], stats['p50'], stats['p99'], stats['max'], stats['per_second']))
+    for event, count in sorted(messages['by_event'].items(), key=lambda item: -item[1])[:8]:
+        print('    %-26s %10d' % (event, count))
+    memory = result['memory_mb']
+    print('  memory        rss %s -> %s MB, peak %s MB, traced peak %s MB' % (
+        memory['rss_before'], memory['rss_after'], memory['rss_peak'], memory['traced_peak']))
+    if result['errors']:
+        print('  ERRORS        %d logged' % result['errors'])
+    print('  digest        %s' % result['digest'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runners', type=int, default=2000)
+    parser.add_argument('--crews', type=int, default=50)
+    parser.add_argument('--emergencies', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--route', default=race.DEFAULT_ROUTE)
+    parser.add_argument('--seconds', type=float, help='stop after this much race time')
+    parser.add_argument('--trace-memory', action='store_true', help='tracemalloc peak too (several times slower)')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare against results saved with --save')
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    args = parser.parse_args()
+
+    if os.environ.get('PYTHONHASHSEED') != '0':
+        # Set iteration order decides the order of emits, and so the digest
+        os.execve(sys.executable, [sys.executable] + sys.argv, dict(os.environ, PYTHONHASHSEED='0'))
+
+    directory = tempfile.mkdtemp(prefix='bench_simulate')
+    history.HISTORY_DIR = directory
+    rss_before = rss_mb()
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.time()
+    sim = Simulation(args.runners, args.crews, args.emergencies, args.seed, args.route)
+    try:
+        sim.run(args.seconds)
+        sim.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+    result = summary(sim, time.time() - started, rss_before, traced_peak)
+    result['args'] = {'runners': args.runners, 'crews': args.crews, 'emergencies': args.emergencies,
+                      'seed': args.seed, 'route': sim.route, 'seconds': args.seconds}
+    report(args, result)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('args') != result['args']:
+            print('NOTE baseline was run with %s' % baseline.get('args'))
+        elif baseline['digest'] != result['digest']:
+            print('NOTE planned messages differ from the baseline')
+        found = []
+        for name in ('p50', 'p99'):
+            old, new = baseline['tick_cpu_ms'][name], result['tick_cpu_ms'][name]
+            if old and new and new > old * (1 + args.tolerance):
+                found.append('tick cpu %s: %.3f -> %.3f ms' % (name, old, new))
+        old, new = baseline['handlers']['us_each'], result['handlers']['us_each']
+        if old and new and new > old * (1 + args.tolerance):
+            found.append('handler cpu: %.2f -> %.2f us each' % (old, new))
+        for line in found:
+            print('REGRESSION', line)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""How often each page should send its GPS position.
+
+The server hints an interval per participant and the pages send at that
+cadence instead of a fixed one. Runners with an emergency, and crews
+working an incident, report fastest; runners and crews that no other crew
+is looking at individually, and anyone barely moving, report slower. Everything except emergencies stretches with hub lag, so a
+saturated server cuts inbound traffic at the source.
+
+Intervals are rounded up to a few STEPS so hints rarely change and are only
+sent when they do.
+"""
+STEPS = (2, 5, 10, 15, 20, 30, 45, 60)
+
+EMERGENCY_SECONDS = 2
+VISIBLE_SECONDS = 5
+HIDDEN_SECONDS = 15
+# Slower than this (m/s, filtered) doubles the interval
+SLOW_SPEED = 0.5
+
+# Hub lag where intervals start to stretch, and where they reach MAX_STRETCH
+LAG_LOW = 0.05
+LAG_HIGH = 0.5
+MAX_STRETCH = 4.0
+
+
+def stretch(lag):
+    if lag <= LAG_LOW:
+        return 1.0
+    share = min((lag - LAG_LOW) / (LAG_HIGH - LAG_LOW), 1.0)
+    return 1.0 + (MAX_STRETCH - 1.0) * share
+
+
+def step(seconds):
+    for candidate in STEPS:
+        if candidate >= seconds:
+            return candidate
+    return STEPS[-1]
+
+
+def interval(emergency, visible, speed, lag=0.0):
+    """Seconds between reports. speed is None before the first filtered fix."""
+    if emergency:
+        return EMERGENCY_SECONDS
+    seconds = VISIBLE_SECONDS if visible else HIDDEN_SECONDS
+    if speed is not None and speed < SLOW_SPEED:
+        seconds *= 2
+    return step(seconds * stretch(lag))
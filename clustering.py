@@ -0,0 +1,215 @@
+"""Hierarchical grid clustering of participant positions for the crew maps.
+
+Positions are projected to Web Mercator and bucketed into one grid per zoom
+level. Cell sizes halve with every zoom so a cell at zoom z is exactly the
+parent of four cells at zoom z + 1, the same nesting supercluster uses.
+Each cell keeps running coordinate sums and a member set, so moving a point
+only touches one cell per level instead of rebuilding the index.
+"""
+import math
+
+# Cells are 2**-(zoom + CELL_BITS) of the world wide, i.e. 64px at 256px tiles
+CELL_BITS = 2
+
+
+def project(lat, lng):
+    """Project lat/lng to Web Mercator coordinates in the [0, 1) range."""
+    x = (lng + 180.0) / 360.0
+    s = math.sin(math.radians(max(min(lat, 85.0511), -85.0511)))
+    y = 0.5 - math.log((1 + s) / (1 - s)) / (4 * math.pi)
+    return x, y
+
+
+def unproject(x, y):
+    lng = x * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y))))
+    return lat, lng
+
+
+class ClusterIndex(object):
+    """Incrementally maintained cluster index over runner and crew markers.
+
+    Handlers call update()/remove() as fixes arrive; those are only queued.
+    flush() applies the queued changes once per tick. Participants with an
+    active emergency are kept out of the cells entirely so they are always
+    returned as individual points, whatever the zoom.
+    """
+
+    def __init__(self, max_zoom=16):
+        self.max_zoom = max_zoom
+        # levels[z] maps (cx, cy) -> [sum_x, sum_y, runners, members]
+        self.levels = [{} for _ in range(max_zoom + 1)]
+        # id -> (lat, lng, x, y, kind, emergency, (cx, cy) at max_zoom, info)
+        self.points = {}
+        self.emergencies = set()
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def update(self, pid, lat, lng, kind, emergency=False, info=None):
+        self.pending[pid] = (lat, lng, kind, bool(emergency), info)
+
+    def remove(self, pid):
+        self.pending[pid] = None
+
+    def set_emergency(self, pid, emergency):
+        if pid in self.pending:
+            fix = self.pending[pid]
+        elif pid in self.points:
+            point = self.points[pid]
+            fix = (point[0], point[1], point[4], point[5], point[7])
+        else:
+            fix = None
+        if fix is not None:
+            self.pending[pid] = fix[:3] + (bool(emergency), fix[4])
+
+    def flush(self):
+        """Apply queued updates. Returns the number of points changed."""
+        pending, self.pending = self.pending, {}
+        scale = 1 << (self.max_zoom + CELL_BITS)
+        for pid, fix in pending.items():
+            old = self.points.pop(pid, None)
+            if fix is None:
+                if old is not None and not old[5]:
+                    self._unlink(pid, old)
+                self.emergencies.discard(pid)
+                continue
+            lat, lng, kind, emergency, info = fix
+            x, y = project(lat, lng)
+            key = (int(x * scale), int(y * scale))
+            point = (lat, lng, x, y, kind, emergency, key, info)
+            self.points[pid] = point
+            if old is not None and not old[5] and not emergency and old[4] == kind:
+                self._move(pid, old, point)
+                continue
+            if old is not None and not old[5]:
+                self._unlink(pid, old)
+            self.emergencies.discard(pid)
+            if emergency:
+                self.emergencies.add(pid)
+            else:
+                self._link(pid, point)
+        return len(pending)
+
+    def _move(self, pid, old, point):
+        # Keys nest, so once old and new share a cell they share every
+        # coarser one too and only the coordinate sums need adjusting
+        dx = point[2] - old[2]
+        dy = point[3] - old[3]
+        runner = 1 if point[4] == 'runner' else 0
+        (ox, oy), (nx, ny) = old[6], point[6]
+        for zoom in range(self.max_zoom, -1, -1):
+            level = self.levels[zoom]
+            if ox == nx and oy == ny:
+                cell = level[(nx, ny)]
+                cell[0] += dx
+                cell[1] += dy
+            else:
+                cell = level[(ox, oy)]
+                cell[3].discard(pid)
+                if not cell[3]:
+                    del level[(ox, oy)]
+                else:
+                    cell[0] -= old[2]
+                    cell[1] -= old[3]
+                    cell[2] -= runner
+                cell = level.get((nx, ny))
+                if cell is None:
+                    cell = level[(nx, ny)] = [0.0, 0.0, 0, set()]
+                cell[0] += point[2]
+                cell[1] += point[3]
+                cell[2] += runner
+                cell[3].add(pid)
+            ox >>= 1
+            oy >>= 1
+            nx >>= 1
+            ny >>= 1
+
+    def _link(self, pid, point):
+        x, y, kind, (cx, cy) = point[2], point[3], point[4], point[6]
+        runner = 1 if kind == 'runner' else 0
+        for zoom in range(self.max_zoom, -1, -1):
+            cell = self.levels[zoom].get((cx, cy))
+            if cell is None:
+                cell = self.levels[zoom][(cx, cy)] = [0.0, 0.0, 0, set()]
+            cell[0] += x
+            cell[1] += y
+            cell[2] += runner
+            cell[3].add(pid)
+            cx >>= 1
+            cy >>= 1
+
+    def _unlink(self, pid, point):
+        x, y, kind, (cx, cy) = point[2], point[3], point[4], point[6]
+        runner = 1 if kind == 'runner' else 0
+        for zoom in range(self.max_zoom, -1, -1):
+            level = self.levels[zoom]
+            cell = level[(cx, cy)]
+            cell[3].discard(pid)
+            if not cell[3]:
+                del level[(cx, cy)]
+            else:
+                cell[0] -= x
+                cell[1] -= y
+                cell[2] -= runner
+            cx >>= 1
+            cy >>= 1
+
+    def _point(self, pid):
+        lat, lng, _, _, kind, emergency, _, info = self.points[pid]
+        point = {'id': pid, 'type': kind, 'location': [lat, lng], 'emergency': emergency}
+        if info:
+            point.update(info)
+        return point
+
+    def query(self, zoom, bounds=None):
+        """Clusters and individual points visible at zoom within bounds.
+
+        bounds is [south, west, north, east]. Returns None above max_zoom,
+        where clients should show every marker individually instead.
+        """
+        zoom = max(int(zoom), 0)
+        if zoom > self.max_zoom:
+            return None
+        level = self.levels[zoom]
+        scale = 1 << (zoom + CELL_BITS)
+        if bounds:
+            south, west, north, east = bounds
+            x0, y0 = project(north, west)
+            x1, y1 = project(south, east)
+            x0, y0 = int(x0 * scale), int(y0 * scale)
+            x1, y1 = int(x1 * scale), int(y1 * scale)
+        else:
+            x0 = y0 = 0
+            x1 = y1 = scale - 1
+
+        if (x1 - x0 + 1) * (y1 - y0 + 1) < len(level):
+            keys = [(cx, cy) for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1)
+                    if (cx, cy) in level]
+        else:
+            keys = [k for k in level if x0 <= k[0] <= x1 and y0 <= k[1] <= y1]
+
+        clusters = []
+        points = []
+        for key in keys:
+            sx, sy, runners, members = level[key]
+            count = len(members)
+            if count == 1:
+                points.append(self._point(next(iter(members))))
+                continue
+            lat, lng = unproject(sx / count, sy / count)
+            clusters.append({
+                'location': [lat, lng],
+                'count': count,
+                'runners': runners,
+                'crews': count - runners
+            })
+
+        shift = self.max_zoom - zoom
+        for pid in self.emergencies:
+            cx, cy = self.points[pid][6]
+            if x0 <= cx >> shift <= x1 and y0 <= cy >> shift <= y1:
+                points.append(self._point(pid))
+
+        return {'zoom': zoom, 'clusters': clusters, 'points': points}
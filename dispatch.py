@@ -0,0 +1,172 @@
+"""Priority lane for emergency alerts.
+
+Alerts are not batched into the tick with position traffic: they are sent as
+soon as they are raised, one acknowledged emit per crew, and retried to crews
+that have not acknowledged within `retry_seconds`. Every hop is time-stamped
+so the time from the runner pressing SOS to the first crew's ack reaching us
+can be reported, which is the service-level figure we care about.
+
+sos_to_first_crew needs the runner page's send time on our clock, so it only
+counts alerts from pages whose clock offset is known. server_to_first_ack,
+from our receipt of the SOS to that ack, counts every alert but leaves out
+the runner's uplink.
+"""
+from collections import deque
+from functools import partial
+import time
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def summary(latencies):
+    latencies = list(latencies)
+    return {
+        'count': len(latencies),
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'max': max(latencies) if latencies else None
+    }
+
+
+class AlertDispatcher(object):
+
+    def __init__(self, emit, retry_seconds=5.0, max_attempts=4, history=500, clock=time.time):
+        # emit(event, payload, sid, callback) sends one acknowledged message
+        self.emit = emit
+        self.clock = clock
+        self.retry_seconds = retry_seconds
+        self.max_attempts = max_attempts
+        self.queue = deque()
+        self.incidents = {}
+        self.latencies = deque(maxlen=history)
+        self.server_latencies = deque(maxlen=history)
+        self.recent = deque(maxlen=50)
+
+    def raise_alert(self, incident_id, payload, recipients, sos_sent=None):
+        """sos_sent is when the runner's page sent the SOS, in our clock's
+        seconds, or None if the page's clock offset isn't known."""
+        now = self.clock()
+        incident = {
+            'id': incident_id,
+            'payload': payload,
+            'hops': {
+                'sos_sent': sos_sent,
+                'server_received': now,
+                'first_emitted': None,
+                'first_acked': None
+            },
+            'deliveries': {},
+            'settled': False
+        }
+        self.incidents[incident_id] = incident
+        self.recent.append(incident)
+        for sid in recipients:
+            incident['deliveries'][sid] = {'attempts': 0, 'emitted': None, 'acked': None, 'client_received': None}
+            self.queue.append((incident_id, sid))
+        self.drain()
+
+    def drain(self):
+        """Send everything queued. Cheap when the queue is empty."""
+        while self.queue:
+            incident_id, sid = self.queue.popleft()
+            incident = self.incidents.get(incident_id)
+            if incident is None or incident['settled']:
+                continue
+            delivery = incident['deliveries'].get(sid)
+            if delivery is None or delivery['acked']:
+                continue
+            now = self.clock()
+            delivery['attempts'] += 1
+            delivery['emitted'] = now
+            hops = incident['hops']
+            if hops['first_emitted'] is None:
+                hops['first_emitted'] = now
+            payload = dict(incident['payload'], hops={
+                'sos_sent': hops['sos_sent'],
+                'server_received': hops['server_received'],
+                'server_emitted': now,
+                'attempt': delivery['attempts']
+            })
+            self.emit('emergency_alert', payload, sid, partial(self._ack, incident_id, sid))
+
+    def _ack(self, incident_id, sid, receipt=None):
+        incident = self.incidents.get(incident_id)
+        if incident is None or sid not in incident['deliveries']:
+            return
+        delivery = incident['deliveries'][sid]
+        if delivery['acked']:
+            return
+        now = self.clock()
+        delivery['acked'] = now
+        if isinstance(receipt, dict) and receipt.get('received_at'):
+            delivery['client_received'] = receipt['received_at'] / 1000.0
+        hops = incident['hops']
+        if hops['first_acked'] is None:
+            hops['first_acked'] = now
+            hops['first_crew'] = sid
+            self.server_latencies.append(now - hops['server_received'])
+            if hops['sos_sent'] is not None:
+                # An offset estimate can't put the send after our receipt
+                self.latencies.append(now - min(hops['sos_sent'], hops['server_received']))
+
+    def retry(self, now):
+        """Re-queue unacknowledged deliveries that have timed out."""
+        for incident_id, incident in self.incidents.items():
+            if incident['settled']:
+                continue
+            for sid, delivery in incident['deliveries'].items():
+                if (not delivery['acked'] and delivery['emitted']
+                        and delivery['attempts'] < self.max_attempts
+                        and now - delivery['emitted'] >= self.retry_seconds):
+                    delivery['emitted'] = None
+                    self.queue.append((incident_id, sid))
+        self.drain()
+
+    def waiting(self, now):
+        """Crews with an alert they haven't acknowledged that is still being
+        sent, or whose last attempt is still within its retry interval."""
+        crews = set()
+        for incident in self.incidents.values():
+            if incident['settled']:
+                continue
+            for sid, delivery in incident['deliveries'].items():
+                if not delivery['acked'] and (delivery['attempts'] < self.max_attempts or delivery['emitted'] is None
+                                              or now - delivery['emitted'] < self.retry_seconds):
+                    crews.add(sid)
+        return crews
+
+    def settle(self, incident_id):
+        """Stop sending the full alert (e.g. a crew has claimed it) while
+        still recording acknowledgements that are in flight."""
+        incident = self.incidents.get(incident_id)
+        if incident is not None:
+            incident['settled'] = True
+            self.queue = deque(item for item in self.queue if item[0] != incident_id)
+
+    def cancel(self, incident_id):
+        self.incidents.pop(incident_id, None)
+
+    def forget(self, sid):
+        for incident in self.incidents.values():
+            delivery = incident['deliveries'].get(sid)
+            if delivery is not None and not delivery['acked']:
+                del incident['deliveries'][sid]
+
+    def stats(self):
+        return {
+            'sos_to_first_crew': summary(self.latencies),
+            'server_to_first_ack': summary(self.server_latencies),
+            'open_incidents': len(self.incidents),
+            'incidents': [{
+                'id': incident['id'],
+                'hops': incident['hops'],
+                'crews': len(incident['deliveries']),
+                'acked': sum(1 for d in incident['deliveries'].values() if d['acked']),
+                'retries': sum(max(d['attempts'] - 1, 0) for d in incident['deliveries'].values())
+            } for incident in reversed(self.recent)]
+        }
@@ -0,0 +1,312 @@
+"""Post-race export of tracks and emergency timelines.
+
+Reads what history.py has written to disk, so it runs in a process of its
+own at low priority (run by hand, or spawned by /admin/export) and never on
+the hub. Every stage is a generator: fixes come off disk one bucket at a
+time, sorted by time within the bucket, and each format yields encoded
+chunks, so memory stays at about one bucket whatever the race size. During
+a live race the last few minutes are still in the server's memory and are
+left out until they are written. An event's latest run is exported
+unless --run names another (the run directories under HISTORY_DIR/<event>).
+
+    python export.py --format gpx --participant 1234 > 1234.gpx
+    python export.py --event spring --format geojsonseq -o spring.geojsons
+    python export.py --event spring --run 20260412T070000Z --format gpx > 2026.gpx
+    python export.py --format arrow -o fixes.arrows
+
+GPX has one track per participant per bucket, named after the bib, plus a
+waypoint per emergency milestone. GeoJSON text sequences (RFC 8142)
+interleave fixes and timeline entries in time order. Arrow IPC streams
+hold fixes only, and need pyarrow (requirements-export.txt).
+"""
+import argparse
+from datetime import datetime, timezone
+import heapq
+import importlib.util
+import json
+import os
+import sys
+from xml.sax.saxutils import escape
+
+from courses import DEFAULT_EVENT, EVENT_ID
+from geo import LocalProjection
+import history
+
+FORMATS = {
+    'geojsonseq': ('application/geo+json-seq', 'geojsons'),
+    'gpx': ('application/gpx+xml', 'gpx'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+CHUNK_ROWS = 5000
+CHUNK_BYTES = 64 * 1024
+NICE = 10
+
+
+def available(output):
+    return output != 'arrow' or importlib.util.find_spec('pyarrow') is not None
+
+
+def command(event_id, output, participant=None, start=None, end=None, run=None):
+    """argv for an export process writing to stdout."""
+    argv = [sys.executable, os.path.abspath(__file__), '--event', event_id, '--format', output]
+    if run:
+        argv += ['--run', run]
+    if participant:
+        argv.append('--participant=' + participant)
+    if start is not None:
+        argv += ['--from', repr(start)]
+    if end is not None:
+        argv += ['--to', repr(end)]
+    return argv
+
+
+def iso(t):
+    return datetime.fromtimestamp(t, timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+class Export(object):
+    """A race's history on disk, filtered by participant and time."""
+
+    def __init__(self, directory, participant=None, start=None, end=None):
+        self.history = history.History(directory)
+        self.projection = LocalProjection(*self.history.origin) if self.history.origin else None
+        self.start = start
+        self.end = end
+        self.who = None
+        self.ids = None
+        if participant:
+            participant = str(participant)
+            self.who = set(i for i, (pid, _, bib) in enumerate(self.history.table)
+                           if participant in (pid, str(bib)))
+            self.ids = set(self.history.table[i][0] for i in self.who)
+
+    def in_range(self, t):
+        return (self.start is None or t >= self.start) and (self.end is None or t <= self.end)
+
+    def buckets(self):
+        """Each bucket's fixes as a time-ordered list of (t, who, lat, lng)."""
+        hist = self.history
+        for start in sorted(hist.segments):
+            if self.end is not None and start > self.end:
+                break
+            if self.start is not None and start + hist.bucket_seconds <= self.start:
+                continue
+            rows = []
+            for segment in hist.segments[start]:
+                for t, x, y, who in segment.columns():
+                    rows.extend(zip(t, who, x, y))
+            rows.sort()
+            to_latlng = self.projection.to_latlng
+            out = []
+            for t, who, x, y in rows:
+                if (self.who is None or who in self.who) and self.in_range(t):
+                    lat, lng = to_latlng(x, y)
+                    out.append((t, who, lat, lng))
+            if out:
+                yield out
+
+    def fixes(self):
+        for rows in self.buckets():
+            for row in rows:
+                yield row
+
+    def timeline(self):
+        """Emergency milestones in the order they happened. Lines are
+        sorted, as a server's last write can overlap one still in flight."""
+        try:
+            f = open(os.path.join(self.history.directory, 'timeline.jsonl'))
+        except OSError:
+            return
+        entries = []
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+                if self.ids is not None and entry.get('id') not in self.ids and entry.get('crew') not in self.ids:
+                    continue
+                if self.in_range(entry['t']):
+                    entries.append(entry)
+        entries.sort(key=lambda entry: entry['t'])
+        for entry in entries:
+            yield entry
+
+    def describe(self, who):
+        # (id, kind, bib)
+        return self.history.table[who]
+
+
+def chunked(lines):
+    """Join encoded lines into chunks of about CHUNK_BYTES."""
+    parts = []
+    size = 0
+    for line in lines:
+        parts.append(line)
+        size += len(line)
+        if size >= CHUNK_BYTES:
+            yield ''.join(parts)
+            parts = []
+            size = 0
+    if parts:
+        yield ''.join(parts)
+
+
+def geojsonseq(export):
+    def fixes():
+        for seq, (t, who, lat, lng) in enumerate(export.fixes()):
+            yield t, 0, seq, (who, lat, lng)
+
+    def timeline():
+        for seq, entry in enumerate(export.timeline()):
+            yield entry['t'], 1, seq, entry
+
+    def features():
+        for t, source, _, item in heapq.merge(fixes(), timeline()):
+            if source == 0:
+                who, lat, lng = item
+                pid, kind, bib = export.describe(who)
+                feature = {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [lng, lat]},
+                           'properties': {'id': pid, 'type': kind, 'bib': bib, 'time': iso(t)}}
+            else:
+                location = item.get('location')
+                geometry = {'type': 'Point', 'coordinates': [location[1], location[0]]} if location else None
+                feature = {'type': 'Feature', 'geometry': geometry, 'properties': dict(item, time=iso(t))}
+            yield '\x1e' + json.dumps(feature) + '\n'
+
+    return chunked(features())
+
+
+def gpx(export):
+    def lines():
+        yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<gpx version="1.1" creator="10k" xmlns="http://www.topografix.com/GPX/1/1">\n')
+        # GPX wants waypoints before tracks
+        for entry in export.timeline():
+            location = entry.get('location')
+            if not location:
+                continue
+            yield ('<wpt lat="%.7f" lon="%.7f"><time>%s</time><name>%s</name><type>%s</type></wpt>\n'
+                   % (location[0], location[1], iso(entry['t']), escape(str(entry.get('id'))), escape(entry['event'])))
+        for rows in export.buckets():
+            tracks = {}
+            for t, who, lat, lng in rows:
+                tracks.setdefault(who, []).append('<trkpt lat="%.7f" lon="%.7f"><time>%s</time></trkpt>'
+                                                  % (lat, lng, iso(t)))
+            for who, points in tracks.items():
+                pid, kind, bib = export.describe(who)
+                yield ('<trk><name>%s</name><type>%s</type><trkseg>\n%s\n</trkseg></trk>\n'
+                       % (escape(str(bib or pid)), escape(kind), '\n'.join(points)))
+        yield '</gpx>\n'
+
+    return chunked(lines())
+
+
+class _Sink(object):
+    # File-like object collecting what pyarrow writes, drained per batch
+
+    def __init__(self):
+        self.parts = []
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def arrow(export):
+    import pyarrow as pa
+    schema = pa.schema([
+        ('time', pa.timestamp('ms', tz='UTC')),
+        ('id', pa.string()),
+        ('type', pa.string()),
+        ('bib', pa.string()),
+        ('lat', pa.float64()),
+        ('lng', pa.float64()),
+    ])
+    sink = _Sink()
+    writer = pa.ipc.new_stream(pa.PythonFile(sink, mode='w'), schema)
+
+    def batch(rows):
+        described = [export.describe(who) for _, who, _, _ in rows]
+        return pa.record_batch([
+            pa.array([int(t * 1000) for t, _, _, _ in rows], pa.timestamp('ms', tz='UTC')),
+            pa.array([pid for pid, _, _ in described]),
+            pa.array([kind for _, kind, _ in described]),
+            pa.array([None if bib is None else str(bib) for _, _, bib in described]),
+            pa.array([lat for _, _, lat, _ in rows], pa.float64()),
+            pa.array([lng for _, _, _, lng in rows], pa.float64()),
+        ], schema=schema)
+
+    rows = []
+    for row in export.fixes():
+        rows.append(row)
+        if len(rows) >= CHUNK_ROWS:
+            writer.write_batch(batch(rows))
+            rows = []
+            yield sink.drain()
+    if rows:
+        writer.write_batch(batch(rows))
+    writer.close()
+    yield sink.drain()
+
+
+WRITERS = {'geojsonseq': geojsonseq, 'gpx': gpx, 'arrow': arrow}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--event', default=DEFAULT_EVENT)
+    parser.add_argument('--dir', default=history.HISTORY_DIR, help='history directory (HISTORY_DIR)')
+    parser.add_argument('--run', help='run to export; the latest if omitted')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='geojsonseq')
+    parser.add_argument('--participant', help='bib number or participant ID; everyone if omitted')
+    parser.add_argument('--from', dest='start', type=float, help='epoch seconds')
+    parser.add_argument('--to', dest='end', type=float, help='epoch seconds')
+    parser.add_argument('-o', '--output', help='file to write; stdout if omitted')
+    args = parser.parse_args()
+
+    if not EVENT_ID.match(args.event):
+        parser.error('bad event ID')
+    if args.run and not history.RUN.match(args.run):
+        parser.error('bad run name')
+    if not available(args.format):
+        parser.error('%s export needs pyarrow: pip install -r requirements-export.txt' % args.format)
+    if hasattr(os, 'nice'):
+        # Leave the CPU to the live server
+        os.nice(NICE)
+    runs = history.runs(os.path.join(args.dir, args.event))
+    run = args.run or (runs[-1] if runs else None)
+    if run not in runs:
+        sys.exit('no history for event %s in %s' % (args.event, args.dir))
+    export = Export(os.path.join(args.dir, args.event, run), args.participant, args.start, args.end)
+    if export.projection is None:
+        sys.exit('no history for event %s run %s in %s' % (args.event, run, args.dir))
+
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for chunk in WRITERS[args.format](export):
+            out.write(chunk if isinstance(chunk, bytes) else chunk.encode())
+        out.flush()
+    except BrokenPipeError:
+        # The download was abandoned
+        pass
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
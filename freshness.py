@@ -0,0 +1,223 @@
+"""How old a position is by the time it is on a crew's screen.
+
+Pages stamp each fix with its GPS time and the time they sent it, the
+server notes when it received the fix and when it broadcast the filtered
+position, and at most once every SAMPLE_SECONDS per participant the
+broadcast carries those stamps. Crew pages send back when stamped updates
+arrived, a batch at a time.
+
+Page clocks are put on the server's clock the way NTP does it: every
+CLOCK_PROBE_SECONDS the server sends 'clock' with an ack, the page answers
+with its own time, and of the last CLOCK_SAMPLES answers the one with the
+shortest round trip gives the offset. Hops that cross a clock are only
+counted once the page's offset is known.
+
+Delays go into fixed-bucket histograms per hop and role:
+    gps       GPS fix to the page sending it (page clock only)
+    uplink    page sending to server receiving
+    server    server receiving to broadcasting, i.e. waiting for the tick
+    downlink  server broadcasting to the crew page receiving
+    total     GPS fix to the crew page receiving
+The first three are per role of the participant the fix is from, downlink
+per role of the page receiving it, total as 'runner>crew' or 'crew>crew'.
+"""
+from bisect import bisect_left
+from collections import deque
+from functools import partial
+import time
+
+HOPS = ('gps', 'uplink', 'server', 'downlink', 'total')
+# Histogram bucket upper bounds, in milliseconds; the last bucket is open
+BOUNDS_MS = (50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 30000, 60000)
+
+SAMPLE_SECONDS = 10
+CLOCK_PROBE_SECONDS = 60
+# New pages get a few probes in quick succession so the offset is known early
+CLOCK_FIRST_PROBES = 3
+CLOCK_RETRY_SECONDS = 2
+CLOCK_SAMPLES = 8
+# Probes per tick, so a burst of new connections doesn't become a burst of emits
+MAX_PROBES = 200
+MAX_RECEIPTS = 100
+
+# Positions older than this on screen are what we tune ticks and throttling against
+TARGET_SECONDS = 10
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        seconds = max(seconds, 0.0)
+        self.counts[bisect_left(BOUNDS_MS, seconds * 1000)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, fraction):
+        """Upper bound in seconds of the bucket holding the quantile; None
+        if it falls in the open bucket."""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return BOUNDS_MS[i] / 1000.0 if i < len(BOUNDS_MS) else None
+        return None
+
+    def within(self, seconds):
+        """Share of samples at or under `seconds`, to bucket precision."""
+        if not self.count:
+            return None
+        ms = seconds * 1000
+        return sum(count for bound, count in zip(BOUNDS_MS, self.counts) if bound <= ms) / float(self.count)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 3) if self.count else None,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': [[bound, count] for bound, count in zip(BOUNDS_MS + (None,), self.counts)]
+        }
+
+
+class Clock(object):
+    """A page's clock offset from ours: page time minus server time."""
+
+    def __init__(self):
+        self.samples = deque(maxlen=CLOCK_SAMPLES)
+        self.probes = 0
+        self.next_probe = 0
+
+    def add(self, sent, page_time, received):
+        rtt = received - sent
+        self.samples.append((rtt, page_time - (sent + received) / 2.0))
+
+    def offset(self):
+        if not self.samples:
+            return None
+        return min(self.samples)[1]
+
+    def rtt(self):
+        return min(self.samples)[0] if self.samples else None
+
+
+class Freshness(object):
+
+    def __init__(self, emit, clock=time.time):
+        # emit(event, payload, pid, callback) sends to one participant
+        self.emit = emit
+        self.clock = clock
+        self.clocks = {}
+        self.fixes = {}
+        self.last_sample = {}
+        self.histograms = {}
+
+    def record(self, hop, role, seconds):
+        histogram = self.histograms.get((hop, role))
+        if histogram is None:
+            histogram = self.histograms[(hop, role)] = Histogram()
+        histogram.add(seconds)
+
+    def probe(self, pids, now):
+        """Send clock probes to the connected participants that are due one."""
+        sent = 0
+        for pid in pids:
+            clock = self.clocks.get(pid)
+            if clock is None:
+                clock = self.clocks[pid] = Clock()
+            if now < clock.next_probe:
+                continue
+            clock.probes += 1
+            clock.next_probe = now + (CLOCK_RETRY_SECONDS if clock.probes < CLOCK_FIRST_PROBES else CLOCK_PROBE_SECONDS)
+            self.emit('clock', None, pid, partial(self._answer, pid, self.clock()))
+            sent += 1
+            if sent >= MAX_PROBES:
+                break
+
+    def _answer(self, pid, sent, page_ms=None):
+        clock = self.clocks.get(pid)
+        if clock is not None and isinstance(page_ms, (int, float)):
+            clock.add(sent, page_ms / 1000.0, self.clock())
+
+    def to_server(self, pid, page_ms):
+        """A page timestamp in milliseconds as server time, if the page's
+        clock offset is known."""
+        clock = self.clocks.get(pid)
+        offset = clock.offset() if clock is not None else None
+        if offset is None or not isinstance(page_ms, (int, float)):
+            return None
+        return page_ms / 1000.0 - offset
+
+    def received(self, pid, kind, data, now):
+        """Note the stamps on a live fix; the latest one per tick is broadcast."""
+        self.fixes[pid] = (kind, data.get('gps_at'), data.get('sent_at'), now)
+
+    def emitted(self, pid, now):
+        """Record the hops up to the broadcast of a participant's position.
+        Returns the stamps to send with it, [GPS time, received, broadcast]
+        in server milliseconds plus the participant's role, or None if this
+        one isn't sampled."""
+        fix = self.fixes.pop(pid, None)
+        if fix is None:
+            # Positions from an offline batch aren't live traffic
+            return None
+        kind, gps_at, sent_at, received = fix
+        if isinstance(gps_at, (int, float)) and isinstance(sent_at, (int, float)):
+            self.record('gps', kind, (sent_at - gps_at) / 1000.0)
+        sent = self.to_server(pid, sent_at)
+        if sent is not None:
+            self.record('uplink', kind, received - sent)
+        self.record('server', kind, now - received)
+        if now - self.last_sample.get(pid, 0) < SAMPLE_SECONDS:
+            return None
+        self.last_sample[pid] = now
+        gps = self.to_server(pid, gps_at)
+        return [int(gps * 1000) if gps is not None else None, int(received * 1000), int(now * 1000), kind]
+
+    def receipts(self, pid, role, receipts):
+        """Crew page `pid` reporting [stamps, arrived] pairs, arrived in its
+        own clock's milliseconds."""
+        if not isinstance(receipts, list):
+            return
+        for receipt in receipts[:MAX_RECEIPTS]:
+            try:
+                (gps, _, emitted, kind), arrived = receipt
+            except (TypeError, ValueError):
+                continue
+            arrived = self.to_server(pid, arrived)
+            if arrived is None or not isinstance(emitted, (int, float)):
+                continue
+            self.record('downlink', role, arrived - emitted / 1000.0)
+            if isinstance(gps, (int, float)) and kind in ('runner', 'crew'):
+                self.record('total', '%s>%s' % (kind, role), arrived - gps / 1000.0)
+
+    def forget(self, pid):
+        self.clocks.pop(pid, None)
+        self.fixes.pop(pid, None)
+        self.last_sample.pop(pid, None)
+
+    def stats(self, target=TARGET_SECONDS):
+        hops = {}
+        for (hop, role), histogram in sorted(self.histograms.items()):
+            hops.setdefault(hop, {})[role] = histogram.summary()
+        totals = dict((role, histogram.within(target)) for (hop, role), histogram in self.histograms.items()
+                      if hop == 'total')
+        rtts = sorted(rtt for rtt in (clock.rtt() for clock in self.clocks.values()) if rtt is not None)
+        return {
+            'target': target,
+            'within_target': totals,
+            'hops': hops,
+            'clocks': {
+                'known': len(rtts),
+                'pending': len(self.clocks) - len(rtts),
+                'rtt_p50': rtts[len(rtts) // 2] if rtts else None
+            }
+        }
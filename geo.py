@@ -0,0 +1,50 @@
+"""Small geodesy helpers shared by the per-tick analytics."""
+import math
+
+EARTH_RADIUS = 6371000.0
+
+
+def haversine(a, b):
+    """Great-circle distance in metres between two [lat, lng] points."""
+    lat1, lng1 = math.radians(a[0]), math.radians(a[1])
+    lat2, lng2 = math.radians(b[0]), math.radians(b[1])
+    h = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(h))
+
+
+class LocalProjection(object):
+    """Equirectangular projection to metres around a fixed origin.
+
+    Accurate to well under a metre across a race-sized area, and cheap enough
+    to run on every fix.
+    """
+
+    def __init__(self, lat, lng):
+        self.lat = lat
+        self.lng = lng
+        self.mx = math.radians(1) * EARTH_RADIUS * math.cos(math.radians(lat))
+        self.my = math.radians(1) * EARTH_RADIUS
+
+    def to_xy(self, lat, lng):
+        return (lng - self.lng) * self.mx, (lat - self.lat) * self.my
+
+    def to_latlng(self, x, y):
+        return self.lat + y / self.my, self.lng + x / self.mx
+
+
+def encode_polyline(points, precision=5):
+    """Encode [(lat, lng), ...] with Google's encoded polyline algorithm."""
+    factor = 10 ** precision
+    out = []
+    prev_lat = prev_lng = 0
+    for lat, lng in points:
+        lat, lng = int(round(lat * factor)), int(round(lng * factor))
+        for delta in (lat - prev_lat, lng - prev_lng):
+            delta = ~(delta << 1) if delta < 0 else delta << 1
+            while delta >= 0x20:
+                out.append(chr((0x20 | (delta & 0x1f)) + 63))
+                delta >>= 5
+            out.append(chr(delta + 63))
+        prev_lat, prev_lng = lat, lng
+    return ''.join(out)
@@ -0,0 +1,445 @@
+"""Every raw fix of a race, for questions asked after the fact.
+
+Fixes land in time buckets of BUCKET_SECONDS, each a grid of CELL_METERS
+cells in the event's local metres, so a query only opens the buckets its
+time range overlaps and, in those, the cells its area overlaps. Buckets
+that ended more than HOT_SECONDS ago are written to disk, one file each:
+a JSON header indexing every cell's offset, then the cells' columns. The
+headers stay in memory; a query reads just the cells it needs.
+
+Fixes that arrive late for a bucket already on disk (offline batches) start
+a fresh in-memory bucket for the same period, spilled as a further segment.
+
+Participants are interned per event into a table of [id, kind, bib] that is
+written next to the segments, with the projection origin, so history
+outlives the RaceEvent. Emergency milestones are queued as they happen and
+appended to timeline.jsonl in the same directory by the next spill.
+
+Each race writes to HISTORY_DIR/<event>/<run>, the run named after when it
+started: a RaceEvent created within RESUME_SECONDS of the latest run's last
+write (a restart, or an event evicted while idle) carries on with it, and
+otherwise starts a new run, so a race never inherits an earlier one's
+fixes. Writes are one job at a time; given an offload, the job runs off
+the hub and the bucket being written stays queryable until it lands.
+"""
+from array import array
+import json
+import math
+import os
+import re
+import struct
+import time
+
+from logs import logger
+
+HISTORY_DIR = os.environ.get('HISTORY_DIR', 'history')
+BUCKET_SECONDS = 300
+CELL_METERS = 250
+HOT_SECONDS = 600
+RESUME_SECONDS = 3600
+RUN_FORMAT = '%Y%m%dT%H%M%SZ'
+RUN = re.compile(r'^\d{8}T\d{6}Z$')
+TABLE = re.compile(r'^participants\.(\d+)\.json$')
+
+MAGIC = b'HIST1\n'
+HEADER = struct.Struct('<I')
+# Column type codes and item sizes, in file order
+COLUMNS = (('t', 'd'), ('x', 'f'), ('y', 'f'), ('who', 'i'))
+ROW_BYTES = sum(array(code).itemsize for _, code in COLUMNS)
+
+
+def cell_of(x, y):
+    return int(math.floor(x / CELL_METERS)), int(math.floor(y / CELL_METERS))
+
+
+def cells_around(x, y, radius):
+    cx0, cy0 = cell_of(x - radius, y - radius)
+    cx1, cy1 = cell_of(x + radius, y + radius)
+    return [(cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)]
+
+
+def runs(event_directory):
+    """An event's run names, oldest first."""
+    try:
+        names = os.listdir(event_directory)
+    except OSError:
+        return []
+    return sorted(name for name in names if RUN.match(name))
+
+
+def last_written(directory):
+    try:
+        return max([os.path.getmtime(directory)] +
+                   [os.path.getmtime(os.path.join(directory, name)) for name in os.listdir(directory)])
+    except OSError:
+        return 0
+
+
+def run_directory(event_directory, now, resume_seconds=RESUME_SECONDS):
+    """Where a RaceEvent created at `now` writes: the latest run if it was
+    written to in the last resume_seconds, else a new run."""
+    existing = runs(event_directory)
+    if existing:
+        latest = os.path.join(event_directory, existing[-1])
+        if last_written(latest) >= now - resume_seconds:
+            return latest
+    return os.path.join(event_directory, time.strftime(RUN_FORMAT, time.gmtime(now)))
+
+
+def save_table(directory, version, origin, table):
+    # Versioned, so when two writes overlap (a close while one is off the
+    # hub) the newer table is the one kept
+    path = os.path.join(directory, 'participants.%d.json' % version)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'origin': origin, 'participants': table}, f)
+    os.replace(path + '.tmp', path)
+    for name in os.listdir(directory):
+        match = TABLE.match(name)
+        if match and int(match.group(1)) < version:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+def write(job):
+    """Carry out one History write, on or off the hub: timeline lines, then
+    the bucket, then the table. Returns (segment, table saved, lines
+    written, error)."""
+    directory, start, bucket, path, table, lines = job
+    segment = None
+    saved = written = False
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        if lines:
+            with open(os.path.join(directory, 'timeline.jsonl'), 'a') as f:
+                f.write(''.join(lines))
+        written = True
+        if bucket is not None:
+            bucket.write(path)
+            segment = Segment(path)
+        if table is not None:
+            save_table(directory, *table)
+        saved = True
+    except (OSError, ValueError) as e:
+        return segment, saved, written, e
+    return segment, saved, written, None
+
+
+class Bucket(object):
+    """One period's fixes in memory, as four columns per cell."""
+
+    def __init__(self, start):
+        self.start = start
+        self.cells = {}
+        self.rows = 0
+
+    def add(self, t, x, y, who):
+        key = cell_of(x, y)
+        columns = self.cells.get(key)
+        if columns is None:
+            columns = self.cells[key] = tuple(array(code) for _, code in COLUMNS)
+        columns[0].append(t)
+        columns[1].append(x)
+        columns[2].append(y)
+        columns[3].append(who)
+        self.rows += 1
+
+    def read(self, key):
+        return self.cells.get(key)
+
+    def merge(self, other):
+        for key, columns in other.cells.items():
+            mine = self.cells.get(key)
+            if mine is None:
+                self.cells[key] = columns
+            else:
+                for column, more in zip(mine, columns):
+                    column.extend(more)
+        self.rows += other.rows
+
+    def write(self, path):
+        index = []
+        offset = 0
+        for (cx, cy), columns in self.cells.items():
+            count = len(columns[0])
+            index.append([cx, cy, offset, count])
+            offset += count * ROW_BYTES
+        header = json.dumps({'start': self.start, 'rows': self.rows, 'cells': index}).encode()
+        with open(path + '.tmp', 'wb') as f:
+            f.write(MAGIC + HEADER.pack(len(header)) + header)
+            for columns in self.cells.values():
+                for column in columns:
+                    column.tofile(f)
+        os.replace(path + '.tmp', path)
+
+
+class Segment(object):
+    """A bucket on disk: its cell index in memory, its fixes read on demand."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a history segment' % path)
+            size, = HEADER.unpack(f.read(HEADER.size))
+            header = json.loads(f.read(size))
+        self.base = len(MAGIC) + HEADER.size + size
+        self.start = header['start']
+        self.rows = header['rows']
+        self.cells = dict(((cx, cy), (offset, count)) for cx, cy, offset, count in header['cells'])
+
+    def read(self, key):
+        entry = self.cells.get(key)
+        if entry is None:
+            return None
+        offset, count = entry
+        columns = tuple(array(code) for _, code in COLUMNS)
+        with open(self.path, 'rb') as f:
+            f.seek(self.base + offset)
+            for column in columns:
+                column.fromfile(f, count)
+        return columns
+
+    def columns(self):
+        """Every cell's columns in file order, reading the file once."""
+        with open(self.path, 'rb') as f:
+            f.seek(self.base)
+            for offset, count in sorted(self.cells.values()):
+                columns = tuple(array(code) for _, code in COLUMNS)
+                for column in columns:
+                    column.fromfile(f, count)
+                yield columns
+
+
+class History(object):
+
+    def __init__(self, directory, origin=None, bucket_seconds=BUCKET_SECONDS, hot_seconds=HOT_SECONDS,
+                 offload=None):
+        # origin is the (lat, lng) the event's local metres are measured from
+        self.directory = directory
+        self.origin = origin
+        self.bucket_seconds = bucket_seconds
+        self.hot_seconds = hot_seconds
+        # offload(fn, arg, done) runs fn(arg) off the hub and done(result)
+        # back on it; without one, writes happen in spill()
+        self.offload = offload
+        self.hot = {}
+        self.segments = {}
+        self.table = []
+        self.ids = {}
+        self.table_dirty = False
+        self.table_version = 0
+        # Segment files so far, for unique names; the write job in flight;
+        # timeline lines waiting for the next one
+        self.spilled = 0
+        self.writing = None
+        self.notes = []
+        self.load()
+
+    def load(self):
+        # Carry on from what an earlier RaceEvent for this race left on disk
+        if not os.path.isdir(self.directory):
+            return
+        names = sorted(os.listdir(self.directory))
+        versions = [int(match.group(1)) for match in map(TABLE.match, names) if match]
+        if versions:
+            self.table_version = max(versions)
+            try:
+                with open(os.path.join(self.directory, 'participants.%d.json' % self.table_version)) as f:
+                    saved = json.load(f)
+                self.table = saved['participants']
+                self.origin = self.origin or saved['origin']
+            except (OSError, ValueError, KeyError):
+                self.table = []
+        self.ids = dict((entry[0], i) for i, entry in enumerate(self.table))
+        for name in names:
+            if name.endswith('.bin'):
+                segment = Segment(os.path.join(self.directory, name))
+                self.segments.setdefault(segment.start, []).append(segment)
+                self.spilled += 1
+
+    def intern(self, pid, kind, bib=None):
+        who = self.ids.get(pid)
+        if who is None:
+            who = self.ids[pid] = len(self.table)
+            self.table.append([pid, kind, bib])
+            self.table_dirty = True
+        elif bib and self.table[who][2] != bib:
+            self.table[who][2] = bib
+            self.table_dirty = True
+        return who
+
+    def add(self, pid, kind, t, x, y, bib=None):
+        start = int(t // self.bucket_seconds) * self.bucket_seconds
+        bucket = self.hot.get(start)
+        if bucket is None:
+            bucket = self.hot[start] = Bucket(start)
+        bucket.add(t, x, y, self.intern(pid, kind, bib))
+
+    def spill(self, now, everything=False):
+        """Start writing the oldest bucket that has gone cold, with the
+        timeline lines and participant table changed since the last write.
+        One write at a time, so a tick never starts more than one. Returns
+        whether one started."""
+        if self.writing is not None:
+            return False
+        cold = [start for start in self.hot
+                if everything or start + self.bucket_seconds <= now - self.hot_seconds]
+        if not cold and not self.notes:
+            return False
+        start = bucket = path = table = None
+        if cold:
+            start = min(cold)
+            bucket = self.hot.pop(start)
+            path = os.path.join(self.directory, '%d.%d.bin' % (start, self.spilled))
+            self.spilled += 1
+        if self.table_dirty:
+            self.table_version += 1
+            table = (self.table_version, self.origin, list(self.table))
+            self.table_dirty = False
+        job = self.writing = (self.directory, start, bucket, path, table, self.notes)
+        self.notes = []
+        if self.offload is None:
+            self.written(job, write(job))
+        else:
+            self.offload(write, job, lambda result: self.written(job, result))
+        return True
+
+    def written(self, job, result):
+        _, start, bucket, _, table, lines = job
+        segment, saved, lines_written, error = result
+        if self.writing is job:
+            self.writing = None
+        if segment is not None:
+            self.segments.setdefault(start, []).append(segment)
+        elif bucket is not None:
+            # Back into memory for the next spill, with any fixes that came
+            # in for the same period meanwhile
+            fresh = self.hot.get(start)
+            if fresh is not None:
+                bucket.merge(fresh)
+            self.hot[start] = bucket
+        if table is not None and not saved:
+            self.table_dirty = True
+        if not lines_written:
+            self.notes[:0] = lines
+        if error is not None:
+            logger.error('history_write_failed', directory=self.directory, error=repr(error))
+
+    def note(self, t, event, **fields):
+        """Queue a milestone for the timeline; the next spill writes it."""
+        fields['t'] = t
+        fields['event'] = event
+        self.notes.append(json.dumps(fields) + '\n')
+
+    def close(self):
+        """Write everything still in memory, here and now. A write already
+        off the hub lands on its own; its files don't clash with these."""
+        self.offload = None
+        self.writing = None
+        for _ in range(len(self.hot) + 1):
+            if not self.spill(None, everything=True):
+                break
+        if self.table_dirty:
+            self.table_dirty = False
+            self.table_version += 1
+            job = (self.directory, None, None, None, (self.table_version, self.origin, self.table), [])
+            self.written(job, write(job))
+
+    def parts(self, t0, t1):
+        # Every bucket, in memory or on disk, that overlaps [t0, t1]
+        first = int(t0 // self.bucket_seconds) * self.bucket_seconds
+        # A bucket still being written is queried from memory
+        writing = self.writing
+        spilling = {writing[1]: writing[2]} if writing is not None and writing[2] is not None else {}
+        for start in sorted(set(self.hot) | set(self.segments) | set(spilling)):
+            if first <= start <= t1:
+                for segment in self.segments.get(start, ()):
+                    yield segment
+                if start in spilling:
+                    yield spilling[start]
+                if start in self.hot:
+                    yield self.hot[start]
+
+    def scan(self, x, y, radius, t0, t1, keys=None):
+        """(t, who, distance) for fixes within radius metres of (x, y)."""
+        keys = keys if keys is not None else cells_around(x, y, radius)
+        for part in self.parts(t0, t1):
+            for key in keys:
+                columns = part.read(key)
+                if columns is None:
+                    continue
+                for t, fx, fy, who in zip(*columns):
+                    if t0 <= t <= t1:
+                        distance = math.hypot(fx - x, fy - y)
+                        if distance <= radius:
+                            yield t, who, distance
+
+    def describe(self, who):
+        pid, kind, bib = self.table[who]
+        return {'id': pid, 'type': kind, 'bib': bib}
+
+    def within(self, x, y, radius, t0, t1, kind=None):
+        """Participants with a fix within radius metres of (x, y) between
+        t0 and t1: when they were first and last there and how close they got."""
+        found = {}
+        for t, who, distance in self.scan(x, y, radius, t0, t1):
+            entry = found.get(who)
+            if entry is None:
+                found[who] = [t, t, distance, 1]
+            else:
+                entry[0] = min(entry[0], t)
+                entry[1] = max(entry[1], t)
+                entry[2] = min(entry[2], distance)
+                entry[3] += 1
+        out = []
+        for who, (first, last, closest, fixes) in found.items():
+            row = self.describe(who)
+            if kind and row['type'] != kind:
+                continue
+            row.update({'first': first, 'last': last, 'closest': round(closest, 1), 'fixes': fixes})
+            out.append(row)
+        out.sort(key=lambda row: row['closest'])
+        return out
+
+    def nearest(self, x, y, t, count=5, window=120, kind=None, max_radius=20000):
+        """The `count` participants that came closest to (x, y) in the
+        `window` seconds up to t. The search radius doubles from one cell
+        until enough are found, so only the cells nearby are read."""
+        radius = CELL_METERS
+        searched = set()
+        closest = {}
+        while True:
+            keys = [key for key in cells_around(x, y, radius) if key not in searched]
+            searched.update(keys)
+            # Keep every fix in the cells read, not just those within the
+            # radius: each cell is only read once
+            for _, who, distance in self.scan(x, y, float('inf'), t - window, t, keys):
+                if kind and self.table[who][1] != kind:
+                    continue
+                if distance < closest.get(who, float('inf')):
+                    closest[who] = distance
+            inside = [who for who, distance in closest.items() if distance <= radius]
+            if len(inside) >= count or radius >= max_radius:
+                break
+            radius *= 2
+        ranked = sorted(closest.items(), key=lambda item: item[1])[:count]
+        out = []
+        for who, distance in ranked:
+            row = self.describe(who)
+            row['distance'] = round(distance, 1)
+            out.append(row)
+        return out
+
+    def stats(self):
+        return {
+            'hot_buckets': len(self.hot),
+            'hot_rows': sum(bucket.rows for bucket in self.hot.values()),
+            'segments': sum(len(segments) for segments in self.segments.values()),
+            'disk_rows': sum(segment.rows for segments in self.segments.values() for segment in segments),
+            'participants': len(self.table),
+            'run': os.path.basename(self.directory),
+            'writing': self.writing is not None
+        }
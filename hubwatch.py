@@ -0,0 +1,78 @@
+"""Hub lag and blocking detector.
+
+A heartbeat task on the hub calls beat() every BEAT_SECONDS; how late each
+beat arrives is the hub lag every other task saw too. The heartbeat can't
+notice a stall while it is happening, so watch() runs on a real OS thread
+and, when the last beat is older than STALL_SECONDS, samples the stack of
+the hub thread: with green threads or coroutines that is exactly the code
+holding the hub.
+"""
+from collections import deque
+import sys
+import time
+import traceback
+
+from logs import logger
+from dispatch import percentile
+
+BEAT_SECONDS = 0.05
+STALL_SECONDS = 0.25
+STACK_DEPTH = 12
+
+
+class HubWatchdog(object):
+
+    def __init__(self, hub_thread, interval=BEAT_SECONDS, threshold=STALL_SECONDS, history=1200):
+        # hub_thread is the OS thread ID of the thread running the hub
+        self.hub_thread = hub_thread
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = deque(maxlen=history)
+        self.samples = deque(maxlen=50)
+        self.stalls = 0
+        self.last = None
+        self.sampled = None
+
+    def beat(self):
+        now = time.monotonic()
+        if self.last is not None:
+            lag = max(now - self.last - self.interval, 0.0)
+            self.lags.append(lag)
+            if self.sampled == self.last:
+                # The stall that was sampled is over: record how long it was
+                self.samples[-1]['seconds'] = round(lag + self.interval, 3)
+        self.last = now
+
+    def watch(self, sleep):
+        """Loop forever on a real thread; sleep must not need the hub."""
+        while True:
+            sleep(self.interval)
+            last = self.last
+            if last is None or last == self.sampled or time.monotonic() - last < self.threshold:
+                continue
+            self.sampled = last
+            self.stalls += 1
+            frame = sys._current_frames().get(self.hub_thread)
+            stack = traceback.format_stack(frame)[-STACK_DEPTH:] if frame is not None else []
+            self.samples.append({'at': time.time(), 'seconds': None, 'stack': [line.strip() for line in stack]})
+            logger.error('hub_stall', threshold=self.threshold, stack=stack[-1].strip() if stack else None)
+
+    def recent_lag(self, seconds=2.0):
+        """p90 lag over the last few seconds of beats, for load decisions."""
+        count = max(int(seconds / self.interval), 1)
+        lags = list(self.lags)[-count:]
+        return percentile(lags, 0.9) or 0.0
+
+    def stats(self):
+        lags = list(self.lags)
+        return {
+            'lag': {
+                'p50': percentile(lags, 0.5),
+                'p99': percentile(lags, 0.99),
+                'max': max(lags) if lags else None
+            },
+            'stalls': self.stalls,
+            'recent_stalls': [{'at': sample['at'], 'seconds': sample['seconds'],
+                               'where': sample['stack'][-1] if sample['stack'] else None}
+                              for sample in reversed(self.samples)]
+        }
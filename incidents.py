@@ -0,0 +1,103 @@
+"""Emergency incident state machine.
+
+    raised -> claimed -> on_scene -> resolved
+       ^         |           |
+       +---------+           |  (claim released, or the claiming crew left)
+       +---------------------+  (only when the crew on scene left)
+
+Any open state can go straight to resolved, and raising an incident that
+is still open only moves it: its status and crew stay. Incidents are kept in the
+shared `emergencies` dict and indexed by status, so listing e.g. every
+unclaimed incident doesn't scan the closed ones.
+"""
+import time
+
+RAISED = 'raised'
+CLAIMED = 'claimed'
+ON_SCENE = 'on_scene'
+RESOLVED = 'resolved'
+
+TRANSITIONS = {
+    RAISED: (CLAIMED, RESOLVED),
+    CLAIMED: (ON_SCENE, RAISED, RESOLVED),
+    ON_SCENE: (RESOLVED,),
+}
+
+
+class IncidentBoard(object):
+
+    def __init__(self, incidents, clock=time.time):
+        self.incidents = incidents
+        self.clock = clock
+        self.by_status = {status: set() for status in TRANSITIONS}
+        self.by_crew = {}
+
+    def raise_incident(self, incident_id, location):
+        """A new incident, raised. If the runner already has one open, that
+        one keeps its status and crew and just moves to `location`."""
+        incident = self.incidents.get(incident_id)
+        if incident is not None:
+            incident['location'] = location
+            incident['timestamp'] = self.clock()
+            return incident
+        incident = self.incidents[incident_id] = {
+            'id': incident_id,
+            'location': location,
+            'timestamp': self.clock(),
+            'status': RAISED,
+            'crew': None
+        }
+        self.by_status[RAISED].add(incident_id)
+        return incident
+
+    def transition(self, incident_id, status, crew=None):
+        """Move an incident to `status`. Returns the incident, or None if the
+        move is not allowed from its current state."""
+        incident = self.incidents.get(incident_id)
+        if incident is None or status not in TRANSITIONS[incident['status']]:
+            return None
+        self._unindex(incident_id)
+        incident['status'] = status
+        incident['updated'] = self.clock()
+        if status == CLAIMED:
+            incident['crew'] = crew
+        elif status == RAISED:
+            incident['crew'] = None
+
+        if status == RESOLVED:
+            del self.incidents[incident_id]
+        else:
+            self.by_status[status].add(incident_id)
+            if incident['crew']:
+                self.by_crew.setdefault(incident['crew'], set()).add(incident_id)
+        return incident
+
+    def reopen(self, incident_id):
+        """Back to raised after its crew left for good, from claimed or
+        on_scene. Returns the incident, or None if it wasn't with a crew."""
+        incident = self.incidents.get(incident_id)
+        if incident is None or incident['status'] not in (CLAIMED, ON_SCENE):
+            return None
+        self._unindex(incident_id)
+        incident['status'] = RAISED
+        incident['crew'] = None
+        incident['updated'] = self.clock()
+        self.by_status[RAISED].add(incident_id)
+        return incident
+
+    def _unindex(self, incident_id):
+        incident = self.incidents.get(incident_id)
+        if incident is None:
+            return
+        self.by_status[incident['status']].discard(incident_id)
+        claimed = self.by_crew.get(incident['crew'])
+        if claimed is not None:
+            claimed.discard(incident_id)
+            if not claimed:
+                del self.by_crew[incident['crew']]
+
+    def with_status(self, status):
+        return [self.incidents[i] for i in self.by_status.get(status, ())]
+
+    def claimed_by(self, crew):
+        return list(self.by_crew.get(crew, ()))
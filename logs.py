@@ -0,0 +1,79 @@
+"""Buffered, sampled, structured logging.
+
+Handlers only append a dict to an in-memory buffer; the server drains it
+once per FLUSH_SECONDS and hands the chunk to a real thread for a single
+stdout write, so a connection surge costs no blocking writes on the hub.
+
+Each event name gets BURST records per flush. Past that only every
+SAMPLE_EVERY-th record is kept (tagged with 'sampled'), and the flush ends
+with a 'log_suppressed' summary of what was dropped. Errors are never
+sampled.
+"""
+from collections import deque
+import json
+import sys
+import time
+
+FLUSH_SECONDS = 1.0
+BURST = 20
+SAMPLE_EVERY = 100
+CAPACITY = 10000
+
+
+def write(chunk, stream=None):
+    stream = stream or sys.stdout
+    stream.write(chunk)
+    stream.flush()
+
+
+class Logger(object):
+
+    def __init__(self, burst=BURST, sample_every=SAMPLE_EVERY, capacity=CAPACITY):
+        self.burst = burst
+        self.sample_every = sample_every
+        self.records = deque()
+        self.capacity = capacity
+        self.counts = {}
+        self.suppressed = {}
+        self.dropped = 0
+
+    def log(self, event, **fields):
+        count = self.counts.get(event, 0) + 1
+        self.counts[event] = count
+        if count > self.burst:
+            if (count - self.burst) % self.sample_every:
+                self.suppressed[event] = self.suppressed.get(event, 0) + 1
+                return
+            fields['sampled'] = self.sample_every
+        self._append(event, 'info', fields)
+
+    def error(self, event, **fields):
+        self._append(event, 'error', fields)
+
+    def _append(self, event, level, fields):
+        if len(self.records) >= self.capacity:
+            self.dropped += 1
+            return
+        fields['ts'] = round(time.time(), 3)
+        fields['level'] = level
+        fields['event'] = event
+        self.records.append(fields)
+
+    def drain(self):
+        """Everything logged since the last drain as newline-delimited JSON,
+        or '' if there is nothing to write."""
+        # popleft rather than swapping the deque: the hub watchdog logs from
+        # its own thread
+        records = self.records
+        lines = []
+        while records:
+            lines.append(json.dumps(records.popleft(), default=str))
+        suppressed, self.suppressed, self.counts = self.suppressed, {}, {}
+        if suppressed or self.dropped:
+            lines.append(json.dumps({'ts': round(time.time(), 3), 'level': 'info', 'event': 'log_suppressed',
+                                     'counts': suppressed, 'dropped': self.dropped}))
+            self.dropped = 0
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+logger = Logger()
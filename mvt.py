@@ -0,0 +1,118 @@
+"""Mapbox Vector Tile (v2) encoding.
+
+Just the protobuf the spec needs, written by hand like geo.encode_polyline
+rather than pulling in a protobuf library: a tile is a list of layers, each
+a list of features with a geometry in tile coordinates (0..extent, y down)
+and a dict of properties.
+"""
+import struct
+
+EXTENT = 4096
+
+POINT = 1
+LINESTRING = 2
+POLYGON = 3
+
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+
+def varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def field(number, wire_type):
+    return varint((number << 3) | wire_type)
+
+
+def length_delimited(number, data):
+    return field(number, 2) + varint(len(data)) + data
+
+
+def packed(number, values):
+    return length_delimited(number, b''.join(varint(value) for value in values))
+
+
+def command(command_id, count):
+    return (command_id & 0x7) | (count << 3)
+
+
+def geometry(kind, parts):
+    """Command stream for a point set, or the parts of a line or polygon.
+    Polygon rings must already be wound clockwise (y down) for outer rings."""
+    out = []
+    cx = cy = 0
+    if kind == POINT:
+        points = [point for part in parts for point in part]
+        out.append(command(MOVE_TO, len(points)))
+        for x, y in points:
+            out += [zigzag(x - cx), zigzag(y - cy)]
+            cx, cy = x, y
+        return out
+    for part in parts:
+        if kind == POLYGON and part[0] == part[-1]:
+            part = part[:-1]
+        x, y = part[0]
+        out += [command(MOVE_TO, 1), zigzag(x - cx), zigzag(y - cy)]
+        cx, cy = x, y
+        out.append(command(LINE_TO, len(part) - 1))
+        for x, y in part[1:]:
+            out += [zigzag(x - cx), zigzag(y - cy)]
+            cx, cy = x, y
+        if kind == POLYGON:
+            out.append(command(CLOSE_PATH, 1))
+    return out
+
+
+def value(item):
+    if isinstance(item, bool):
+        return field(7, 0) + varint(int(item))
+    if isinstance(item, int):
+        if item >= 0:
+            return field(5, 0) + varint(item)
+        return field(6, 0) + varint(zigzag(item))
+    if isinstance(item, float):
+        return field(3, 1) + struct.pack('<d', item)
+    return length_delimited(1, str(item).encode())
+
+
+def layer(name, features, extent=EXTENT):
+    """features are (id or None, kind, parts, properties)."""
+    keys, values = {}, {}
+    encoded = []
+    for feature_id, kind, parts, properties in features:
+        tags = []
+        for key, item in properties.items():
+            if item is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(item), item), len(values)))
+        body = b''
+        if feature_id is not None:
+            body += field(1, 0) + varint(feature_id)
+        if tags:
+            body += packed(2, tags)
+        body += field(3, 0) + varint(kind)
+        body += packed(4, geometry(kind, parts))
+        encoded.append(length_delimited(2, body))
+    out = field(15, 0) + varint(2) + length_delimited(1, name.encode())
+    out += b''.join(encoded)
+    out += b''.join(length_delimited(3, key.encode()) for key in keys)
+    out += b''.join(length_delimited(4, value(item)) for _, item in values)
+    out += field(5, 0) + varint(extent)
+    return out
+
+
+def tile(layers):
+    """layers are (name, features); layers without features are left out."""
+    return b''.join(length_delimited(3, layer(name, features)) for name, features in layers if features)
@@ -0,0 +1,246 @@
+"""Slow-consumer handling for position traffic.
+
+Position updates go out as room broadcasts, encoded once for everyone. A
+client whose send backlog in the Socket.IO server passes SLOW_PACKETS is
+taken out of the position feeds and gets a ClientQueue instead: bounded,
+keyed per participant so a newer position replaces the older one, and
+flushed every FLUSH_SECONDS only once its backlog has drained. After
+RECOVER_FLUSHES healthy flushes in a row it goes back on the live feeds.
+
+Only position traffic is ever queued here. Emergencies, incident status and
+presence always go straight out, so they are never coalesced or dropped.
+
+A crew with an unacknowledged emergency alert is held the same way whatever
+its backlog, so its alert isn't queued behind position updates: the server
+drops the position packets still waiting for it (drop_positions) and its
+queue collects newer ones until release().
+"""
+from collections import OrderedDict
+
+from logs import logger
+from dispatch import percentile
+
+SLOW_PACKETS = 200
+RECOVERED_PACKETS = 10
+CAPACITY = 500
+FLUSH_SECONDS = 5
+RECOVER_FLUSHES = 3
+
+
+def drop_positions(queue, waiting, events):
+    """Take the packets for `events` out of a client's Engine.IO send queue,
+    `waiting` being the deque under `queue`. Returns how many went."""
+    prefixes = tuple('2["%s"' % event for event in events)
+    keep = [pkt for pkt in waiting
+            if pkt is None or not isinstance(pkt.data, str) or not pkt.data.startswith(prefixes)]
+    dropped = len(waiting) - len(keep)
+    if dropped:
+        waiting.clear()
+        waiting.extend(keep)
+        # Dropped packets count as done, or a closing socket's join() hangs
+        for _ in range(dropped):
+            queue.task_done()
+    return dropped
+
+
+class ClientQueue(object):
+
+    def __init__(self, capacity=CAPACITY, demoted=True):
+        self.capacity = capacity
+        # Slow (demoted), held for an alert, or both
+        self.demoted = demoted
+        self.held = False
+        self.entries = OrderedDict()
+        self.dropped = 0
+        self.coalesced = 0
+        self.healthy = 0
+        self.last_flush = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, key, event, payload, now):
+        entries = self.entries
+        if key in entries:
+            del entries[key]
+            self.coalesced += 1
+        elif len(entries) >= self.capacity:
+            entries.popitem(last=False)
+            self.dropped += 1
+        entries[key] = (event, payload, now)
+
+    def oldest(self):
+        for _, _, queued in self.entries.values():
+            return queued
+        return None
+
+    def drain(self):
+        entries = list(self.entries.values())
+        self.entries.clear()
+        return entries
+
+
+class Outbox(object):
+    """Per-client backlogs for one race, and queues for its slow clients.
+
+    session(pid) maps a participant to its socket, rooms(pid) gives the
+    rooms it belongs to, and room(name) the transport's name for a room.
+    """
+
+    def __init__(self, transport, session, rooms, room, feeds):
+        self.transport = transport
+        self.session = session
+        self.rooms = rooms
+        self.room = room
+        self.feeds = feeds
+        self.slow = {}
+        # Only clients with something waiting; most have nothing. Peaks are
+        # since the backlog last emptied
+        self.backlogs = {}
+        self.peaks = {}
+        self.demotions = {}
+
+    def holds(self, pid, name):
+        """True if a feed room is being replaced by the client's queue."""
+        return pid in self.slow and name in self.feeds
+
+    def push(self, event, payload, feed, key, now, skip=None):
+        """Queue a feed broadcast for slow clients, who aren't in the room."""
+        for pid, queue in self.slow.items():
+            if pid != skip and feed in self.rooms(pid):
+                queue.put((event, key), event, payload, now)
+
+    def send(self, pid, event, payload, key, now):
+        """Queue a direct position message if the client is slow. Returns
+        False if it should just be sent."""
+        queue = self.slow.get(pid)
+        if queue is None:
+            return False
+        queue.put((event, key), event, payload, now)
+        return True
+
+    def check(self, pids, now):
+        """Sample every client's send backlog; demote, flush and promote."""
+        backlog = self.transport.backlog
+        for pid in pids:
+            sid = self.session(pid)
+            packets = backlog(sid) if sid is not None else None
+            if packets is None:
+                continue
+            if packets:
+                self.backlogs[pid] = packets
+                if packets > self.peaks.get(pid, 0):
+                    self.peaks[pid] = packets
+            else:
+                self.backlogs.pop(pid, None)
+                self.peaks.pop(pid, None)
+
+            queue = self.slow.get(pid)
+            if queue is None or not queue.demoted:
+                if packets >= SLOW_PACKETS:
+                    self.demote(pid, sid, packets)
+            elif queue.held:
+                continue
+            elif packets > RECOVERED_PACKETS:
+                queue.healthy = 0
+            elif now - queue.last_flush >= FLUSH_SECONDS:
+                self.flush(pid, sid, queue, now)
+
+    def demote(self, pid, sid, packets):
+        queue = self.slow.get(pid)
+        if queue is None:
+            self.slow[pid] = ClientQueue()
+            self.leave_feeds(pid, sid)
+        else:
+            # Already off the feeds for an alert
+            queue.demoted = True
+        self.demotions[pid] = self.demotions.get(pid, 0) + 1
+        logger.log('client_demoted', participant=pid, backlog=packets)
+
+    def hold(self, pid, sid):
+        """Keep a client's position traffic in its queue until release()."""
+        queue = self.slow.get(pid)
+        if queue is None:
+            queue = self.slow[pid] = ClientQueue(demoted=False)
+            self.leave_feeds(pid, sid)
+        queue.held = True
+
+    def held(self):
+        return [pid for pid, queue in self.slow.items() if queue.held]
+
+    def release(self, pid, sid):
+        """End a hold. A client that isn't slow as well gets the latest of
+        what was queued and goes back on the feeds straight away."""
+        queue = self.slow.get(pid)
+        if queue is None or not queue.held:
+            return
+        queue.held = False
+        if queue.demoted:
+            return
+        del self.slow[pid]
+        if sid is None:
+            # Away; connect() puts it back in its rooms when it resumes
+            return
+        for event, payload, _ in queue.drain():
+            self.transport.emit(event, payload, to=sid)
+        self.enter_feeds(pid, sid)
+
+    def leave_feeds(self, pid, sid):
+        for name in self.rooms(pid):
+            if name in self.feeds:
+                self.transport.leave_room(sid, self.room(name))
+
+    def enter_feeds(self, pid, sid):
+        for name in self.rooms(pid):
+            if name in self.feeds:
+                self.transport.enter_room(sid, self.room(name))
+
+    def flush(self, pid, sid, queue, now):
+        queue.last_flush = now
+        for event, payload, _ in queue.drain():
+            self.transport.emit(event, payload, to=sid)
+        queue.healthy += 1
+        if queue.healthy >= RECOVER_FLUSHES:
+            del self.slow[pid]
+            self.enter_feeds(pid, sid)
+            logger.log('client_promoted', participant=pid, dropped=queue.dropped, coalesced=queue.coalesced)
+
+    def forget(self, pid):
+        self.slow.pop(pid, None)
+        self.backlogs.pop(pid, None)
+        self.peaks.pop(pid, None)
+        self.demotions.pop(pid, None)
+
+    def stats(self, now, top=20):
+        backlogs = list(self.backlogs.values())
+        slow = sorted(pid for pid, queue in self.slow.items() if queue.demoted)
+        worst = sorted(set(self.backlogs) | set(self.slow), key=lambda pid: -self.backlogs.get(pid, 0))[:top]
+        clients = []
+        for pid in worst:
+            packets = self.backlogs.get(pid, 0)
+            queue = self.slow.get(pid)
+            oldest = queue.oldest() if queue is not None else None
+            clients.append({
+                'id': pid,
+                'backlog': packets,
+                'peak': self.peaks.get(pid),
+                'slow': queue is not None and queue.demoted,
+                'held': queue is not None and queue.held,
+                'queued': len(queue) if queue is not None else 0,
+                'lag': round(now - oldest, 3) if oldest is not None else None,
+                'dropped': queue.dropped if queue is not None else 0,
+                'coalesced': queue.coalesced if queue is not None else 0,
+                'demotions': self.demotions.get(pid, 0)
+            })
+        return {
+            'backlogged': len(backlogs),
+            'slow': len(slow),
+            'held': len(self.held()),
+            'backlog': {
+                'p50': percentile(backlogs, 0.5),
+                'p99': percentile(backlogs, 0.99),
+                'max': max(backlogs) if backlogs else None
+            },
+            'slow_clients': slow,
+            'worst': clients
+        }
@@ -0,0 +1,185 @@
+"""Vector tiles for the course and for where runners are.
+
+Pages fetch only the tiles in their viewport instead of whole polylines or
+a message per marker, and every tile has a bounded size: course geometry
+within its buffer, or at most DENSITY_CELLS squared density cells.
+
+Course tiles (routes as lines, the start and a marker every MARKER_METERS
+as points) are cut once per event for every zoom in COURSE_ZOOMS and kept
+encoded; the course doesn't change during a race. Density tiles count
+runners in a DENSITY_CELLS x DENSITY_CELLS grid per tile, recounted from the
+tick every DENSITY_SECONDS. A tile's encoding is only dropped, and its ETag
+only changes, when its counts did, so pages re-polling the layer get 304s
+for everything else.
+"""
+import hashlib
+import math
+import secrets
+
+from geo import haversine
+import mvt
+
+COURSE_ZOOMS = (10, 18)
+DENSITY_ZOOMS = (10, 16)
+DENSITY_CELLS = 16
+DENSITY_SECONDS = 5
+MARKER_METERS = 1000
+# Geometry this far past a tile's edge (in tile units) is kept, so lines
+# and markers don't break at tile seams
+BUFFER = 64
+LAYERS = ('course', 'density')
+CONTENT_TYPE = 'application/vnd.mapbox-vector-tile'
+
+
+def mercator(lat, lng):
+    """Web Mercator position as fractions of the world, y down."""
+    lat = math.radians(max(min(lat, 85.0511), -85.0511))
+    return (lng + 180.0) / 360.0, (1.0 - math.asinh(math.tan(lat)) / math.pi) / 2.0
+
+
+def parse(path):
+    """(layer, z, x, y) from a /tiles/{layer}/{z}/{x}/{y}.mvt path, or None."""
+    if not path.startswith('/tiles/') or not path.endswith('.mvt'):
+        return None
+    parts = path[len('/tiles/'):-len('.mvt')].split('/')
+    if len(parts) != 4 or parts[0] not in LAYERS or not all(part.isdigit() for part in parts[1:]):
+        return None
+    return (parts[0],) + tuple(int(part) for part in parts[1:])
+
+
+def etag(data):
+    return '"%s"' % hashlib.sha1(data).hexdigest()[:16]
+
+
+class CourseTiles(object):
+
+    def __init__(self, route_points, zooms=COURSE_ZOOMS):
+        self.encoded = {}
+        self.etags = {}
+        for z in range(zooms[0], zooms[1] + 1):
+            tiles = {}
+            for name, points in route_points.items():
+                self.cut_line(tiles, z, name, points)
+                self.cut_markers(tiles, z, name, points)
+            for key, (lines, markers) in tiles.items():
+                data = mvt.tile([('routes', lines), ('checkpoints', markers)])
+                self.encoded[key] = data
+                self.etags[key] = etag(data)
+
+    def cut_line(self, tiles, z, name, points):
+        scale = (2 ** z) * mvt.EXTENT
+        line = []
+        for lat, lng in points:
+            fx, fy = mercator(lat, lng)
+            point = (int(round(fx * scale)), int(round(fy * scale)))
+            # Points that land on the same tile unit add nothing at this zoom
+            if not line or point != line[-1]:
+                line.append(point)
+        runs = {}
+        for a, b in zip(line, line[1:]):
+            x0, x1 = sorted((a[0], b[0]))
+            y0, y1 = sorted((a[1], b[1]))
+            for tx in range((x0 - BUFFER) // mvt.EXTENT, (x1 + BUFFER) // mvt.EXTENT + 1):
+                for ty in range((y0 - BUFFER) // mvt.EXTENT, (y1 + BUFFER) // mvt.EXTENT + 1):
+                    tile_runs = runs.setdefault((z, tx, ty), [])
+                    ox, oy = tx * mvt.EXTENT, ty * mvt.EXTENT
+                    a_local, b_local = (a[0] - ox, a[1] - oy), (b[0] - ox, b[1] - oy)
+                    if tile_runs and tile_runs[-1][-1] == a_local:
+                        tile_runs[-1].append(b_local)
+                    else:
+                        tile_runs.append([a_local, b_local])
+        length = sum(haversine(a, b) for a, b in zip(points, points[1:]))
+        for key, tile_runs in runs.items():
+            lines, _ = tiles.setdefault(key, ([], []))
+            lines.append((None, mvt.LINESTRING, tile_runs, {'name': name, 'km': round(length / 1000.0, 2)}))
+
+    def cut_markers(self, tiles, z, name, points):
+        scale = (2 ** z) * mvt.EXTENT
+        markers = [(points[0], {'route': name, 'kind': 'start'})]
+        walked = 0.0
+        next_marker = MARKER_METERS
+        for a, b in zip(points, points[1:]):
+            step = haversine(a, b)
+            while step and walked + step >= next_marker:
+                share = (next_marker - walked) / step
+                location = (a[0] + (b[0] - a[0]) * share, a[1] + (b[1] - a[1]) * share)
+                markers.append((location, {'route': name, 'kind': 'km', 'km': next_marker // 1000}))
+                next_marker += MARKER_METERS
+            walked += step
+        for (lat, lng), properties in markers:
+            fx, fy = mercator(lat, lng)
+            px, py = int(round(fx * scale)), int(round(fy * scale))
+            key = (z, px // mvt.EXTENT, py // mvt.EXTENT)
+            _, points_in_tile = tiles.setdefault(key, ([], []))
+            local = (px - key[1] * mvt.EXTENT, py - key[2] * mvt.EXTENT)
+            points_in_tile.append((None, mvt.POINT, [[local]], properties))
+
+    def tile(self, z, x, y):
+        """(encoded tile, ETag); empty outside the course."""
+        key = (z, x, y)
+        data = self.encoded.get(key, b'')
+        return data, self.etags.get(key, '"empty"')
+
+
+class DensityTiles(object):
+
+    def __init__(self, zooms=DENSITY_ZOOMS, refresh_seconds=DENSITY_SECONDS):
+        self.zooms = zooms
+        self.refresh_seconds = refresh_seconds
+        self.last = 0
+        # Per tile: {(cell x, cell y): runners}
+        self.counts = {}
+        self.encoded = {}
+        self.versions = {}
+        self.version = 0
+        # Keeps ETags from a previous server run from matching
+        self.token = secrets.token_hex(4)
+
+    def refresh(self, locations, now):
+        """Recount if DENSITY_SECONDS have passed. Returns the number of
+        tiles that changed."""
+        if now - self.last < self.refresh_seconds:
+            return 0
+        self.last = now
+        low, high = self.zooms
+        # Count in the finest grid, then halve it for each zoom out
+        scale = (2 ** high) * DENSITY_CELLS
+        cells = {}
+        for lat, lng in locations:
+            fx, fy = mercator(lat, lng)
+            cell = (int(fx * scale), int(fy * scale))
+            cells[cell] = cells.get(cell, 0) + 1
+        counts = {}
+        shift = DENSITY_CELLS.bit_length() - 1
+        for z in range(high, low - 1, -1):
+            for (cx, cy), count in cells.items():
+                tile = counts.setdefault((z, cx >> shift, cy >> shift), {})
+                cell = (cx & (DENSITY_CELLS - 1), cy & (DENSITY_CELLS - 1))
+                tile[cell] = tile.get(cell, 0) + count
+            coarser = {}
+            for (cx, cy), count in cells.items():
+                key = (cx >> 1, cy >> 1)
+                coarser[key] = coarser.get(key, 0) + count
+            cells = coarser
+
+        self.version += 1
+        changed = [key for key in set(counts) | set(self.counts) if counts.get(key) != self.counts.get(key)]
+        for key in changed:
+            self.encoded.pop(key, None)
+            self.versions[key] = self.version
+        self.counts = counts
+        return len(changed)
+
+    def tile(self, z, x, y):
+        """(encoded tile, ETag), encoded on first request after a change."""
+        key = (z, x, y)
+        data = self.encoded.get(key)
+        if data is None:
+            size = mvt.EXTENT // DENSITY_CELLS
+            features = []
+            for (cx, cy), count in sorted(self.counts.get(key, {}).items()):
+                x0, y0 = cx * size, cy * size
+                ring = [(x0, y0), (x0 + size, y0), (x0 + size, y0 + size), (x0, y0 + size)]
+                features.append((None, mvt.POLYGON, [ring], {'count': count}))
+            data = self.encoded[key] = mvt.tile([('density', features)])
+        return data, '"%s-%d"' % (self.token, self.versions.get(key, 0))
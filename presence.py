@@ -0,0 +1,126 @@
+"""Who is in a race, with a grace period for dropped connections.
+
+Participants are known by a stable ID: the session ID of their first
+connection. A page that reconnects with its resume token within
+GRACE_SECONDS gets its old ID back, so the race keeps its state and nobody
+else hears it left. Departures that outlive the grace period, and brand new
+participants, are reported to everyone as one diff per tick, so a cell tower
+dropping thousands of phones costs one broadcast rather than one each.
+
+Counts per kind are kept as participants come and go instead of being
+recounted.
+"""
+import secrets
+
+GRACE_SECONDS = 45
+
+
+class Presence(object):
+
+    def __init__(self, grace_seconds=GRACE_SECONDS):
+        self.grace_seconds = grace_seconds
+        self.participants = {}
+        self.sessions = {}
+        self.tokens = {}
+        self.resume = {}
+        self.rooms = {}
+        self.kinds = {}
+        self.departing = {}
+        self.counts = {'connected': 0, 'away': 0, 'runner': 0, 'crew': 0}
+        self.joined = []
+        self.left = []
+        self.changed = False
+
+    def __len__(self):
+        # Participants away but within the grace period still count
+        return len(self.sessions)
+
+    def connect(self, sid, token=None):
+        """Bind a new socket. Returns (participant ID, resumed)."""
+        pid = self.resume.get(token) if token else None
+        resumed = pid is not None
+        if resumed:
+            old = self.sessions[pid]
+            self.participants.pop(old, None)
+            if self.departing.pop(pid, None) is not None:
+                self.counts['away'] -= 1
+            else:
+                # Reconnected before the old socket's disconnect arrived
+                self.counts['connected'] -= 1
+        else:
+            pid = sid
+            token = secrets.token_urlsafe(16)
+            self.tokens[pid] = token
+            self.resume[token] = pid
+            self.rooms[pid] = set()
+            self.kinds[pid] = set()
+            self.joined.append(pid)
+        self.participants[sid] = pid
+        self.sessions[pid] = sid
+        self.counts['connected'] += 1
+        self.changed = True
+        return pid, resumed
+
+    def disconnect(self, sid, now):
+        """Start the grace period for a socket's participant. Returns the
+        participant ID, or None if the participant has already moved on to
+        a newer socket."""
+        pid = self.participants.pop(sid, None)
+        if pid is None or self.sessions.get(pid) != sid:
+            return None
+        self.departing[pid] = now + self.grace_seconds
+        self.counts['connected'] -= 1
+        self.counts['away'] += 1
+        self.changed = True
+        return pid
+
+    def participant(self, sid):
+        return self.participants.get(sid)
+
+    def session(self, pid):
+        """The participant's current socket, or None for a room name."""
+        return self.sessions.get(pid)
+
+    def holder(self, token):
+        """The participant a resume token belongs to, if still known."""
+        return self.resume.get(token) if token else None
+
+    def token(self, pid):
+        return self.tokens.get(pid)
+
+    def enter(self, pid, room):
+        self.rooms[pid].add(room)
+
+    def exit(self, pid, room):
+        self.rooms[pid].discard(room)
+
+    def mark(self, pid, kind):
+        """Count the participant as a runner or crew, once."""
+        kinds = self.kinds[pid]
+        if kind not in kinds:
+            kinds.add(kind)
+            self.counts[kind] += 1
+            self.changed = True
+
+    def expire(self, now):
+        """Participants whose grace period has run out, now gone for good."""
+        gone = [pid for pid, deadline in self.departing.items() if deadline <= now]
+        for pid in gone:
+            del self.departing[pid]
+            del self.sessions[pid]
+            del self.rooms[pid]
+            del self.resume[self.tokens.pop(pid)]
+            for kind in self.kinds.pop(pid):
+                self.counts[kind] -= 1
+            self.counts['away'] -= 1
+            self.left.append(pid)
+            self.changed = True
+        return gone
+
+    def diff(self):
+        """This tick's joins, leaves and counts, or None if nothing changed."""
+        if not self.changed:
+            return None
+        diff = {'joined': self.joined, 'left': self.left, 'counts': dict(self.counts)}
+        self.joined, self.left, self.changed = [], [], False
+        return diff
@@ -0,0 +1,96 @@
+"""On-demand statistical profiler for the live server.
+
+While a profile runs, a real OS thread samples the hub thread's Python stack
+every SAMPLE_SECONDS. With green threads or coroutines that is whichever
+handler holds the hub at that moment, so sampling one thread covers all of
+them. Each sample is tagged with the Socket.IO handler it is inside, found
+by walking the stack for a RaceEvent method, so nothing is instrumented and
+an idle profiler costs nothing.
+
+Output is collapsed stacks ("tag;outer;...;inner count" per line), which
+flamegraph.pl and speedscope render as a flame graph, or a JSON summary.
+"""
+from collections import Counter
+import os
+import sys
+import time
+
+from race import HANDLERS
+
+SAMPLE_SECONDS = 0.005
+MAX_SECONDS = 60
+MAX_DEPTH = 128
+
+# RaceEvent method -> tag; handler methods are tagged with their event name
+TAGS = dict((method, event) for event, method in HANDLERS.items())
+TAGS.update({'connect': 'connect', 'disconnect': 'disconnect', 'tick': 'tick'})
+RACE_FILE = 'race.py'
+# Leaf frames that mean the hub is waiting for I/O, not working
+IDLE_FILES = ('selectors.py', os.path.join('eventlet', 'hubs'))
+
+
+def frame_label(code):
+    return '%s:%s' % (os.path.basename(code.co_filename), getattr(code, 'co_qualname', code.co_name))
+
+
+class SamplingProfiler(object):
+
+    def __init__(self, hub_thread, interval=SAMPLE_SECONDS):
+        self.hub_thread = hub_thread
+        self.interval = interval
+        self.running = False
+
+    def claim(self):
+        """Reserve the profiler from the hub; one profile at a time."""
+        if self.running:
+            return False
+        self.running = True
+        return True
+
+    def profile(self, seconds, sleep):
+        """Sample for `seconds` and return a Counter of (tag, stack) tuples.
+        Call claim() first; this runs on a thread that isn't the hub."""
+        counts = Counter()
+        try:
+            deadline = time.monotonic() + min(seconds, MAX_SECONDS)
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(self.hub_thread)
+                if frame is not None:
+                    counts[self.sample(frame)] += 1
+                del frame
+                sleep(self.interval)
+        finally:
+            self.running = False
+        return counts
+
+    def sample(self, frame):
+        idle = any(part in frame.f_code.co_filename for part in IDLE_FILES)
+        stack = []
+        tag = None
+        while frame is not None and len(stack) < MAX_DEPTH:
+            code = frame.f_code
+            if tag is None and code.co_filename.endswith(RACE_FILE) and code.co_name in TAGS:
+                tag = TAGS[code.co_name]
+            stack.append(frame_label(code))
+            frame = frame.f_back
+        stack.reverse()
+        return tag or ('idle' if idle else 'other'), tuple(stack)
+
+
+def collapsed(counts):
+    return ''.join('%s;%s %d\n' % (tag, ';'.join(stack), count)
+                   for (tag, stack), count in counts.most_common())
+
+
+def summary(counts, top=20):
+    total = sum(counts.values()) or 1
+    by_tag = Counter()
+    for (tag, _), count in counts.items():
+        by_tag[tag] += count
+    return {
+        'samples': sum(counts.values()),
+        'handlers': [{'handler': tag, 'samples': count, 'share': round(count / float(total), 4)}
+                     for tag, count in by_tag.most_common()],
+        'top_stacks': [{'handler': tag, 'samples': count, 'stack': list(stack)}
+                       for (tag, stack), count in counts.most_common(top)]
+    }
@@ -0,0 +1,932 @@
+"""Per-event race state and the logic behind the Socket.IO handlers.
+
+Everything one race needs (participants, incidents, courses, analytics,
+trails) lives on a RaceEvent, so several races can share a deployment
+without sharing fan-out: every broadcast goes to a room prefixed with the
+event ID. The transport only has to provide emit(), enter_room() and
+leave_room() keyed by session ID, and backlog() and drop_queued() over each
+client's send queue (see outbox), so this module doesn't depend on any
+particular Socket.IO server.
+
+Race state is keyed by participant ID rather than session ID, so a page
+that reconnects within the presence grace period carries on where it was;
+emit(), join() and leave() map participants to their current socket.
+"""
+from datetime import datetime
+import os
+import time
+
+from clustering import ClusterIndex
+import corridor
+from geo import LocalProjection, haversine
+from stationary import FixRings
+from tracks import TrackStore
+from smoothing import KalmanBank
+from dispatch import AlertDispatcher
+from incidents import IncidentBoard
+from logs import logger
+from presence import Presence
+from outbox import Outbox
+from freshness import Freshness
+from spectators import SpectatorFeed
+from aidcover import Coverage
+import history
+import cadence
+import incidents
+import overlays
+
+DEFAULT_ROUTE = '10k'
+
+# Raw fixes are queued by the handlers and smoothed in one batch per tick;
+# everything downstream (broadcasts, clustering, analytics) sees the
+# filtered position. Fixes implying more than MAX_SPEED m/s are outliers.
+MAX_SPEED = {'runner': 8.0, 'walk': 4.0, 'bike': 15.0}
+
+# Crews zoomed in past this level get individual runner_update messages,
+# everyone else gets cluster_update once per tick
+CLUSTER_MAX_ZOOM = 16
+
+# Runners further than OFF_COURSE_METERS from their registered course for
+# OFF_COURSE_SECONDS are reported to every crew
+OFF_COURSE_METERS = 50
+OFF_COURSE_SECONDS = 60
+
+# Runners whose recent fixes stay within STATIONARY_METERS for
+# STATIONARY_SECONDS (spread and end-to-end displacement both) while on
+# course, and nowhere near an aid station in that time, are raised as
+# suspected emergencies to crews within NEARBY_CREW_METERS
+STATIONARY_SECONDS = 120
+STATIONARY_METERS = 15
+RING_INTERVAL = 10
+NEARBY_CREW_METERS = 1500
+AID_STATION_METERS = 50
+
+# Emergency alerts skip the tick: they are sent straight away with an ack
+# per crew, retried every ALERT_RETRY_SECONDS, and hop-timed end to end
+ALERT_RETRY_SECONDS = 5
+ALERT_MAX_ATTEMPTS = 4
+
+# Smoothed fixes applied per step of the tick; see RaceEvent.tick
+TICK_FIXES = 500
+
+# Reporting-interval hints are recomputed this often and sent when they change
+REPORT_HINT_SECONDS = 5
+
+# Breadcrumb trails, freed TRACK_RETENTION seconds after a participant's last fix
+TRACK_RETENTION = 6 * 3600
+TRACK_SWEEP_SECONDS = 60
+
+# First-aid coverage gaps are re-reported to crews at most this often, and
+# only when some part of the course got a different best ETA
+COVERAGE_SECONDS = 10
+
+# Rooms, per event
+EVERYONE = 'all'
+CREW_ROOM = 'crews'
+RUNNER_ROOM = 'runners'
+RUNNER_FEED = 'runner_feed'
+# Everyone gets crew positions; slow clients are taken off both feeds
+POSITION_FEED = 'positions'
+FEEDS = (RUNNER_FEED, POSITION_FEED)
+# What those feeds carry, and what an emergency alert goes ahead of
+POSITION_EVENTS = ('runner_update', 'crew_update', 'cluster_update')
+
+# Socket.IO events handled by RaceEvent methods, shared by every server mode
+HANDLERS = {
+    'runner_location': 'runner_location',
+    'crew_location': 'crew_location',
+    'emergency_request': 'emergency_request',
+    'emergency_claim': 'emergency_claim',
+    'emergency_on_scene': 'emergency_on_scene',
+    'emergency_release': 'emergency_release',
+    'emergency_resolved': 'emergency_resolved',
+    'map_view': 'map_view',
+    'freshness': 'freshness_report',
+    'get_initial_data': 'initial_data'
+}
+
+
+def in_bounds(location, bounds):
+    if not bounds:
+        return True
+    south, west, north, east = bounds
+    return south <= location[0] <= north and west <= location[1] <= east
+
+
+class RaceEvent(object):
+
+    def __init__(self, event_id, route_points, transport, analytics=None, clock=time.time, build_corridors=None,
+                 offload=None):
+        self.id = event_id
+        # clock() is the time everywhere below; a simulation passes its own
+        self.clock = clock
+        self.route_points = route_points
+        self.transport = transport
+        self.default_route = DEFAULT_ROUTE if DEFAULT_ROUTE in route_points else next(iter(route_points))
+        self.presence = Presence()
+        self.outbox = Outbox(transport, self.presence.session, lambda pid: self.presence.rooms.get(pid, ()),
+                             self.room, FEEDS)
+        self.last_active = self.clock()
+
+        # In-memory storage
+        self.users = {}
+        self.crews = {}
+        self.emergencies = {}
+        self.incident_board = IncidentBoard(self.emergencies, clock)
+
+        start = route_points[self.default_route][0]
+        self.projection = LocalProjection(*start)
+        self.kalman = KalmanBank()
+        self.pending_fixes = []
+
+        self.cluster_index = ClusterIndex(max_zoom=CLUSTER_MAX_ZOOM)
+        self.map_views = {}
+
+        # Off-course checks start once the corridors exist. Servers build them
+        # up front (EventRegistry.prepare); build_corridors(route_points,
+        # done) covers a course that isn't ready yet, off the hub. Without it
+        # a new course is rasterised right here
+        self.off_course = {}
+        self.off_course_job = None
+        self.analytics = analytics
+        self.closed = False
+        self.corridors = corridor.cached(route_points)
+        if self.corridors is None and build_corridors is not None:
+            self.corridors = {}
+            build_corridors(route_points, self.corridors_ready)
+        elif self.corridors is None:
+            self.corridors = corridor.build(route_points)
+        self.use_analytics(analytics)
+
+        # Only the shared start/finish area is known from the KML so far
+        self.aid_stations = [start]
+        self.aid_station_xy = [self.projection.to_xy(*station) for station in self.aid_stations]
+        self.fix_rings = FixRings(capacity=STATIONARY_SECONDS // RING_INTERVAL + 1, min_interval=RING_INTERVAL)
+        self.ring_dirty = set()
+        self.suspected = {}
+
+        self.alert_dispatcher = AlertDispatcher(
+            self.send_alert,
+            retry_seconds=ALERT_RETRY_SECONDS,
+            max_attempts=ALERT_MAX_ATTEMPTS,
+            clock=clock
+        )
+
+        self.track_store = TrackStore()
+        self.last_track_sweep = 0
+        # Every raw fix, for incident investigation, written through offload
+        # (see EventRegistry) when there is one
+        self.history = history.History(history.run_directory(os.path.join(history.HISTORY_DIR, event_id),
+                                                             self.clock()), start, offload=offload)
+
+        self.report_intervals = {}
+        self.last_hints = 0
+
+        # GPS-to-screen delays, with each page's clock offset
+        self.freshness = Freshness(lambda event, payload, pid, callback: self.emit(event, payload, to=pid,
+                                                                                   callback=callback), clock)
+
+        # Vector tiles: the course's are cut on first request, density from the tick
+        self.course_tiles = None
+        self.density_tiles = overlays.DensityTiles()
+
+        # Runner positions for spectators, encoded once per round
+        self.spectator_feed = SpectatorFeed()
+
+        # Best first-aid crew ETA along the course, updated per crew fix
+        self.coverage = Coverage(route_points, self.projection)
+        self.coverage_report = None
+        self.coverage_version = 0
+        self.last_coverage = 0
+
+    def room(self, name):
+        return '%s/%s' % (self.id, name)
+
+    def emit(self, event, payload, to=None, skip_sid=None, callback=None):
+        # `to` is a room or a participant; a participant who is away gets
+        # nothing until they resume
+        presence = self.presence
+        to = (presence.session(to) or to) if to else self.room(EVERYONE)
+        if skip_sid is not None:
+            skip_sid = presence.session(skip_sid)
+        self.transport.emit(event, payload, to=to, skip_sid=skip_sid, callback=callback)
+
+    def publish(self, event, payload, feed, skip_sid=None):
+        # Position traffic, keyed by the participant it is about: slow
+        # clients get the latest one per participant from their queue
+        self.emit(event, payload, to=self.room(feed), skip_sid=skip_sid)
+        if self.outbox.slow:
+            self.outbox.push(event, payload, feed, payload['id'], self.clock(), skip=skip_sid)
+
+    def send_alert(self, event, payload, pid, callback):
+        # Ahead of position traffic: the crew's queued position packets are
+        # dropped and newer ones held in its outbox until the alert is done
+        # with (release_held); it gets the latest of them then
+        sid = self.presence.session(pid)
+        if sid is not None:
+            self.outbox.hold(pid, sid)
+            self.transport.drop_queued(sid, POSITION_EVENTS)
+        self.emit(event, payload, to=pid, callback=callback)
+
+    def release_held(self, now):
+        waiting = self.alert_dispatcher.waiting(now)
+        for pid in self.outbox.held():
+            if pid not in waiting:
+                self.outbox.release(pid, self.presence.session(pid))
+                view = self.map_views.get(pid)
+                if view is not None:
+                    # Its last cluster_update may have been dropped
+                    view['dirty'] = True
+
+    def join(self, pid, name):
+        self.presence.enter(pid, name)
+        if not self.outbox.holds(pid, name):
+            self.transport.enter_room(self.presence.session(pid), self.room(name))
+
+    def leave(self, pid, name):
+        self.presence.exit(pid, name)
+        self.transport.leave_room(self.presence.session(pid), self.room(name))
+
+    def course_overlay(self):
+        if self.course_tiles is None:
+            self.course_tiles = overlays.CourseTiles(self.route_points)
+        return self.course_tiles
+
+    def idle_since(self):
+        return None if self.presence else self.last_active
+
+    def use_analytics(self, pool):
+        # With a pool, corridor lookups (only those; see analytics) run in
+        # worker processes and land a tick later
+        self.analytics = pool
+        if pool is not None and self.off_course_job is None and self.corridors and not self.closed:
+            self.off_course_job = pool.corridor_job(self.corridors)
+
+    def corridors_ready(self, corridors):
+        self.corridors = corridors
+        self.use_analytics(self.analytics)
+
+    def close(self):
+        self.closed = True
+        if self.off_course_job is not None:
+            self.off_course_job.close()
+        self.history.close()
+
+    # Per-tick work
+
+    def tick(self, now, hub_lag=0.0):
+        """The tick's stages, as a generator that yields between them (and
+        every TICK_FIXES fixes) so the server can run handlers in between: a
+        big race's tick never holds the hub for its whole length. Handlers
+        that run in a gap only queue fixes or change state a later stage
+        reads afresh."""
+        # Alerts go out before any of this tick's position traffic
+        self.alert_dispatcher.retry(now)
+        self.release_held(now)
+        self.publish_presence(now)
+        yield
+        for _ in self.apply_fixes():
+            yield
+        changed = self.cluster_index.flush()
+        self.publish_clusters(changed)
+        yield
+        self.check_off_course(now)
+        yield
+        self.check_stationary(now)
+        self.sweep_tracks(now)
+        self.history.spill(now)
+        yield
+        self.density_tiles.refresh([user['location'] for user in self.users.values()], now)
+        yield
+        self.spectator_feed.publish([(user.get('bib'), user['location'][0], user['location'][1], user.get('route'))
+                                     for user in self.users.values()], now)
+        yield
+        self.publish_coverage(now)
+        self.publish_report_intervals(now, hub_lag)
+        yield
+        connected = list(self.presence.participants.values())
+        self.outbox.check(connected, now)
+        self.freshness.probe(connected, now)
+
+    def publish_coverage(self, now):
+        coverage = self.coverage
+        if now - self.last_coverage < COVERAGE_SECONDS or coverage.version == self.coverage_version:
+            return
+        self.last_coverage = now
+        self.coverage_version = coverage.version
+        # Crews on an incident aren't suggested anywhere else
+        busy = set(crew for crew, claimed in self.incident_board.by_crew.items() if claimed)
+        self.coverage_report = coverage.report(busy)
+        self.emit('coverage', self.coverage_report, to=self.room(CREW_ROOM))
+
+    def queue_fix(self, sid, kind, now, data, max_speed):
+        x, y = self.projection.to_xy(data['lat'], data['lng'])
+        self.history.add(sid, kind, now, x, y, data.get('bib'))
+        self.pending_fixes.append((sid, now, x, y, data.get('accuracy'), max_speed))
+
+    def apply_fixes(self):
+        # A generator, yielding every TICK_FIXES fixes; see tick()
+        batch, self.pending_fixes = self.pending_fixes, []
+        for i, (sid, (x, y, _, _)) in enumerate(self.kalman.update_batch(batch).items(), 1):
+            lat, lng = self.projection.to_latlng(x, y)
+            # Participants who left in a gap are skipped
+            if sid in self.users:
+                self.apply_runner_fix(sid, self.users[sid], lat, lng)
+            elif sid in self.crews:
+                self.apply_crew_fix(sid, self.crews[sid], lat, lng)
+            if i % TICK_FIXES == 0:
+                yield
+
+    def apply_runner_fix(self, sid, user, lat, lng):
+        now = user['timestamp']
+        user['location'] = [lat, lng]
+        self.track_store.add(self.track_store.key_for(sid, user['bib']), now, lat, lng)
+        if self.fix_rings.push(sid, now, *self.projection.to_xy(lat, lng)):
+            self.ring_dirty.add(sid)
+        self.cluster_index.update(sid, lat, lng, 'runner', user['emergency'])
+
+        # Broadcast to crews that are zoomed in far enough to show runners individually
+        update = {
+            'id': sid,
+            'location': [lat, lng],
+            'emergency': user['emergency']
+        }
+        stamps = self.freshness.emitted(sid, self.clock())
+        if stamps is not None:
+            update['stamps'] = stamps
+        self.publish('runner_update', update, RUNNER_FEED, skip_sid=sid)
+
+    def apply_crew_fix(self, sid, crew, lat, lng):
+        crew['location'] = [lat, lng]
+        self.coverage.update(sid, crew)
+        self.track_store.add(self.track_store.key_for(sid), crew['timestamp'], lat, lng)
+        if crew['sharing']:
+            self.cluster_index.update(sid, lat, lng, 'crew', info={
+                'transport': crew['transport'],
+                'first_aid': crew['first_aid']
+            })
+        else:
+            self.cluster_index.remove(sid)
+
+        # Broadcast to all
+        update = {
+            'id': sid,
+            'location': [lat, lng],
+            'transport': crew['transport'],
+            'first_aid': crew['first_aid'],
+            'sharing': crew['sharing']
+        }
+        stamps = self.freshness.emitted(sid, self.clock())
+        if stamps is not None:
+            update['stamps'] = stamps
+        self.publish('crew_update', update, POSITION_FEED)
+
+    def publish_presence(self, now):
+        for pid in self.presence.expire(now):
+            self.depart(pid)
+        diff = self.presence.diff()
+        if diff is not None:
+            self.emit('presence', diff)
+
+    def publish_clusters(self, changed):
+        # Crews looking at the same view share one query result
+        results = {}
+        for sid, view in list(self.map_views.items()):
+            if view['zoom'] > CLUSTER_MAX_ZOOM or not (changed or view['dirty']):
+                continue
+            key = (view['zoom'], tuple(view['bounds'] or ()))
+            if key not in results:
+                results[key] = self.cluster_index.query(view['zoom'], view['bounds'])
+            view['dirty'] = False
+            if not self.outbox.send(sid, 'cluster_update', results[key], None, self.clock()):
+                self.emit('cluster_update', results[key], to=sid)
+
+    def check_off_course(self, now):
+        # One corridor lookup pass per route instead of one per fix
+        batches = {}
+        for sid, user in list(self.users.items()):
+            batch = batches.get(user['route'])
+            if batch is None:
+                batch = batches[user['route']] = ([], [], [])
+            batch[0].append(sid)
+            batch[1].append(user['location'][0])
+            batch[2].append(user['location'][1])
+
+        job = self.off_course_job
+        if job is None:
+            for route, (sids, lats, lngs) in batches.items():
+                corridor = self.corridors.get(route)
+                if corridor is not None:
+                    self.apply_off_course(now, route, sids, corridor.distances(lats, lngs))
+            return
+
+        results = job.collect()
+        if results is not None:
+            for route, sids, distances in results:
+                self.apply_off_course(now, route, sids, distances)
+        job.submit(batches)
+
+    def apply_off_course(self, now, route, sids, distances):
+        users = self.users
+        for sid, distance in zip(sids, distances):
+            if sid not in users:
+                # Left while the batch was with the workers
+                continue
+            state = self.off_course.get(sid)
+            if distance <= OFF_COURSE_METERS:
+                if state is not None:
+                    del self.off_course[sid]
+                    if state['alerted']:
+                        self.emit('off_course_cleared', {'id': sid}, to=self.room(CREW_ROOM))
+            elif state is None:
+                self.off_course[sid] = {'since': now, 'alerted': False}
+            else:
+                state['distance'] = distance
+                if not state['alerted'] and now - state['since'] >= OFF_COURSE_SECONDS:
+                    state['alerted'] = True
+                    self.emit('off_course_alert', {
+                        'id': sid,
+                        'route': route,
+                        'location': self.users[sid]['location'],
+                        'distance': distance,
+                        'since': datetime.fromtimestamp(state['since']).isoformat()
+                    }, to=self.room(CREW_ROOM))
+
+    def check_stationary(self, now):
+        # Only runners that stored a new fix since last tick can change state
+        dirty = list(self.ring_dirty)
+        self.ring_dirty.clear()
+        for sid in dirty:
+            user = self.users.get(sid)
+            if user is None or sid not in self.fix_rings:
+                continue
+            span, spread, displacement = self.fix_rings.window(sid)
+            # Spread alone is small for a runner who waited a while and has
+            # just set off; displacement isn't
+            stationary = (span >= STATIONARY_SECONDS and spread < STATIONARY_METERS
+                          and displacement < STATIONARY_METERS)
+            if sid in self.suspected:
+                if not stationary or user['emergency']:
+                    self.clear_suspected(sid)
+            elif (stationary and not user['emergency'] and sid not in self.off_course
+                    and not self.fix_rings.visited(sid, self.aid_station_xy, AID_STATION_METERS)):
+                self.raise_suspected(sid, user['location'], now - span)
+
+    def raise_suspected(self, sid, location, since):
+        nearby = [cid for cid, crew in self.crews.items()
+                  if haversine(crew['location'], location) <= NEARBY_CREW_METERS]
+        self.suspected[sid] = {'id': sid, 'location': location, 'since': since, 'crews': nearby}
+        self.history.note(self.clock(), 'suspected_emergency', id=sid, location=location, since=since, crews=nearby)
+        alert = {
+            'id': sid,
+            'location': location,
+            'since': datetime.fromtimestamp(since).isoformat()
+        }
+        # Nobody close enough: fall back to every crew rather than no one
+        if not nearby:
+            self.emit('suspected_emergency', alert, to=self.room(CREW_ROOM))
+        for cid in nearby:
+            self.emit('suspected_emergency', alert, to=cid)
+
+    def clear_suspected(self, sid):
+        state = self.suspected.pop(sid, None)
+        if state is None:
+            return
+        self.history.note(self.clock(), 'suspected_cleared', id=sid)
+        if not state['crews']:
+            self.emit('suspected_emergency_cleared', {'id': sid}, to=self.room(CREW_ROOM))
+        for cid in state['crews']:
+            self.emit('suspected_emergency_cleared', {'id': sid}, to=cid)
+
+    def sweep_tracks(self, now):
+        if now - self.last_track_sweep >= TRACK_SWEEP_SECONDS:
+            self.last_track_sweep = now
+            self.track_store.expire(now - TRACK_RETENTION)
+
+    def publish_report_intervals(self, now, hub_lag):
+        if now - self.last_hints < REPORT_HINT_SECONDS:
+            return
+        self.last_hints = now
+        # Views showing markers individually; a crew with no bounds sees everyone
+        views = [(viewer, view['bounds']) for viewer, view in self.map_views.items()
+                 if view['zoom'] > CLUSTER_MAX_ZOOM]
+        everyone = any(not bounds for _, bounds in views)
+        hints = []
+        for pid, user in self.users.items():
+            location = user['location']
+            visible = everyone or any(in_bounds(location, bounds) for _, bounds in views)
+            emergency = user['emergency'] or pid in self.emergencies
+            hints.append((pid, cadence.interval(emergency, visible, self.kalman.speed(pid), hub_lag)))
+        for pid, crew in self.crews.items():
+            # A crew's own page draws it from local GPS, so only other crews'
+            # views count; a crew working an incident reports like an emergency
+            location = crew['location']
+            visible = any(viewer != pid and in_bounds(location, bounds) for viewer, bounds in views)
+            busy = bool(self.incident_board.claimed_by(pid))
+            hints.append((pid, cadence.interval(busy, visible, self.kalman.speed(pid), hub_lag)))
+        intervals = self.report_intervals
+        for pid, seconds in hints:
+            if intervals.get(pid) != seconds:
+                intervals[pid] = seconds
+                self.emit('report_interval', {'seconds': seconds}, to=pid)
+
+    def publish_incident_status(self, incident):
+        status = {
+            'id': incident['id'],
+            'status': incident['status'],
+            'crew': incident['crew']
+        }
+        self.emit('emergency_status', status, to=self.room(CREW_ROOM))
+        self.emit('emergency_status', status, to=incident['id'])
+        self.history.note(self.clock(), 'emergency_status', **status)
+
+    def release_incident(self, incident_id):
+        incident = self.incident_board.transition(incident_id, incidents.RAISED)
+        if incident is not None:
+            self.publish_incident_status(incident)
+        return incident
+
+    def crew_recipients(self):
+        # Crew pages announce themselves with map_view even before they have GPS
+        return set(self.crews) | set(self.map_views)
+
+    # Handlers
+
+    def connect(self, sid, resume=None):
+        """Returns the participant ID, the same one as before if `resume` is
+        the token of a participant still within the grace period."""
+        self.last_active = self.clock()
+        pid, resumed = self.presence.connect(sid, resume)
+        if resumed:
+            for name in self.presence.rooms[pid]:
+                self.transport.enter_room(sid, self.room(name))
+            # The new page starts from its default cadence and on the live feeds
+            self.report_intervals.pop(pid, None)
+            self.outbox.forget(pid)
+        else:
+            self.join(pid, EVERYONE)
+            self.join(pid, POSITION_FEED)
+        # The page keeps the token to resume with after a dropped connection
+        self.transport.emit('session', {'id': pid, 'token': self.presence.token(pid), 'resumed': resumed}, to=sid)
+        return pid
+
+    def disconnect(self, sid):
+        # Nothing is torn down until the grace period runs out
+        self.last_active = self.clock()
+        self.presence.disconnect(sid, self.last_active)
+
+    def depart(self, sid):
+        # Leaves are announced in the tick's presence diff
+        self.users.pop(sid, None)
+        self.crews.pop(sid, None)
+        self.coverage.remove(sid)
+        self.off_course.pop(sid, None)
+        self.suspected.pop(sid, None)
+        self.fix_rings.discard(sid)
+        self.ring_dirty.discard(sid)
+        self.kalman.discard(sid)
+        self.report_intervals.pop(sid, None)
+        self.outbox.forget(sid)
+        self.freshness.forget(sid)
+        self.alert_dispatcher.forget(sid)
+
+        # The grace period is over, so the crew isn't coming back: anything it
+        # had claimed or was on scene at goes back to raised for another crew
+        for incident_id in self.incident_board.claimed_by(sid):
+            incident = self.incident_board.reopen(incident_id)
+            if incident is not None:
+                self.publish_incident_status(incident)
+        self.cluster_index.remove(sid)
+        self.map_views.pop(sid, None)
+
+    def add_runner(self, sid, lat, lng):
+        # Shown at the raw fix until the first tick filters it
+        user = self.users[sid] = {'id': sid, 'type': 'runner', 'location': [lat, lng]}
+        self.join(sid, RUNNER_ROOM)
+        self.presence.mark(sid, 'runner')
+        return user
+
+    def runner_location(self, sid, data):
+        now = self.clock()
+        user = self.users.get(sid)
+        if user is None:
+            user = self.add_runner(sid, data['lat'], data['lng'])
+        user.update({
+            'emergency': data.get('emergency', False),
+            'route': data.get('route', self.default_route),
+            'bib': data.get('bib'),
+            'timestamp': now
+        })
+        self.queue_fix(sid, 'runner', now, data, MAX_SPEED['runner'])
+        self.freshness.received(sid, 'runner', data, now)
+
+    def crew_location(self, sid, data):
+        now = self.clock()
+        crews = self.crews
+        known = sid in crews
+        location = crews[sid]['location'] if known else [data['lat'], data['lng']]
+        crews[sid] = {
+            'id': sid,
+            'type': 'crew',
+            'location': location,
+            'transport': data.get('transport', 'walk'),
+            'first_aid': data.get('first_aid', False),
+            'sharing': data.get('sharing', True),
+            'timestamp': now
+        }
+        # Transport and first aid count straight away; the position on the next tick
+        self.coverage.update(sid, crews[sid])
+        self.queue_fix(sid, 'crew', now, data, MAX_SPEED.get(crews[sid]['transport'], MAX_SPEED['walk']))
+        self.freshness.received(sid, 'crew', data, now)
+
+        if not known:
+            self.join(sid, CREW_ROOM)
+            self.presence.mark(sid, 'crew')
+            # Crews on older pages never send map_view, keep them on the full feed
+            if sid not in self.map_views:
+                self.join(sid, RUNNER_FEED)
+            if self.coverage_report is not None:
+                self.emit('coverage', self.coverage_report, to=sid)
+
+    def ingest_fixes(self, sid, fixes, data, now):
+        """Merge (t, lat, lng, accuracy) fixes a page buffered while offline.
+
+        Every fix goes into the track, in order, in one pass. Only fixes newer
+        than the participant's last position go through the filter and the
+        stationary check, so the next tick broadcasts just the newest.
+        """
+        batch = {}
+        for t, lat, lng, accuracy in fixes:
+            # Later duplicates win; phone clocks ahead of ours are clamped
+            batch[min(t, now)] = (min(t, now), lat, lng, accuracy)
+        fixes = sorted(batch.values())
+        if not fixes:
+            return {'fixes': 0, 'stored': 0, 'applied': 0}
+
+        crew = self.crews.get(sid)
+        if crew is not None:
+            record, max_speed = crew, MAX_SPEED.get(crew['transport'], MAX_SPEED['walk'])
+            key = self.track_store.key_for(sid)
+        else:
+            record = self.users.get(sid)
+            if record is None:
+                _, lat, lng, _ = fixes[-1]
+                record = self.add_runner(sid, lat, lng)
+                record.update({'emergency': False, 'route': data.get('route', self.default_route), 'timestamp': None})
+            if data.get('bib'):
+                record['bib'] = data['bib']
+            record.setdefault('bib', None)
+            max_speed = MAX_SPEED['runner']
+            key = self.track_store.key_for(sid, record['bib'])
+
+        stored = self.track_store.merge(key, [(t, lat, lng) for t, lat, lng, _ in fixes])
+        last = record['timestamp'] or 0
+        newer = []
+        kind = 'runner' if crew is None else 'crew'
+        for fix in fixes:
+            t, lat, lng, accuracy = fix
+            x, y = self.projection.to_xy(lat, lng)
+            self.history.add(sid, kind, t, x, y, record.get('bib'))
+            if t <= last:
+                continue
+            newer.append(fix)
+            self.pending_fixes.append((sid, t, x, y, accuracy, max_speed))
+            if crew is None and self.fix_rings.push(sid, t, x, y):
+                self.ring_dirty.add(sid)
+        if newer:
+            record['timestamp'] = newer[-1][0]
+        return {'fixes': len(fixes), 'stored': stored, 'applied': len(newer)}
+
+    def emergency_request(self, sid, data):
+        alert = {
+            'id': sid,
+            'location': data['location'],
+            'timestamp': datetime.fromtimestamp(self.clock()).isoformat()
+        }
+        sos_sent = self.freshness.to_server(sid, data.get('sent_at'))
+        bib = self.users[sid]['bib'] if sid in self.users else None
+
+        incident = self.emergencies.get(sid)
+        if incident is not None and incident['crew'] is not None:
+            # Pressed again while a crew is on it: the incident keeps its
+            # crew, and only that crew hears about the new location
+            self.incident_board.raise_incident(sid, data['location'])
+            repeat = dict(alert, status=incident['status'], crew=incident['crew'])
+            self.alert_dispatcher.raise_alert(sid, repeat, [incident['crew']], sos_sent=sos_sent)
+            self.history.note(self.clock(), 'emergency_repeated', id=sid, location=data['location'], bib=bib,
+                              crew=incident['crew'])
+            return
+
+        # Notify all crews first, each one acknowledged, then the other runners
+        self.alert_dispatcher.raise_alert(sid, alert, self.crew_recipients(), sos_sent=sos_sent)
+        self.emit('emergency_alert', alert, to=self.room(RUNNER_ROOM), skip_sid=sid)
+
+        self.incident_board.raise_incident(sid, data['location'])
+        self.history.note(self.clock(), 'emergency_raised', id=sid, location=data['location'], bib=bib)
+
+        # Update user status
+        if sid in self.users:
+            self.users[sid]['emergency'] = True
+        self.cluster_index.set_emergency(sid, True)
+        self.clear_suspected(sid)
+
+    def emergency_claim(self, sid, data):
+        incident = self.incident_board.transition(data.get('id'), incidents.CLAIMED, crew=sid)
+        if incident is None:
+            return {'ok': False, 'incident': self.emergencies.get(data.get('id'))}
+        # The claiming crew is on it: everyone else gets one status change
+        # instead of further retries of the full alert
+        self.alert_dispatcher.settle(incident['id'])
+        self.publish_incident_status(incident)
+        return {'ok': True, 'incident': incident}
+
+    def emergency_on_scene(self, sid, data):
+        incident = self.emergencies.get(data.get('id'))
+        if incident is None or incident['crew'] != sid:
+            return {'ok': False, 'incident': incident}
+        if self.incident_board.transition(incident['id'], incidents.ON_SCENE) is None:
+            return {'ok': False, 'incident': incident}
+        self.publish_incident_status(incident)
+        return {'ok': True, 'incident': incident}
+
+    def emergency_release(self, sid, data):
+        incident = self.emergencies.get(data.get('id'))
+        if incident is None or incident['crew'] != sid:
+            return {'ok': False, 'incident': incident}
+        if self.release_incident(incident['id']) is None:
+            return {'ok': False, 'incident': incident}
+        return {'ok': True, 'incident': incident}
+
+    def emergency_resolved(self, sid, data):
+        runner_id = data.get('id', sid)
+        incident = self.emergencies.get(runner_id)
+
+        # Once claimed, only the runner or the claiming crew can close it
+        if incident is not None and incident['crew'] not in (None, sid) and sid != runner_id:
+            return {'ok': False, 'incident': incident}
+
+        # Remove from emergencies
+        if incident is not None:
+            self.incident_board.transition(runner_id, incidents.RESOLVED)
+            self.history.note(self.clock(), 'emergency_resolved', id=runner_id, by=sid)
+        self.alert_dispatcher.cancel(runner_id)
+
+        # Update user status
+        if runner_id in self.users:
+            self.users[runner_id]['emergency'] = False
+        self.cluster_index.set_emergency(runner_id, False)
+
+        # Notify all
+        self.emit('emergency_resolved', {'id': runner_id})
+        return {'ok': True}
+
+    def map_view(self, sid, data):
+        zoom = int(data.get('zoom', CLUSTER_MAX_ZOOM + 1))
+        bounds = data.get('bounds')
+        if sid not in self.map_views:
+            self.join(sid, CREW_ROOM)
+        self.map_views[sid] = {'zoom': zoom, 'bounds': bounds, 'dirty': True}
+
+        if zoom > CLUSTER_MAX_ZOOM:
+            # Switching to individual markers: send the runners in view once
+            self.join(sid, RUNNER_FEED)
+            users = self.users
+            return {
+                'clustered': False,
+                'users': {uid: users[uid] for uid in users if in_bounds(users[uid]['location'], bounds)}
+            }
+
+        self.leave(sid, RUNNER_FEED)
+        return {'clustered': True}
+
+    def freshness_report(self, sid, data):
+        # Crew pages report when stamped position updates reached them
+        if sid in self.crews or sid in self.map_views:
+            self.freshness.receipts(sid, 'crew', data.get('receipts'))
+
+    def initial_data(self, sid, data=None):
+        off_course = self.off_course
+        return {
+            'users': dict(self.users),
+            'crews': dict(self.crews),
+            'emergencies': self.emergencies,
+            'off_course': {uid: off_course[uid] for uid in off_course if off_course[uid]['alerted']}
+        }
+
+
+class EventRegistry(object):
+    """Live RaceEvents by ID, created on first use and evicted when idle.
+
+    load_routes(event_id) returns the event's route_points, or None for an
+    event that doesn't exist.
+    """
+
+    def __init__(self, transport, load_routes, idle_seconds=1800, pinned=(), analytics=None, hub_lag=None,
+                 clock=time.time, offload=None):
+        self.transport = transport
+        self.clock = clock
+        # offload(fn, arg, done) runs fn(arg) off the hub and done(result)
+        # back on it; course corridors are built and history written that way
+        self.offload = offload
+        # Courses whose corridors are being built, with who waits for them
+        self.building = {}
+        # hub_lag() returns the server's recent hub lag in seconds
+        self.hub_lag = hub_lag
+        self.analytics = analytics
+        self.load_routes = load_routes
+        self.idle_seconds = idle_seconds
+        self.pinned = set(pinned)
+        self.events = {}
+        self.sid_events = {}
+
+    def __len__(self):
+        return len(self.events)
+
+    def use_analytics(self, pool):
+        self.analytics = pool
+        for event in self.events.values():
+            event.use_analytics(pool)
+
+    def get(self, event_id):
+        event = self.events.get(event_id)
+        if event is None:
+            routes = self.load_routes(event_id)
+            if not routes:
+                return None
+            build = self.build_corridors if self.offload is not None else None
+            event = self.events[event_id] = RaceEvent(event_id, routes, self.transport, self.analytics, self.clock,
+                                                      build, self.offload)
+        return event
+
+    def prepare(self, event_ids):
+        """Start building every listed event's course corridors off the hub,
+        so no race has to wait for them when its first page connects."""
+        if self.offload is None:
+            return
+        for event_id in event_ids:
+            routes = self.load_routes(event_id)
+            if routes and corridor.cached(routes) is None:
+                self.build_corridors(routes, lambda corridors: None)
+
+    def build_corridors(self, route_points, done):
+        # One build per course at a time; later callers wait for the same one
+        key = corridor.course_key(route_points)
+        waiting = self.building.get(key)
+        if waiting is not None:
+            waiting.append(done)
+            return
+        waiting = self.building[key] = [done]
+
+        def built(corridors):
+            del self.building[key]
+            for done in waiting:
+                done(corridors)
+        self.offload(corridor.build, route_points, built)
+
+    def join(self, sid, event_id, resume=None):
+        event = self.get(event_id)
+        if event is not None:
+            self.sid_events[sid] = event
+            event.connect(sid, resume)
+        return event
+
+    def for_sid(self, sid):
+        return self.sid_events.get(sid)
+
+    def handle(self, sid, name, data=None):
+        """Run the handler for Socket.IO event `name` on the sender's event."""
+        event = self.sid_events.get(sid)
+        pid = event.presence.participant(sid) if event is not None else None
+        if pid is not None:
+            return getattr(event, HANDLERS[name])(pid, data or {})
+
+    def leave(self, sid):
+        event = self.sid_events.pop(sid, None)
+        if event is not None:
+            event.disconnect(sid)
+        return event
+
+    def close(self):
+        for event in self.events.values():
+            event.close()
+
+    def evict_idle(self, now):
+        for event_id, event in list(self.events.items()):
+            since = event.idle_since()
+            if event_id not in self.pinned and since is not None and now - since >= self.idle_seconds:
+                del self.events[event_id]
+                event.close()
+
+    def tick(self, now):
+        """Tick every live event, yielding after each stage of each one (see
+        RaceEvent.tick) so the caller can let handlers run in between and a
+        busy race can't starve a quiet one or the handlers."""
+        lag = self.hub_lag() if self.hub_lag is not None else 0.0
+        for event in list(self.events.values()):
+            try:
+                for _ in event.tick(now, lag):
+                    yield event
+            except Exception as e:
+                logger.error('tick_failed', race=event.id, error=repr(e))
+            yield event
+        self.evict_idle(now)
@@ -0,0 +1,141 @@
+"""Constant-velocity Kalman filters for every participant, updated per tick.
+
+State lives in flat arrays indexed by slot, in local metres. Measurement
+noise is isotropic (the browser reports one accuracy radius), so the x and y
+axes share a single 2x2 covariance per slot: [[p00, p01], [p01, p11]].
+
+Fixes implying a speed above the participant's mode limit are rejected as
+outliers. After MAX_REJECTS rejections in a row the filter is assumed to be
+the thing that is wrong (e.g. after a tunnel) and is reset to the fix.
+"""
+from array import array
+import math
+
+# White-noise acceleration, m/s^2
+ACCEL_NOISE = 1.5
+# Jitter tolerated on top of the speed limit before a fix counts as a jump
+GATE_METERS = 30.0
+MAX_REJECTS = 5
+DEFAULT_ACCURACY = 20.0
+MIN_ACCURACY = 5.0
+
+
+class KalmanBank(object):
+
+    def __init__(self, accel_noise=ACCEL_NOISE):
+        self.q = accel_noise * accel_noise
+        self.slots = {}
+        self.free = []
+        self.t = array('d')
+        self.x = array('d')
+        self.y = array('d')
+        self.vx = array('d')
+        self.vy = array('d')
+        self.p00 = array('d')
+        self.p01 = array('d')
+        self.p11 = array('d')
+        self.rejects = array('l')
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _slot(self, pid):
+        slot = self.slots.get(pid)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                slot = len(self.t)
+                for column in (self.t, self.x, self.y, self.vx, self.vy,
+                               self.p00, self.p01, self.p11):
+                    column.append(0.0)
+                self.rejects.append(0)
+            self.slots[pid] = slot
+            self._reset(slot, None, 0.0, 0.0, 0.0)
+        return slot
+
+    def _reset(self, slot, t, x, y, r):
+        self.t[slot] = -1.0 if t is None else t
+        self.x[slot] = x
+        self.y[slot] = y
+        self.vx[slot] = 0.0
+        self.vy[slot] = 0.0
+        self.p00[slot] = r
+        self.p01[slot] = 0.0
+        self.p11[slot] = 25.0
+        self.rejects[slot] = 0
+
+    def update_batch(self, fixes):
+        """Filter a tick's fixes in arrival order.
+
+        fixes is a sequence of (pid, t, x, y, accuracy, max_speed). Returns
+        {pid: (x, y, vx, vy)} with the latest filtered state of every
+        participant that had at least one accepted fix.
+        """
+        q = self.q
+        t_, x_, y_, vx_, vy_ = self.t, self.x, self.y, self.vx, self.vy
+        p00_, p01_, p11_, rejects = self.p00, self.p01, self.p11, self.rejects
+        out = {}
+        for pid, t, zx, zy, accuracy, max_speed in fixes:
+            slot = self._slot(pid)
+            r = max(accuracy or DEFAULT_ACCURACY, MIN_ACCURACY) ** 2
+            last = t_[slot]
+            if last < 0:
+                self._reset(slot, t, zx, zy, r)
+                out[pid] = (zx, zy, 0.0, 0.0)
+                continue
+
+            dt = t - last
+            if dt < 0:
+                # Older than what the filter has already seen
+                continue
+
+            x, y = x_[slot], y_[slot]
+            if math.hypot(zx - x, zy - y) > max_speed * dt + GATE_METERS:
+                rejects[slot] += 1
+                if rejects[slot] < MAX_REJECTS:
+                    continue
+                self._reset(slot, t, zx, zy, r)
+                out[pid] = (zx, zy, 0.0, 0.0)
+                continue
+            rejects[slot] = 0
+
+            # Predict
+            vx, vy = vx_[slot], vy_[slot]
+            p00, p01, p11 = p00_[slot], p01_[slot], p11_[slot]
+            dt2 = dt * dt
+            x += vx * dt
+            y += vy * dt
+            p00 += 2 * dt * p01 + dt2 * p11 + q * dt2 * dt2 / 4
+            p01 += dt * p11 + q * dt2 * dt / 2
+            p11 += q * dt2
+
+            # Update with the position measurement
+            s = p00 + r
+            k0 = p00 / s
+            k1 = p01 / s
+            ix, iy = zx - x, zy - y
+            x += k0 * ix
+            y += k0 * iy
+            vx += k1 * ix
+            vy += k1 * iy
+            p11 -= k1 * p01
+            p00 *= 1 - k0
+            p01 *= 1 - k0
+
+            t_[slot], x_[slot], y_[slot], vx_[slot], vy_[slot] = t, x, y, vx, vy
+            p00_[slot], p01_[slot], p11_[slot] = p00, p01, p11
+            out[pid] = (x, y, vx, vy)
+        return out
+
+    def speed(self, pid):
+        """Filtered speed in m/s, or None for a participant without a fix."""
+        slot = self.slots.get(pid)
+        if slot is None or self.t[slot] < 0:
+            return None
+        return math.hypot(self.vx[slot], self.vy[slot])
+
+    def discard(self, pid):
+        slot = self.slots.pop(pid, None)
+        if slot is not None:
+            self.free.append(slot)
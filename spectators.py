@@ -0,0 +1,190 @@
+"""Read-only spectator feed over Server-Sent Events.
+
+Friends and family following runners don't join Socket.IO: they would add
+rooms, acks and per-client queues to the fan-out crews depend on. Instead
+the tick hands each event's SpectatorFeed the runners' positions every
+SPECTATOR_SECONDS, and the feed encodes what changed once, as one SSE frame
+per bib. Every spectator response is built by joining those same bytes:
+all of a round's frames for the whole field, or just the frames for the
+bibs in ?bib=. Spectators never call into the RaceEvent.
+
+A connecting spectator gets the latest frame per bib, then each round
+after it; Last-Event-ID resumes from the backlog of recent rounds. The
+number of open spectator streams is capped at SPECTATOR_MAX per server.
+Each open stream also takes one of the server's connections (gunicorn's
+--worker-connections under eventlet, 1000 unless set), so that limit has
+to cover SPECTATOR_MAX on top of every runner and crew socket; otherwise a
+full house of spectators locks race participants out. railway.json sizes
+it for 10,000 runners, their crews and SPECTATOR_MAX.
+"""
+from collections import deque
+import json
+import os
+import threading
+
+SPECTATOR_MAX = int(os.environ.get('SPECTATOR_MAX', '2000'))
+SPECTATOR_SECONDS = 2
+# A comment line this often keeps proxies from closing quiet streams
+KEEPALIVE_SECONDS = 15
+# Rounds kept for reconnecting spectators
+BACKLOG = 30
+MAX_BIBS = 20
+# ~1 m; positions that round the same aren't sent again
+PRECISION = 5
+RETRY_MS = 5000
+CONTENT_TYPE = 'text/event-stream'
+HEADERS = {'Content-Type': CONTENT_TYPE, 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+KEEPALIVE = b': keepalive\n\n'
+# Sent before a snapshot: drop every runner shown and take the snapshot's
+RESET = b'event: reset\ndata: {}\n\n'
+
+
+def frame(event, seq, data):
+    return ('id: %d\nevent: %s\ndata: %s\n\n' % (seq, event, json.dumps(data, separators=(',', ':')))).encode()
+
+
+def parse_bibs(value):
+    """A set of bibs from ?bib=12,345, None for all, or raises ValueError."""
+    if not value:
+        return None
+    bibs = set(bib.strip() for bib in value.split(',') if bib.strip())
+    if not bibs or len(bibs) > MAX_BIBS or any(len(bib) > 16 for bib in bibs):
+        raise ValueError('bib is up to %d comma-separated bib numbers' % MAX_BIBS)
+    return bibs
+
+
+def parse_seq(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class SpectatorFeed(object):
+
+    def __init__(self, publish_seconds=SPECTATOR_SECONDS, backlog=BACKLOG):
+        self.publish_seconds = publish_seconds
+        self.last = 0
+        self.seq = 0
+        # bib -> (lat, lng, route) as last published, and its encoded frame
+        self.state = {}
+        self.latest = {}
+        # (seq, {bib: frame}, all frames joined), oldest first
+        self.rounds = deque(maxlen=backlog)
+        self.snapshot_all = None
+
+    def publish(self, runners, now):
+        """runners are (bib, lat, lng, route). Encodes what changed since the
+        last round, if SPECTATOR_SECONDS have passed."""
+        if now - self.last < self.publish_seconds:
+            return
+        self.last = now
+        current = {}
+        for bib, lat, lng, route in runners:
+            if bib is not None and bib != '':
+                current[str(bib)] = (round(lat, PRECISION), round(lng, PRECISION), route)
+        seq = self.seq + 1
+        frames = {}
+        for bib, position in current.items():
+            if self.state.get(bib) != position:
+                lat, lng, route = position
+                frames[bib] = frame('runner', seq, {'bib': bib, 'lat': lat, 'lng': lng, 'route': route, 't': int(now)})
+        for bib in self.state:
+            if bib not in current:
+                frames[bib] = frame('gone', seq, {'bib': bib})
+        if not frames:
+            return
+        latest = dict(self.latest)
+        for bib, encoded in frames.items():
+            if bib in current:
+                latest[bib] = encoded
+            else:
+                latest.pop(bib, None)
+        self.state = current
+        self.latest = latest
+        self.snapshot_all = None
+        self.rounds.append((seq, frames, b''.join(frames.values())))
+        self.seq = seq
+
+    def snapshot(self, bibs=None):
+        """(seq, bytes): the latest frame for every bib, or for `bibs`."""
+        seq, latest = self.seq, self.latest
+        if bibs is not None:
+            return seq, b''.join(latest[bib] for bib in bibs if bib in latest)
+        snapshot = self.snapshot_all
+        if snapshot is None or snapshot[0] != seq:
+            snapshot = self.snapshot_all = (seq, b''.join(latest.values()))
+        return snapshot
+
+    def since(self, seq, bibs=None):
+        """(seq, bytes) for the rounds after `seq`, or None if they are no
+        longer in the backlog and the spectator needs a snapshot."""
+        if seq == self.seq:
+            return seq, b''
+        rounds = list(self.rounds)
+        # A seq ahead of ours is from before a restart
+        if seq > self.seq or not rounds or rounds[0][0] > seq + 1:
+            return None
+        chunks = []
+        for round_seq, frames, joined in rounds:
+            if round_seq <= seq:
+                continue
+            if bibs is None:
+                chunks.append(joined)
+            else:
+                chunks.extend(frames[bib] for bib in bibs if bib in frames)
+        return rounds[-1][0], b''.join(chunks)
+
+    def stream(self, bibs=None, last_seq=None):
+        """A generator of SSE chunks for one spectator: it yields a chunk, the
+        server waits SPECTATOR_SECONDS, and asks for the next."""
+        update = self.since(last_seq, bibs) if last_seq is not None else None
+        if update is None:
+            seq, chunk = self.snapshot(bibs)
+            chunk = RESET + chunk
+        else:
+            seq, chunk = update
+        yield ('retry: %d\n\n' % RETRY_MS).encode() + chunk
+        quiet = 0
+        while True:
+            update = self.since(seq, bibs)
+            if update is None:
+                seq, chunk = self.snapshot(bibs)
+                chunk = RESET + chunk
+            else:
+                seq, chunk = update
+            if chunk:
+                quiet = 0
+                yield chunk
+                continue
+            quiet += self.publish_seconds
+            if quiet >= KEEPALIVE_SECONDS:
+                quiet = 0
+                yield KEEPALIVE
+            else:
+                yield b''
+
+
+class Gate(object):
+    """Counts open spectator streams against SPECTATOR_MAX."""
+
+    def __init__(self, limit=SPECTATOR_MAX):
+        self.limit = limit
+        self.open = 0
+        self.refused = 0
+        self.lock = threading.Lock()
+
+    def admit(self):
+        with self.lock:
+            if self.open >= self.limit:
+                self.refused += 1
+                return False
+            self.open += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.open -= 1
+
+    def stats(self):
+        return {'open': self.open, 'limit': self.limit, 'refused': self.refused}
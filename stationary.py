@@ -0,0 +1,131 @@
+"""Fixed-size ring buffers of recent fixes for stationary-runner detection.
+
+Every runner gets one slot of `capacity` entries in shared flat arrays, so
+memory per runner is constant and slots are recycled when runners leave.
+Fixes closer together than `min_interval` are not stored, which makes a full
+ring cover at least (capacity - 1) * min_interval seconds. Running sums of
+x, y, x^2 and y^2 are kept per slot, so the window's spread is updated in
+O(1) per fix without rescanning the ring.
+"""
+from array import array
+import math
+
+
+class FixRings(object):
+
+    def __init__(self, capacity=13, min_interval=10.0):
+        self.capacity = capacity
+        self.min_interval = min_interval
+        self.slots = {}
+        self.free = []
+        # Per-entry columns, slot-major: entry i of slot s is at s * capacity + i
+        self.t = array('d')
+        self.x = array('d')
+        self.y = array('d')
+        # Per-slot ring state and running window sums
+        self.head = array('l')
+        self.count = array('l')
+        self.sums = array('d')
+
+    def __contains__(self, pid):
+        return pid in self.slots
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _slot(self, pid):
+        slot = self.slots.get(pid)
+        if slot is not None:
+            return slot
+        if self.free:
+            slot = self.free.pop()
+            self.head[slot] = 0
+            self.count[slot] = 0
+            for i in range(slot * 4, slot * 4 + 4):
+                self.sums[i] = 0.0
+        else:
+            slot = len(self.head)
+            zeros = array('d', [0.0]) * self.capacity
+            self.t.extend(zeros)
+            self.x.extend(zeros)
+            self.y.extend(zeros)
+            self.head.append(0)
+            self.count.append(0)
+            self.sums.extend(array('d', [0.0]) * 4)
+        self.slots[pid] = slot
+        return slot
+
+    def push(self, pid, t, x, y):
+        """Store a fix (x/y in metres). Returns False if it was too soon."""
+        slot = self._slot(pid)
+        cap = self.capacity
+        base = slot * cap
+        head, n = self.head[slot], self.count[slot]
+        if n and t - self.t[base + (head + n - 1) % cap] < self.min_interval:
+            return False
+
+        s = slot * 4
+        if n == cap:
+            # Evict the oldest fix from the window sums
+            ox, oy = self.x[base + head], self.y[base + head]
+            self.sums[s] -= ox
+            self.sums[s + 1] -= oy
+            self.sums[s + 2] -= ox * ox
+            self.sums[s + 3] -= oy * oy
+            i = base + head
+            self.head[slot] = (head + 1) % cap
+        else:
+            i = base + (head + n) % cap
+            self.count[slot] = n + 1
+
+        self.t[i] = t
+        self.x[i] = x
+        self.y[i] = y
+        self.sums[s] += x
+        self.sums[s + 1] += y
+        self.sums[s + 2] += x * x
+        self.sums[s + 3] += y * y
+        return True
+
+    def window(self, pid):
+        """(span_seconds, spread_metres, displacement_metres) for a runner.
+
+        spread is the RMS distance of the window's fixes from their mean,
+        displacement the straight-line distance from oldest to newest fix.
+        """
+        slot = self.slots[pid]
+        cap = self.capacity
+        base = slot * cap
+        head, n = self.head[slot], self.count[slot]
+        if not n:
+            return 0.0, 0.0, 0.0
+        old = base + head
+        new = base + (head + n - 1) % cap
+        s = slot * 4
+        mx, my = self.sums[s] / n, self.sums[s + 1] / n
+        var = self.sums[s + 2] / n - mx * mx + self.sums[s + 3] / n - my * my
+        return (
+            self.t[new] - self.t[old],
+            math.sqrt(max(var, 0.0)),
+            math.hypot(self.x[new] - self.x[old], self.y[new] - self.y[old])
+        )
+
+    def visited(self, pid, points, radius):
+        """True if any fix in the runner's window is within radius metres of
+        one of `points` (x, y)."""
+        slot = self.slots[pid]
+        cap = self.capacity
+        base = slot * cap
+        head, n = self.head[slot], self.count[slot]
+        for k in range(n):
+            i = base + (head + k) % cap
+            x, y = self.x[i], self.y[i]
+            for px, py in points:
+                if math.hypot(x - px, y - py) <= radius:
+                    return True
+        return False
+
+    def discard(self, pid):
+        slot = self.slots.pop(pid, None)
+        if slot is not None:
+            self.free.append(slot)
@@ -0,0 +1,59 @@
+"""Shared fixtures. The seeded simulator's planning transport stands in for
+Socket.IO, so tests drive the core exactly as bench_simulate.py does."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench_simulate  # noqa: E402
+from courses import DEFAULT_EVENT, load_routes  # noqa: E402
+import history  # noqa: E402
+from logs import logger  # noqa: E402
+import race  # noqa: E402
+
+
+class Race(object):
+    """One event on a virtual clock, with pages that join and send."""
+
+    def __init__(self):
+        self.now = bench_simulate.EPOCH
+        self.transport = bench_simulate.PlanningTransport(lambda: self.now)
+        self.registry = race.EventRegistry(self.transport, load_routes, pinned=[DEFAULT_EVENT],
+                                           clock=lambda: self.now)
+        self.event = self.registry.get(DEFAULT_EVENT)
+        self.course = bench_simulate.Course(self.event.route_points[self.event.default_route])
+
+    def connect(self, sid, role='runner'):
+        page = self.transport.pages[sid] = bench_simulate.Page(sid, role, 0.0)
+        page.connected = True
+        self.registry.join(sid, DEFAULT_EVENT)
+        return self.event.presence.participant(sid)
+
+    def send(self, sid, name, data=None):
+        return self.registry.handle(sid, name, data)
+
+    def tick(self):
+        self.now += bench_simulate.TICK_SECONDS
+        for _ in self.registry.tick(self.now):
+            pass
+        errors = [line for line in logger.drain().splitlines() if '"level": "error"' in line]
+        assert not errors, errors
+
+    def emitted(self, event):
+        return self.transport.events.get(event, [0, 0])[0]
+
+
+@pytest.fixture(autouse=True)
+def history_dir(tmp_path, monkeypatch):
+    directory = str(tmp_path / 'history')
+    monkeypatch.setattr(history, 'HISTORY_DIR', directory)
+    return directory
+
+
+@pytest.fixture
+def race_event():
+    harness = Race()
+    yield harness
+    harness.registry.close()
@@ -0,0 +1,58 @@
+import gzip
+import json
+
+import api
+
+
+def batch(race_event, pid, fixes, **extra):
+    body = dict({'token': race_event.event.presence.token(pid), 'fixes': fixes}, **extra)
+    return json.dumps(body).encode()
+
+
+def test_fix_batch_rejects_fixes_outside_the_allowed_ranges(race_event):
+    pid = race_event.connect('r1')
+    now = race_event.now
+    lat, lng = race_event.course.at(500)
+    fixes = [
+        [(now - 60) * 1000, lat, lng, 8],
+        [(now - 50) * 1000, lat, lng, 'NaN'],
+        [(now - 40) * 1000, 'NaN', lng],
+        [(now - api.MAX_BATCH_AGE - 60) * 1000, lat, lng],
+        [(now + api.MAX_BATCH_AHEAD + 60) * 1000, lat, lng],
+        [(now - 30) * 1000, 91.0, lng],
+        [(now - 20) * 1000, lat, 181.0],
+        [(now - 10) * 1000],
+        'not a fix',
+        None,
+    ]
+    result, status = api.fix_batch(race_event.event, batch(race_event, pid, fixes), now=now)
+    assert status == 200
+    assert result['rejected'] == 8
+    assert result['fixes'] == 2
+
+
+def test_fix_batch_takes_gzip(race_event):
+    pid = race_event.connect('r1')
+    lat, lng = race_event.course.at(500)
+    body = gzip.compress(batch(race_event, pid, [[(race_event.now - 5) * 1000, lat, lng]]))
+    result, status = api.fix_batch(race_event.event, body, 'gzip', now=race_event.now)
+    assert status == 200 and result['fixes'] == 1 and result['rejected'] == 0
+
+
+def test_fix_batch_refuses_bad_requests(race_event, monkeypatch):
+    pid = race_event.connect('r1')
+    event, now = race_event.event, race_event.now
+    assert api.fix_batch(None, b'{}')[1] == 404
+    assert api.fix_batch(event, b'{"fixes": [', now=now)[1] == 400
+    assert api.fix_batch(event, b'[]', now=now)[1] == 400
+    assert api.fix_batch(event, b'{"fixes": {}}', now=now)[1] == 400
+    assert api.fix_batch(event, b'not gzip', 'gzip', now=now)[1] == 400
+    assert api.fix_batch(event, json.dumps({'token': 'stolen', 'fixes': []}).encode(), now=now)[1] == 403
+    too_many = batch(race_event, pid, [[0, 0, 0]] * (api.MAX_BATCH_FIXES + 1))
+    assert api.fix_batch(event, too_many, now=now)[1] == 413
+    monkeypatch.setattr(api, 'MAX_BATCH_BYTES', 1024)
+    assert api.fix_batch(event, b' ' * 2048, now=now)[1] == 413
+    # Small on the wire, too big once inflated
+    bomb = gzip.compress(batch(race_event, pid, [[0, 0, 0]] * 500))
+    assert len(bomb) < 1024
+    assert api.fix_batch(event, bomb, 'gzip', now=now)[1] == 413
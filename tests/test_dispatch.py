@@ -0,0 +1,86 @@
+from dispatch import AlertDispatcher
+
+
+class Crews(object):
+    """Records every alert emit, with the ack callback to answer it."""
+
+    def __init__(self):
+        self.sent = []
+
+    def emit(self, event, payload, sid, callback):
+        self.sent.append((sid, payload['hops']['attempt'], callback))
+
+    def attempts(self, sid):
+        return [attempt for to, attempt, _ in self.sent if to == sid]
+
+    def ack(self, sid, received_at=None):
+        callback = [callback for to, _, callback in self.sent if to == sid][-1]
+        callback({'received_at': received_at} if received_at else None)
+
+
+def dispatcher(crews, now, max_attempts=3):
+    return AlertDispatcher(crews.emit, retry_seconds=5.0, max_attempts=max_attempts, clock=lambda: now[0])
+
+
+def test_alert_goes_out_at_once_to_every_crew():
+    crews, now = Crews(), [100.0]
+    d = dispatcher(crews, now)
+    d.raise_alert('r1', {'id': 'r1'}, ['c1', 'c2'], sos_sent=99.5)
+    assert sorted((sid, attempt) for sid, attempt, _ in crews.sent) == [('c1', 1), ('c2', 1)]
+    assert d.waiting(now[0]) == {'c1', 'c2'}
+
+
+def test_unacked_crews_are_retried_until_max_attempts():
+    crews, now = Crews(), [100.0]
+    d = dispatcher(crews, now)
+    d.raise_alert('r1', {'id': 'r1'}, ['c1', 'c2'])
+    now[0] = 102.0
+    crews.ack('c1')
+    d.retry(now[0])
+    assert crews.attempts('c2') == [1]
+    for t in (105.0, 110.0, 115.0, 120.0):
+        now[0] = t
+        d.retry(t)
+    assert crews.attempts('c1') == [1]
+    assert crews.attempts('c2') == [1, 2, 3]
+    # The last attempt's retry interval has run out too
+    assert d.waiting(now[0]) == set()
+
+
+def test_first_ack_sets_the_latencies():
+    crews, now = Crews(), [100.0]
+    d = dispatcher(crews, now)
+    d.raise_alert('r1', {'id': 'r1'}, ['c1', 'c2'], sos_sent=99.0)
+    now[0] = 101.5
+    crews.ack('c2', received_at=101000)
+    now[0] = 103.0
+    crews.ack('c1')
+    stats = d.stats()
+    assert stats['server_to_first_ack']['p50'] == 1.5
+    assert stats['sos_to_first_crew']['p50'] == 2.5
+    assert stats['incidents'][0]['hops']['first_crew'] == 'c2'
+    assert stats['incidents'][0]['acked'] == 2
+
+
+def test_settled_alert_stops_retrying_but_records_late_acks():
+    crews, now = Crews(), [100.0]
+    d = dispatcher(crews, now)
+    d.raise_alert('r1', {'id': 'r1'}, ['c1', 'c2'])
+    d.settle('r1')
+    now[0] = 110.0
+    d.retry(now[0])
+    assert crews.attempts('c1') == [1] and crews.attempts('c2') == [1]
+    assert d.waiting(now[0]) == set()
+    crews.ack('c2')
+    assert d.incidents['r1']['deliveries']['c2']['acked'] == 110.0
+
+
+def test_forget_drops_a_departed_crews_pending_delivery():
+    crews, now = Crews(), [100.0]
+    d = dispatcher(crews, now)
+    d.raise_alert('r1', {'id': 'r1'}, ['c1', 'c2'])
+    d.forget('c1')
+    now[0] = 110.0
+    d.retry(now[0])
+    assert crews.attempts('c1') == [1]
+    assert crews.attempts('c2') == [1, 2]
@@ -0,0 +1,73 @@
+import os
+
+import history
+
+ORIGIN = (51.5, -0.1)
+T0 = 1767254400.0
+
+
+def filled(directory, **kwargs):
+    h = history.History(directory, ORIGIN, bucket_seconds=60, hot_seconds=60, **kwargs)
+    # r1 runs east along y=0 at 2 m/s; r2 stands at (500, 0); c1 at (40, 30)
+    for i in range(300):
+        t = T0 + i
+        h.add('r1', 'runner', t, 2.0 * i, 0.0, bib='101')
+        h.add('r2', 'runner', t, 500.0, 0.0, bib='102')
+        h.add('c1', 'crew', t, 40.0, 30.0)
+    return h
+
+
+def ids(rows):
+    return [row['id'] for row in rows]
+
+
+def test_within_reads_memory_and_disk_alike(history_dir):
+    h = filled(os.path.join(history_dir, 'run'))
+    in_memory = h.within(0, 0, 60, T0, T0 + 300)
+    while h.spill(T0 + 1000):
+        pass
+    assert h.stats()['hot_rows'] == 0
+    assert h.within(0, 0, 60, T0, T0 + 300) == in_memory
+    assert ids(in_memory) == ['r1', 'c1']
+    r1 = in_memory[0]
+    assert (r1['first'], r1['last'], r1['closest'], r1['bib']) == (T0, T0 + 30, 0.0, '101')
+    assert ids(h.within(0, 0, 60, T0, T0 + 300, kind='crew')) == ['c1']
+    assert h.within(0, 0, 60, T0 + 100, T0 + 300, kind='runner') == []
+
+
+def test_nearest_widens_the_search_until_it_finds_enough(history_dir):
+    h = filled(os.path.join(history_dir, 'run'))
+    # In the last minute r1 ran from x=478 to x=598, through (480, 0)
+    nearest = h.nearest(480, 0, T0 + 299, count=2, window=60)
+    assert ids(nearest) == ['r1', 'r2']
+    assert [row['distance'] for row in nearest] == [0.0, 20.0]
+    assert ids(h.nearest(0, 0, T0 + 299, count=3, window=60)) == ['c1', 'r1', 'r2']
+    assert ids(h.nearest(0, 0, T0 + 299, count=3, window=60, kind='runner')) == ['r1', 'r2']
+
+
+def test_bucket_being_written_stays_queryable(history_dir):
+    jobs = []
+    h = filled(os.path.join(history_dir, 'run'), offload=lambda fn, arg, done: jobs.append((fn, arg, done)))
+    before = h.within(0, 0, 60, T0, T0 + 300)
+    assert h.spill(T0 + 1000)
+    assert not h.spill(T0 + 1000)
+    assert h.within(0, 0, 60, T0, T0 + 300) == before
+    fn, arg, done = jobs.pop()
+    done(fn(arg))
+    assert h.stats()['segments'] == 1
+    assert h.within(0, 0, 60, T0, T0 + 300) == before
+
+
+def test_history_reloads_from_disk_and_new_races_get_a_new_run(history_dir):
+    event = os.path.join(history_dir, 'spring')
+    run = history.run_directory(event, T0)
+    h = filled(run)
+    h.note(T0 + 10, 'emergency_raised', id='r1')
+    h.close()
+    assert history.runs(event) == [os.path.basename(run)]
+    again = history.History(run)
+    assert again.origin == list(ORIGIN)
+    assert ids(again.within(0, 0, 60, T0, T0 + 300)) == ['r1', 'c1']
+    written = history.last_written(run)
+    assert history.run_directory(event, written + 60) == run
+    assert history.run_directory(event, written + history.RESUME_SECONDS + 60) != run
@@ -0,0 +1,67 @@
+from incidents import CLAIMED, ON_SCENE, RAISED, RESOLVED, IncidentBoard
+
+
+def board(now=[1000.0]):
+    return IncidentBoard({}, clock=lambda: now[0])
+
+
+def test_claim_arrive_resolve():
+    b = board()
+    b.raise_incident('r1', [51.5, -0.1])
+    assert [i['id'] for i in b.with_status(RAISED)] == ['r1']
+    assert b.transition('r1', CLAIMED, crew='c1')['crew'] == 'c1'
+    assert b.claimed_by('c1') == ['r1']
+    assert b.transition('r1', ON_SCENE)['status'] == ON_SCENE
+    assert b.claimed_by('c1') == ['r1']
+    assert b.transition('r1', RESOLVED)['status'] == RESOLVED
+    assert 'r1' not in b.incidents
+    assert b.claimed_by('c1') == []
+    assert all(not ids for ids in b.by_status.values())
+
+
+def test_moves_not_in_the_state_machine_are_refused():
+    b = board()
+    b.raise_incident('r1', [0, 0])
+    assert b.transition('r1', ON_SCENE) is None
+    b.transition('r1', CLAIMED, crew='c1')
+    b.transition('r1', ON_SCENE)
+    assert b.transition('r1', RAISED) is None
+    assert b.transition('r1', CLAIMED, crew='c2') is None
+    assert b.transition('nobody', CLAIMED, crew='c1') is None
+    assert b.incidents['r1']['crew'] == 'c1'
+
+
+def test_released_claim_goes_back_to_raised_without_a_crew():
+    b = board()
+    b.raise_incident('r1', [0, 0])
+    b.transition('r1', CLAIMED, crew='c1')
+    incident = b.transition('r1', RAISED)
+    assert incident['status'] == RAISED and incident['crew'] is None
+    assert b.claimed_by('c1') == []
+    assert [i['id'] for i in b.with_status(RAISED)] == ['r1']
+
+
+def test_repeated_sos_keeps_status_and_crew_and_moves_the_incident():
+    now = [1000.0]
+    b = board(now)
+    b.raise_incident('r1', [51.5, -0.1])
+    b.transition('r1', CLAIMED, crew='c1')
+    now[0] = 1030.0
+    incident = b.raise_incident('r1', [51.501, -0.1])
+    assert incident['status'] == CLAIMED and incident['crew'] == 'c1'
+    assert incident['location'] == [51.501, -0.1] and incident['timestamp'] == 1030.0
+    assert b.with_status(RAISED) == []
+    assert b.claimed_by('c1') == ['r1']
+
+
+def test_reopen_when_the_crew_on_scene_leaves():
+    b = board()
+    b.raise_incident('r1', [0, 0])
+    assert b.reopen('r1') is None
+    b.transition('r1', CLAIMED, crew='c1')
+    b.transition('r1', ON_SCENE)
+    incident = b.reopen('r1')
+    assert incident['status'] == RAISED and incident['crew'] is None
+    assert b.claimed_by('c1') == []
+    assert [i['id'] for i in b.with_status(RAISED)] == ['r1']
+    assert b.with_status(ON_SCENE) == []
@@ -0,0 +1,17 @@
+import bench_simulate
+
+
+def run(seconds=240):
+    sim = bench_simulate.Simulation(runners=60, crews=4, emergencies=2, seed=3, route='10k')
+    try:
+        sim.run(seconds)
+    finally:
+        sim.close()
+    return sim
+
+
+def test_seeded_runs_plan_the_same_messages():
+    first, second = run(), run()
+    assert first.errors == 0 and second.errors == 0
+    assert first.transport.digest.hexdigest() == second.transport.digest.hexdigest()
+    assert first.transport.events['runner_update'][0] > 0
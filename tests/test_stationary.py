@@ -0,0 +1,50 @@
+import random
+
+from geo import haversine
+import race
+
+GPS_NOISE = 3.0
+REPORT_SECONDS = 10
+
+
+def walk(race_event, sid, distance_at, seconds, seed=1):
+    """Report the runner at course distance distance_at(elapsed) every
+    REPORT_SECONDS, with GPS noise, ticking every second."""
+    rng = random.Random(seed)
+    for elapsed in range(seconds):
+        if elapsed % REPORT_SECONDS == 0:
+            lat, lng = race_event.course.at(distance_at(elapsed))
+            race_event.send(sid, 'runner_location', {
+                'lat': lat + rng.gauss(0, GPS_NOISE) / 111320.0,
+                'lng': lng + rng.gauss(0, GPS_NOISE) / 111320.0,
+                'accuracy': 8, 'route': race_event.event.default_route, 'bib': '101'
+            })
+        race_event.tick()
+
+
+def test_slow_shuffle_out_of_the_start_area_is_not_an_emergency(race_event):
+    # The simulator's false positive: a runner inching along the course from
+    # the start spreads ~14 m over two minutes and is past the aid station
+    # radius by the time the window is full
+    pid = race_event.connect('r1')
+    walk(race_event, 'r1', lambda elapsed: 0.35 * elapsed, 400)
+    assert haversine(race_event.course.at(0.35 * 400), race_event.course.at(0)) > race.AID_STATION_METERS
+    assert pid not in race_event.event.suspected
+    assert race_event.emitted('suspected_emergency') == 0
+
+
+def test_waiting_at_the_start_is_not_an_emergency(race_event):
+    pid = race_event.connect('r1')
+    walk(race_event, 'r1', lambda elapsed: 20, race.STATIONARY_SECONDS * 3)
+    assert pid not in race_event.event.suspected
+
+
+def test_stopping_out_on_the_course_is_flagged_to_nearby_crews(race_event):
+    crew = race_event.connect('c1', 'crew')
+    lat, lng = race_event.course.at(3050)
+    race_event.send('c1', 'crew_location', {'lat': lat, 'lng': lng, 'transport': 'bike', 'first_aid': True})
+    pid = race_event.connect('r1')
+    walk(race_event, 'r1', lambda elapsed: 3000, race.STATIONARY_SECONDS + 30)
+    suspected = race_event.event.suspected.get(pid)
+    assert suspected is not None and suspected['crews'] == [crew]
+    assert race_event.emitted('suspected_emergency') == 1
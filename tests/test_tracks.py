@@ -0,0 +1,41 @@
+import math
+
+from tracks import TrackStore
+
+
+def fixes(store, start, end, step=5):
+    return [(store.epoch + t, 51.5 + t * 1e-6, -0.1) for t in range(start, end, step)]
+
+
+def test_older_batch_is_replayed_into_order():
+    store = TrackStore()
+    for t, lat, lng in fixes(store, 300, 400):
+        store.add('r1', t, lat, lng)
+    offline = fixes(store, 100, 300)
+    assert store.merge('r1', offline) == len(offline)
+    trail = store.trail('r1')
+    times = [t for t, _, _ in trail]
+    assert times == sorted(times)
+    assert times[0] == store.epoch + 100 and times[-1] == store.epoch + 395
+    assert len(trail) == len(offline) + 20
+    # The newest fix still decides when the track expires
+    assert store.last_seen['r1'] == store.epoch + 395
+
+
+def test_merge_skips_known_and_unstorable_fixes():
+    store = TrackStore()
+    for t, lat, lng in fixes(store, 100, 200):
+        store.add('r1', t, lat, lng)
+    before = store.trail('r1')
+    assert store.merge('r1', fixes(store, 100, 200)) == 0
+    bad = [(store.epoch + 50, float('nan'), 0.0), (store.epoch + 55, 95.0, 0.0), (math.inf, 51.5, -0.1)]
+    assert store.merge('r1', bad) == 0
+    assert store.trail('r1') == before
+
+
+def test_newer_batch_is_appended_without_a_replay():
+    store = TrackStore()
+    for t, lat, lng in fixes(store, 100, 200):
+        store.add('r1', t, lat, lng)
+    assert store.merge('r1', fixes(store, 200, 250)) == 10
+    assert len(store.trail('r1')) == 30
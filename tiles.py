@@ -0,0 +1,304 @@
+"""Map tiles served from a local disk cache instead of straight from OSM.
+
+At a crowded start area cellular data is saturated and every phone pulling
+its own tiles from tile.openstreetmap.org makes it worse (and OSM rate-limits
+bulk use). The pages load /tiles/{z}/{x}/{y}.png from us instead: a hit is a
+file read, a miss is fetched once from TILE_UPSTREAM over a small pool of
+kept-alive connections, and concurrent misses for the same tile wait for
+that one fetch. The cache is LRU-bounded to TILE_CACHE_MB.
+
+Run before the event to fill the cache for the course area:
+
+    python tiles.py --event default --zooms 12-18
+
+TILE_UPSTREAM can point at a local stand-in tile server for testing.
+"""
+import argparse
+from collections import OrderedDict
+import http.client
+import math
+import os
+import queue
+import threading
+from urllib.parse import urlsplit
+
+TILE_UPSTREAM = os.environ.get('TILE_UPSTREAM', 'https://tile.openstreetmap.org/{z}/{x}/{y}.png')
+TILE_CACHE_DIR = os.environ.get('TILE_CACHE_DIR', 'tiles')
+TILE_CACHE_MB = int(os.environ.get('TILE_CACHE_MB', '512'))
+
+MAX_ZOOM = 19
+PREFETCH_ZOOMS = (12, 18)
+# Course bounding box padding for prefetch, in metres
+PREFETCH_MARGIN = 500
+# Upstream connections shared by every request; OSM asks for no more than two
+CONNECTIONS = 2
+TIMEOUT = 10
+USER_AGENT = '10k-race-tracker/1.0 (tile cache)'
+CACHE_CONTROL = 'public, max-age=86400'
+
+
+def tile_of(lat, lng, zoom):
+    n = 2 ** zoom
+    x = int((lng + 180.0) / 360.0 * n)
+    lat = math.radians(max(min(lat, 85.0511), -85.0511))
+    y = int((1.0 - math.asinh(math.tan(lat)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def parse(path):
+    """(z, x, y) from a /tiles/{z}/{x}/{y}.png path, or None."""
+    if not path.startswith('/tiles/') or not path.endswith('.png'):
+        return None
+    parts = path[len('/tiles/'):-len('.png')].split('/')
+    if len(parts) != 3 or not all(part.isdigit() for part in parts):
+        return None
+    return tuple(int(part) for part in parts)
+
+
+def valid(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def course_tiles(route_points, zooms=PREFETCH_ZOOMS, margin=PREFETCH_MARGIN):
+    """Every tile covering the routes' bounding box, padded by `margin` metres."""
+    points = [point for points in route_points.values() for point in points]
+    lats, lngs = [p[0] for p in points], [p[1] for p in points]
+    pad_lat = margin / 111320.0
+    pad_lng = margin / (111320.0 * math.cos(math.radians(sum(lats) / len(lats))))
+    south, north = min(lats) - pad_lat, max(lats) + pad_lat
+    west, east = min(lngs) - pad_lng, max(lngs) + pad_lng
+    for z in range(zooms[0], zooms[1] + 1):
+        x0, y0 = tile_of(north, west, z)
+        x1, y1 = tile_of(south, east, z)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                yield z, x, y
+
+
+class Upstream(object):
+    """A fixed pool of kept-alive HTTP connections to the tile server."""
+
+    def __init__(self, template=TILE_UPSTREAM, connections=CONNECTIONS, timeout=TIMEOUT):
+        parts = urlsplit(template)
+        self.https = parts.scheme == 'https'
+        self.host = parts.netloc
+        self.path = parts.path + ('?' + parts.query if parts.query else '')
+        self.timeout = timeout
+        # A slot per connection: taking one blocks while all are busy
+        self.pool = queue.LifoQueue()
+        for _ in range(connections):
+            self.pool.put(None)
+
+    def connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, timeout=self.timeout)
+
+    def fetch(self, z, x, y):
+        """The tile's bytes, or None if upstream doesn't have it."""
+        path = self.path.format(z=z, x=x, y=y)
+        connection = self.pool.get()
+        try:
+            for attempt in range(2):
+                if connection is None:
+                    connection = self.connect()
+                try:
+                    connection.request('GET', path, headers={'User-Agent': USER_AGENT})
+                    response = connection.getresponse()
+                    body = response.read()
+                except (OSError, http.client.HTTPException):
+                    # A kept-alive connection the server has since closed
+                    connection.close()
+                    connection = None
+                    if attempt:
+                        raise
+                    continue
+                if response.will_close:
+                    connection.close()
+                    connection = None
+                if response.status == 200:
+                    return body
+                if response.status == 404:
+                    return None
+                raise OSError('upstream returned %d for %s' % (response.status, path))
+        finally:
+            self.pool.put(connection)
+
+
+class TileCache(object):
+
+    def __init__(self, directory=TILE_CACHE_DIR, upstream=None, max_bytes=TILE_CACHE_MB * 1024 * 1024):
+        self.directory = directory
+        self.upstream = upstream or Upstream()
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Relative path -> size, least recently used first
+        self.index = OrderedDict()
+        self.bytes = 0
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.load()
+
+    def load(self):
+        # Carry on from what earlier runs left, oldest access first
+        if not os.path.isdir(self.directory):
+            return
+        found = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.png'):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    found.append((stat.st_mtime, os.path.relpath(path, self.directory), stat.st_size))
+        for _, path, size in sorted(found):
+            self.index[path] = size
+            self.bytes += size
+
+    def path(self, z, x, y):
+        return os.path.join(str(z), str(x), '%d.png' % y)
+
+    def cached(self, z, x, y):
+        """The tile if it is on disk, without going upstream."""
+        path = self.path(z, x, y)
+        with self.lock:
+            if path not in self.index:
+                return None
+            self.index.move_to_end(path)
+        try:
+            full = os.path.join(self.directory, path)
+            with open(full, 'rb') as f:
+                data = f.read()
+            # mtime keeps the LRU order across restarts
+            os.utime(full)
+        except OSError:
+            with self.lock:
+                self.bytes -= self.index.pop(path, 0)
+            return None
+        self.hits += 1
+        return data
+
+    def get(self, z, x, y):
+        """The tile, fetching it on a miss. Blocks; concurrent misses for the
+        same tile share one fetch. Returns None if upstream has no such tile
+        and raises OSError if upstream can't be reached."""
+        data = self.cached(z, x, y)
+        if data is not None:
+            return data
+        path = self.path(z, x, y)
+        with self.lock:
+            waiting = self.in_flight.get(path)
+            if waiting is None:
+                waiting = self.in_flight[path] = [threading.Event(), None, None]
+                leader = True
+            else:
+                leader = False
+                self.coalesced += 1
+        done, _, _ = waiting
+        if not leader:
+            done.wait()
+            if waiting[2] is not None:
+                raise waiting[2]
+            return waiting[1]
+
+        self.misses += 1
+        try:
+            data = self.upstream.fetch(z, x, y)
+            if data is not None:
+                self.store(path, data)
+            waiting[1] = data
+            return data
+        except OSError as e:
+            self.errors += 1
+            waiting[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[path]
+            done.set()
+
+    def store(self, path, data):
+        full = os.path.join(self.directory, path)
+        directory = os.path.dirname(full)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        with open(full + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(full + '.tmp', full)
+        with self.lock:
+            self.bytes += len(data) - self.index.pop(path, 0)
+            self.index[path] = len(data)
+            evict = []
+            while self.bytes > self.max_bytes and len(self.index) > 1:
+                old, size = self.index.popitem(last=False)
+                self.bytes -= size
+                evict.append(old)
+        for old in evict:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:
+                pass
+
+    def prefetch(self, tiles, workers=CONNECTIONS):
+        """Fetch every tile not already cached. Returns (fetched, failed)."""
+        pending = queue.Queue()
+        for tile in tiles:
+            pending.put(tile)
+        counts = [0, 0]
+
+        def work():
+            while True:
+                try:
+                    z, x, y = pending.get_nowait()
+                except queue.Empty:
+                    return
+                if self.cached(z, x, y) is not None:
+                    continue
+                try:
+                    self.get(z, x, y)
+                    counts[0] += 1
+                except OSError:
+                    counts[1] += 1
+
+        threads = [threading.Thread(target=work) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return tuple(counts)
+
+    def stats(self):
+        return {
+            'tiles': len(self.index),
+            'mb': round(self.bytes / 1048576.0, 1),
+            'limit_mb': round(self.max_bytes / 1048576.0, 1),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'errors': self.errors
+        }
+
+
+def main():
+    from courses import DEFAULT_EVENT, load_routes
+    parser = argparse.ArgumentParser(description='Fill the tile cache for an event\'s course area.')
+    parser.add_argument('--event', default=DEFAULT_EVENT)
+    parser.add_argument('--zooms', default='%d-%d' % PREFETCH_ZOOMS, help='e.g. 12-18')
+    parser.add_argument('--margin', type=float, default=PREFETCH_MARGIN, help='metres around the course')
+    args = parser.parse_args()
+
+    routes = load_routes(args.event)
+    if not routes:
+        parser.error('no such event')
+    low, _, high = args.zooms.partition('-')
+    tiles = list(course_tiles(routes, (int(low), int(high or low)), args.margin))
+    cache = TileCache()
+    fetched, failed = cache.prefetch(tiles)
+    print('%d tiles for %s: %d fetched, %d failed, %d already cached; cache %s' % (
+        len(tiles), args.event, fetched, failed, len(tiles) - fetched - failed, cache.stats()))
+
+
+if __name__ == '__main__':
+    main()
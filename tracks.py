@@ -0,0 +1,212 @@
+"""Bounded breadcrumb trails for every participant.
+
+A track is a cascade of fixed-size rings (tiers). New fixes land in the first,
+full-resolution tier; when a tier is full its oldest fix is pushed down into
+the next, coarser tier, which only keeps it if enough time has passed since
+its own newest fix. The last tier simply drops what falls off the end.
+Capacities are fixed, so every track costs the same memory however long the
+event runs.
+
+Fixes are stored as int32 seconds since the store was created and int32
+microdegrees (~0.1 m), 12 bytes per stored fix, in flat slot-major arrays.
+"""
+from array import array
+import math
+import time
+
+from geo import encode_polyline
+
+# (capacity, minimum seconds between kept fixes) from newest to oldest:
+# 5 s for the last 5 minutes, 1 min for the next hour, 5 min for 6 hours
+TIERS = ((60, 5), (60, 60), (72, 300))
+
+INT32 = 2 ** 31 - 1
+
+
+class _Tier(object):
+
+    def __init__(self, capacity, interval):
+        self.capacity = capacity
+        self.interval = interval
+        self.t = array('i')
+        self.lat = array('i')
+        self.lng = array('i')
+        self.head = array('l')
+        self.count = array('l')
+
+    def grow(self):
+        zeros = array('i', [0]) * self.capacity
+        self.t.extend(zeros)
+        self.lat.extend(zeros)
+        self.lng.extend(zeros)
+        self.head.append(0)
+        self.count.append(0)
+
+    def reset(self, slot):
+        self.head[slot] = 0
+        self.count[slot] = 0
+
+    def last_time(self, slot):
+        n = self.count[slot]
+        if not n:
+            return None
+        return self.t[slot * self.capacity + (self.head[slot] + n - 1) % self.capacity]
+
+    def push(self, slot, t, lat, lng):
+        """Append a fix; returns the evicted oldest fix, if any."""
+        cap = self.capacity
+        base = slot * cap
+        head, n = self.head[slot], self.count[slot]
+        evicted = None
+        if n == cap:
+            i = base + head
+            evicted = (self.t[i], self.lat[i], self.lng[i])
+            self.head[slot] = (head + 1) % cap
+        else:
+            i = base + (head + n) % cap
+            self.count[slot] = n + 1
+        self.t[i] = t
+        self.lat[i] = lat
+        self.lng[i] = lng
+        return evicted
+
+    def entries(self, slot):
+        cap = self.capacity
+        base = slot * cap
+        head = self.head[slot]
+        for k in range(self.count[slot]):
+            i = base + (head + k) % cap
+            yield self.t[i], self.lat[i], self.lng[i]
+
+
+class TrackStore(object):
+    """Per-participant trails, looked up by participant ID or bib number."""
+
+    def __init__(self, tiers=TIERS):
+        self.epoch = int(time.time())
+        self.tiers = [_Tier(capacity, interval) for capacity, interval in tiers]
+        self.slots = {}
+        self.free = []
+        self.aliases = {}
+        self.bibs = {}
+        self.last_seen = {}
+
+    def __len__(self):
+        return len(self.slots)
+
+    def key_for(self, pid, bib=None):
+        """Track key for a participant, linking a new connection ID to the
+        track of a bib that was seen before."""
+        if bib:
+            key = self.bibs.setdefault(str(bib), 'bib:%s' % bib)
+            self.aliases[pid] = key
+            return key
+        return self.aliases.get(pid, pid)
+
+    def lookup(self, ident):
+        """Resolve a bib number or participant ID to a track key."""
+        ident = str(ident)
+        if ident in self.bibs:
+            return self.bibs[ident]
+        key = self.aliases.get(ident, ident)
+        return key if key in self.slots else None
+
+    def add(self, key, t, lat, lng):
+        slot = self.slots.get(key)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+                for tier in self.tiers:
+                    tier.reset(slot)
+            else:
+                slot = len(self.tiers[0].head)
+                for tier in self.tiers:
+                    tier.grow()
+            self.slots[key] = slot
+
+        fix = (int(t) - self.epoch, int(round(lat * 1e6)), int(round(lng * 1e6)))
+        self.last_seen[key] = t
+        for tier in self.tiers:
+            last = tier.last_time(slot)
+            if last is not None and fix[0] - last < tier.interval:
+                return
+            fix = tier.push(slot, *fix)
+            if fix is None:
+                return
+
+    def merge(self, key, fixes):
+        """Add chronological (timestamp, lat, lng) fixes that may predate the
+        track's newest, e.g. a batch buffered offline. Timestamps already in
+        the track are skipped; the track is rebuilt in order only if needed.
+        Returns how many fixes were new. Fixes that can't be stored (not
+        finite, or out of int32 range) are skipped."""
+        existing = self.trail(key)
+        known = set(int(t) for t, _, _ in existing)
+        fresh = []
+        for t, lat, lng in fixes:
+            if not self.storable(t, lat, lng):
+                continue
+            if int(t) not in known:
+                known.add(int(t))
+                fresh.append((t, lat, lng))
+        if not fresh:
+            return 0
+        if existing and fresh[0][0] < existing[-1][0]:
+            # Out of order: replay old and new together through the tiers.
+            # Everything is checked above, so the reset can't lose the trail
+            merged = sorted(existing + fresh)
+            slot = self.slots[key]
+            for tier in self.tiers:
+                tier.reset(slot)
+            fresh = merged
+            count = len(fresh) - len(existing)
+        else:
+            count = len(fresh)
+        last = self.last_seen.get(key)
+        for t, lat, lng in fresh:
+            self.add(key, t, lat, lng)
+        if last is not None and last > self.last_seen[key]:
+            self.last_seen[key] = last
+        return count
+
+    def storable(self, t, lat, lng):
+        if not (math.isfinite(t) and math.isfinite(lat) and math.isfinite(lng)):
+            return False
+        return abs(int(t) - self.epoch) <= INT32 and abs(lat) <= 90 and abs(lng) <= 180
+
+    def trail(self, key, since=None):
+        """Chronological [(timestamp, lat, lng), ...] for a track."""
+        slot = self.slots.get(key)
+        if slot is None:
+            return []
+        points = []
+        for tier in reversed(self.tiers):
+            for t, lat, lng in tier.entries(slot):
+                t += self.epoch
+                if since is None or t >= since:
+                    points.append((t, lat / 1e6, lng / 1e6))
+        return points
+
+    def encoded(self, key, since=None):
+        points = self.trail(key, since)
+        return {
+            'id': key,
+            'points': len(points),
+            'start': points[0][0] if points else None,
+            'end': points[-1][0] if points else None,
+            'polyline': encode_polyline([(lat, lng) for _, lat, lng in points])
+        }
+
+    def expire(self, before):
+        """Free tracks whose last fix is older than `before`."""
+        stale = [key for key, seen in self.last_seen.items() if seen < before]
+        for key in stale:
+            del self.last_seen[key]
+            self.free.append(self.slots.pop(key))
+        if stale:
+            gone = set(stale)
+            for alias in [a for a, key in self.aliases.items() if key in gone]:
+                del self.aliases[alias]
+            for bib in [b for b, key in self.bibs.items() if key in gone]:
+                del self.bibs[bib]
+        return len(stale)